@@ -2,95 +2,431 @@
 
 from __future__ import print_function
 import argparse
+import gzip
 import os
 import json
+import time
 import zipfile
 
-from hashlib import md5
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from hashlib import md5, sha256
 from subprocess import check_call
 
 from get_plugin_data import get_plugin_data
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 VERSION_TO_BRANCH = {
     None: '2.0',
     '1.0': '1.0',
     '2.0': '2.0',
 }
 
+# Bump this whenever the layout of the cached results changes
+BUILD_CACHE_VERSION = 2
+
+# Size of the blocks in which plugin files are read and archived
+CHUNK_SIZE = 64 * 1024
+
+# Names of the files written for each shard, after the plugin id
+SHARD_SUFFIXES = (".json", ".json.gz", ".json.br")
 
-def build_json(dest_dir):
+# Timestamp and permissions of all entries in reproducible archives
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+ZIP_FILE_MODE = 0o100644
+
+
+class BuildCache:
     """
-    Traverse the plugins directory to generate json data.
+    Remembers the results of previous builds, keyed on the path, mtime and
+    size of every file of a plugin, so unchanged plugins can be skipped.
     """
 
-    plugins = {}
+    def __init__(self, path=None):
+        self.path = path
+        self.stages = defaultdict(dict)
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as cache_file:
+                    data = json.load(cache_file)
+            except ValueError:
+                print("Ignoring invalid build cache: " + path)
+            else:
+                if data.get('version') == BUILD_CACHE_VERSION:
+                    self.stages.update(data.get('stages', {}))
 
-    # All top level directories in plugin_dir are plugins
-    for dirname in next(os.walk(plugin_dir))[1]:
+    def get(self, stage, dirname, key):
+        entry = self.stages[stage].get(dirname)
+        if entry and entry['key'] == key:
+            return entry['value']
+        return None
 
-        files = {}
-        data = {}
+    def set(self, stage, dirname, key, value):
+        self.stages[stage][dirname] = {'key': key, 'value': value}
 
-        if dirname in [".git"]:
-            continue
+    def prune(self, stage, dirnames):
+        """Forget about plugins which no longer exist"""
+        for dirname in set(self.stages[stage]) - set(dirnames):
+            del self.stages[stage][dirname]
 
-        dirpath = os.path.join(plugin_dir, dirname)
-        for root, dirs, filenames in os.walk(dirpath):
-            for filename in filenames:
-                ext = os.path.splitext(filename)[1]
+    def save(self):
+        if not self.path:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump({'version': BUILD_CACHE_VERSION, 'stages': self.stages},
+                      cache_file, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
-                if ext not in [".pyc"]:
-                    file_path = os.path.join(root, filename)
-                    with open(file_path, "rb") as md5file:
-                        md5Hash = md5(md5file.read()).hexdigest()
-                    files[file_path.split(os.path.join(dirpath, ''))[1]] = md5Hash
 
-                    if ext in ['.py'] and not data:
-                        data = get_plugin_data(os.path.join(plugin_dir, dirname, filename))
+class BuildStats:
+    """
+    Collects the time spent in each build stage and the cache hits and
+    misses of each cache stage. These are reported separately, as a cache
+    stage (e.g. 'plugin') spans several build stages.
+    """
 
-        if files and data:
-            print("Added: " + dirname)
-            data['files'] = files
-            plugins[dirname] = data
-    out_path = os.path.join(dest_dir, plugin_file)
-    with open(out_path, "w") as out_file:
-        json.dump({"plugins": plugins}, out_file, sort_keys=True, indent=2)
+    def __init__(self):
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.times = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def hit(self, stage):
+        self.hits[stage] += 1
 
+    def miss(self, stage):
+        self.misses[stage] += 1
 
-def zip_files(dest_dir):
+    def report(self):
+        print("Build statistics:")
+        for name in sorted(self.times):
+            print("  %-6s %8.3fs" % (name, self.times[name]))
+        for name in sorted(set(self.hits) | set(self.misses)):
+            print("  %-6s %4d cached  %4d built" % (
+                name, self.hits[name], self.misses[name]))
+
+
+def plugin_dirnames():
+    """Return the names of all plugins, i.e. the top level directories in plugin_dir"""
+    return [dirname for dirname in next(os.walk(plugin_dir))[1]
+            if dirname not in [".git"]]
+
+
+def plugin_files(dirpath):
     """
-    Zip up plugin folders
+    Return the paths of all files of a plugin, top level files first and
+    sorted by name, so that the order does not depend on the file system.
+    """
+    files = []
+    for root, dirs, filenames in os.walk(dirpath):
+        dirs.sort()
+        for filename in sorted(filenames):
+            files.append(os.path.join(root, filename))
+    return files
+
+
+def files_key(dirpath, file_paths):
+    """
+    Compute a cache key from the relative path, mtime and size of each file.
+    """
+    entries = []
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        entries.append([os.path.relpath(file_path, dirpath),
+                        stat.st_mtime_ns, stat.st_size])
+    return md5(json.dumps(entries).encode('utf-8')).hexdigest()
+
+
+def map_jobs(func, args_list, jobs=None):
+    """
+    Run func for each tuple of arguments, on a process pool unless there is
+    only a single job to run.
+    """
+    if jobs == 1 or len(args_list) < 2:
+        return [func(*args) for args in args_list]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, *zip(*args_list)))
+
+
+def scan_plugins(cache, stage, stats, is_valid=None):
+    """
+    Split the plugins into cached results and plugins which need building.
+    """
+    cached = {}
+    pending = []
+    dirnames = plugin_dirnames()
+    with stats.stage('scan'):
+        for dirname in dirnames:
+            dirpath = os.path.join(plugin_dir, dirname)
+            key = files_key(dirpath, plugin_files(dirpath))
+            value = cache.get(stage, dirname, key)
+            if value is not None and (is_valid is None or is_valid(dirname, value)):
+                stats.hit(stage)
+                cached[dirname] = value
+            else:
+                stats.miss(stage)
+                pending.append((dirname, key))
+    cache.prune(stage, dirnames)
+    return cached, pending
+
+
+class HashingWriter:
+    """
+    Write-only file wrapper which computes the SHA-256 digest of everything
+    written through it. It cannot seek, so zipfile streams the archive
+    sequentially, using data descriptors instead of rewriting headers.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = sha256()
+        self.offset = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.offset += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def archive_entry(file_path, name_in_zip, reproducible):
+    zinfo = zipfile.ZipInfo.from_file(file_path, name_in_zip)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    if reproducible:
+        zinfo.date_time = ZIP_DATE_TIME
+        zinfo.create_system = 3
+        zinfo.external_attr = ZIP_FILE_MODE << 16
+    return zinfo
+
+
+def build_plugin(dirname, plugin_dir, archive_path=None, reproducible=True):
+    """
+    Hash the files of a single plugin, read its metadata and, if
+    archive_path is given, zip it up. Every file is read only once, in
+    chunks, and fed to both the digest and the archive.
     """
 
-    for dirname in next(os.walk(plugin_dir))[1]:
-        archive_path = os.path.join(dest_dir, dirname)
-        archive = zipfile.ZipFile(archive_path + ".zip", "w")
+    files = {}
+    data = {}
+    result = {'archive': None}
 
-        dirpath = os.path.join(plugin_dir, dirname)
-        plugin_files = []
+    dirpath = os.path.join(plugin_dir, dirname)
+    plugin_paths = plugin_files(dirpath)
 
-        for root, dirs, filenames in os.walk(dirpath):
-            for filename in filenames:
-                file_path = os.path.join(root, filename)
-                plugin_files.append(file_path)
+    archive = out_file = writer = None
+    if archive_path:
+        out_file = open(archive_path + ".tmp", "wb")
+        writer = HashingWriter(out_file)
+        archive = zipfile.ZipFile(writer, "w")
 
-        if (len(plugin_files) == 1
-            and os.path.basename(plugin_files[0]) != '__init__.py'):
-            # There's only one file, put it directly into the zipfile
-            archive.write(plugin_files[0],
-                          os.path.basename(plugin_files[0]),
-                          compress_type=zipfile.ZIP_DEFLATED)
-        else:
-            for filename in plugin_files:
-                # Preserve the folder structure relative to plugin_dir
-                # in the zip file
-                name_in_zip = os.path.join(os.path.relpath(filename,
-                                                           plugin_dir))
-                archive.write(filename,
-                              name_in_zip,
-                              compress_type=zipfile.ZIP_DEFLATED)
+    try:
+        for file_path in plugin_paths:
+            ext = os.path.splitext(file_path)[1]
+            md5Hash = md5()
+            dest = None
+            if archive:
+                if (len(plugin_paths) == 1
+                    and os.path.basename(file_path) != '__init__.py'):
+                    # There's only one file, put it directly into the zipfile
+                    name_in_zip = os.path.basename(file_path)
+                else:
+                    # Preserve the folder structure relative to plugin_dir
+                    # in the zip file
+                    name_in_zip = os.path.relpath(file_path, plugin_dir)
+                dest = archive.open(archive_entry(file_path, name_in_zip, reproducible), "w")
 
-        print("Created: " + dirname + ".zip")
+            with open(file_path, "rb") as src:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    md5Hash.update(chunk)
+                    if dest:
+                        dest.write(chunk)
+            if dest:
+                dest.close()
+
+            if ext not in [".pyc"]:
+                files[os.path.relpath(file_path, dirpath)] = md5Hash.hexdigest()
+
+                if ext in ['.py'] and not data:
+                    data = get_plugin_data(file_path)
+    finally:
+        if archive:
+            archive.close()
+            out_file.close()
+
+    if archive_path:
+        os.replace(archive_path + ".tmp", archive_path)
+        result['archive'] = archive_stat(archive_path)
+        result['sha256'] = writer.sha256.hexdigest()
+
+    if files and data:
+        data['files'] = files
+        result['data'] = data
+    else:
+        result['data'] = {}
+    return result
+
+
+def archive_stat(archive_path):
+    try:
+        stat = os.stat(archive_path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def compact_json(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def write_compressed(path, content):
+    """
+    Write content to path together with precompressed .gz and, if the
+    brotli module is available, .br variants. Files whose content did not
+    change are left untouched so their mtime stays stable for mirrors,
+    unless one of the variants is missing. Without brotli, a .br variant
+    left by an earlier build is removed, as it would no longer match.
+    Returns True if the file was written.
+    """
+    variants = [path + ".gz"] + ([path + ".br"] if brotli else [])
+    if not brotli and os.path.exists(path + ".br"):
+        os.remove(path + ".br")
+    try:
+        with open(path, "rb") as in_file:
+            if (in_file.read() == content
+                    and all(os.path.exists(variant) for variant in variants)):
+                return False
+    except OSError:
+        pass
+    with open(path, "wb") as out_file:
+        out_file.write(content)
+    with open(path + ".gz", "wb") as out_file:
+        out_file.write(gzip.compress(content, mtime=0))
+    if brotli:
+        with open(path + ".br", "wb") as out_file:
+            out_file.write(brotli.compress(content))
+    return True
+
+
+def write_shards(dest_dir, plugins):
+    """
+    Write the json data as one compact shard per plugin, plus an index
+    holding the version and content hash of every shard, so that clients
+    only need to fetch the shards which changed.
+    """
+    shard_dir = os.path.join(dest_dir, plugin_shard_dir)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    index = {}
+    for dirname, data in sorted(plugins.items()):
+        content = compact_json(data)
+        index[dirname] = {
+            'version': data['version'],
+            'sha256': sha256(content).hexdigest(),
+        }
+        if write_compressed(os.path.join(shard_dir, dirname + ".json"), content):
+            print("Updated shard: " + dirname)
+
+    # Remove the shards of plugins which no longer exist
+    for filename in os.listdir(shard_dir):
+        for suffix in SHARD_SUFFIXES:
+            if filename.endswith(suffix) and filename[:-len(suffix)] not in index:
+                os.remove(os.path.join(shard_dir, filename))
+                break
+
+    write_compressed(os.path.join(dest_dir, plugin_index_file),
+                     compact_json({"plugins": index}))
+
+
+def build_plugins(dest_dir, write_json=True, write_zip=True, cache=None,
+                  stats=None, jobs=None, reproducible=True, sharded=False):
+    """
+    Generate the json data and zip files for all plugins in a single pass.
+    If sharded is set, the json data is also written as per-plugin shards,
+    even if write_json is not.
+    """
+
+    cache = cache or BuildCache()
+    stats = stats or BuildStats()
+
+    def archive_path(dirname):
+        return os.path.join(dest_dir, dirname) + ".zip" if write_zip else None
+
+    def is_valid(dirname, value):
+        # Rebuild archives which were removed or modified since the last run
+        return (not write_zip
+                or (value['archive'] is not None
+                    and value.get('reproducible') == reproducible
+                    and archive_stat(archive_path(dirname)) == value['archive']))
+
+    results, pending = scan_plugins(cache, 'plugin', stats, is_valid)
+    with stats.stage('build'):
+        built = map_jobs(build_plugin,
+                         [(dirname, plugin_dir, archive_path(dirname), reproducible)
+                          for dirname, key in pending],
+                         jobs)
+        for (dirname, key), value in zip(pending, built):
+            if write_zip:
+                value['reproducible'] = reproducible
+                print("Created: " + dirname + ".zip")
+            cache.set('plugin', dirname, key, value)
+            results[dirname] = value
+
+    if not write_json and not sharded:
+        return
+
+    with stats.stage('json'):
+        plugins = {}
+        for dirname, value in sorted(results.items()):
+            if not value['data']:
+                continue
+            print("Added: " + dirname)
+            plugins[dirname] = dict(value['data'])
+            if write_zip:
+                plugins[dirname]['zip_sha256'] = value['sha256']
+        if write_json:
+            out_path = os.path.join(dest_dir, plugin_file)
+            with open(out_path, "w") as out_file:
+                json.dump({"plugins": plugins}, out_file, sort_keys=True, indent=2)
+    if sharded:
+        with stats.stage('shards'):
+            write_shards(dest_dir, plugins)
+
+
+def build_json(dest_dir, cache=None, stats=None, jobs=None):
+    """
+    Traverse the plugins directory to generate json data.
+    """
+    build_plugins(dest_dir, write_zip=False, cache=cache, stats=stats, jobs=jobs)
+
+
+def zip_files(dest_dir, cache=None, stats=None, jobs=None, reproducible=True):
+    """
+    Zip up plugin folders
+    """
+    build_plugins(dest_dir, write_json=False, cache=cache, stats=stats,
+                  jobs=jobs, reproducible=reproducible)
 
 
 # The file that contains json data
@@ -99,6 +435,12 @@ plugin_file = "plugins.json"
 # The directory which contains plugin files
 plugin_dir = "plugins"
 
+# The compact index of the per-plugin json shards
+plugin_index_file = "plugins-index.json"
+
+# The directory in the build output which contains the json shards
+plugin_shard_dir = "shards"
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate plugin files for Picard website.')
     parser.add_argument('version', nargs='?', help="Build output files for the specified version")
@@ -106,6 +448,11 @@ if __name__ == '__main__':
     parser.add_argument('--pull', action='store_true', dest='pull', help="Pulls the remote origin and updates the files before building")
     parser.add_argument('--no-zip', action='store_false', dest='zip', help="Do not generate the zip files in the build output")
     parser.add_argument('--no-json', action='store_false', dest='json', help="Do not generate the json file in the build output")
+    parser.add_argument('--sharded', action='store_true', dest='sharded', help="Also write the json data as compressed per-plugin shards with a compact index")
+    parser.add_argument('--no-reproducible', action='store_false', dest='reproducible', help="Keep the timestamps and permissions of the plugin files in the zip files")
+    parser.add_argument('--no-cache', action='store_false', dest='cache', help="Rebuild all plugins instead of reusing the results of the previous build")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of plugins to build in parallel. DEFAULT = number of CPUs")
+    parser.add_argument('--stats', action='store_true', dest='stats', help="Print cache hits and the time spent in each stage")
     args = parser.parse_args()
     check_call(["git", "checkout", "-q", VERSION_TO_BRANCH[args.version], '--', 'plugins'])
     dest_dir = os.path.abspath(os.path.join(args.build_dir, args.version or ''))
@@ -113,7 +460,13 @@ if __name__ == '__main__':
         os.makedirs(dest_dir)
     if args.pull:
         check_call(["git", "pull", "-q"])
-    if args.json:
-        build_json(dest_dir)
-    if args.zip:
-        zip_files(dest_dir)
+    cache_path = None
+    if args.cache:
+        cache_path = os.path.join(args.build_dir, ".cache", (args.version or "default") + ".json")
+    cache = BuildCache(cache_path)
+    stats = BuildStats()
+    build_plugins(dest_dir, args.json, args.zip, cache, stats, args.jobs,
+                  args.reproducible, args.sharded)
+    cache.save()
+    if args.stats:
+        stats.report()
@@ -25,12 +25,17 @@
 
 from collections import namedtuple
 from functools import partial
+import json
+import os
+import sqlite3
+import time
 
 from picard import (
     config,
     log,
 )
 from picard.album import register_album_post_removal_processor
+from picard.const import USER_DIR
 from picard.metadata import (
     register_album_metadata_processor,
     register_track_metadata_processor,
@@ -58,7 +63,7 @@ artist processing, which can significantly increase the processing speed if you
 Please see the <a href="https://github.com/rdswift/picard-plugins/blob/2.0_RDS_Plugins/plugins/additional_artists_details/docs/README.md">user
 guide</a> on GitHub for more information.
 '''
-PLUGIN_VERSION = '0.3'
+PLUGIN_VERSION = '0.5'
 PLUGIN_API_VERSIONS = ['2.0', '2.1', '2.2', '2.7', '2.8']
 PLUGIN_LICENSE = 'GPL-2.0-or-later'
 PLUGIN_LICENSE_URL = 'https://www.gnu.org/licenses/gpl-2.0.html'
@@ -81,16 +86,21 @@ AREA_TYPE_MUNICIPALITY = '17246454-5ac4-36a1-b81a-4753eb2dab20'
 EXCLUDE_AREA_TYPES = {AREA_TYPE_MUNICIPALITY, AREA_TYPE_COUNTY}
 
 # Standard text for arguments
+ALBUM = 'album'
 ALBUM_ARTISTS = 'album_artists'
 ARTIST = 'artist'
 ARTIST_REQUESTS = 'artist_requests'
 AREA = 'area'
 AREA_REQUESTS = 'area_requests'
+AREA_ITEMS = ('area', 'begin-area', 'end-area')
 ISO_CODES = 'iso-3166-1-codes'
 OPT_AREA_DETAILS = 'aad_area_details'
 OPT_PROCESS_TRACKS = 'aad_process_tracks'
 TRACKS = 'tracks'
 
+# How long artist and area details are kept in the store, in seconds
+STORE_MAX_AGE = 30 * 24 * 60 * 60
+
 
 def log_helper(text, *args):
     """Logging helper to prepend the plugin name to the text.
@@ -149,6 +159,66 @@ class CustomHelper(MBAPIHelper):
         return self._get_by_id(AREA, _id, handler, inc, priority=priority, important=important, mblogin=mblogin, refresh=refresh)
 
 
+class DetailsStore:
+    """Persistent store of artist details and areas, shared by all Picard sessions on this host.
+    """
+
+    TABLES = (ARTIST, AREA)
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the SQLite database file.
+        """
+        self.path = path
+        self.db = None
+
+    def _connect(self):
+        """Open the database, creating it if necessary.
+
+        Returns:
+            Connection: The database connection.
+        """
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            for table in self.TABLES:
+                self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, value TEXT, fetched REAL)")
+        return self.db
+
+    def load(self, table):
+        """Load all entries of a table which are not older than STORE_MAX_AGE, removing the others.
+
+        Args:
+            table (str): Table to load (ARTIST or AREA).
+
+        Returns:
+            dict: Stored values keyed on MBID.
+        """
+        try:
+            db = self._connect()
+            oldest = time.time() - STORE_MAX_AGE
+            db.execute(f"DELETE FROM {table} WHERE fetched < ?", (oldest,))
+            return {_id: json.loads(value) for (_id, value) in db.execute(f"SELECT id, value FROM {table}")}
+        except (OSError, sqlite3.Error, ValueError) as ex:
+            log.warning(*log_helper("Unable to read the %s store: %s", table, ex))
+            return {}
+
+    def save(self, table, _id, value):
+        """Save an entry to a table.
+
+        Args:
+            table (str): Table to update (ARTIST or AREA).
+            _id (str): MBID of the artist or area.
+            value (object): Value to store (must be serializable as JSON).
+        """
+        try:
+            self._connect().execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)", (_id, json.dumps(value), time.time()))
+        except (OSError, sqlite3.Error) as ex:
+            log.warning(*log_helper("Unable to write to the %s store: %s", table, ex))
+
+
 class ArtistDetailsPlugin:
     """Plugin to retrieve artist details, including area and country information.
     """
@@ -160,6 +230,54 @@ class ArtistDetailsPlugin:
     }
     album_processing_count = {}
     albums = {}
+    store = DetailsStore(os.path.join(USER_DIR, 'additional_artists_details', 'store.db'))
+    store_loaded = False
+    # Country and location of areas, keyed on (area MBID, area details option)
+    drilled_areas = {}
+    # Artist and area MBIDs being retrieved
+    pending = set()
+    # Variables of artists whose information is complete, keyed on (artist MBID, area details option)
+    artist_variables = {}
+
+    def _load_store(self):
+        """Add the artists and areas saved in previous sessions to the result cache.
+        """
+        if self.store_loaded:
+            return
+        ArtistDetailsPlugin.store_loaded = True
+        for artist_id, artist_info in self.store.load(ARTIST).items():
+            self.result_cache[ARTIST][artist_id] = artist_info
+            self.result_cache[ARTIST_REQUESTS].add(artist_id)
+        for area_id, area in self.store.load(AREA).items():
+            self.result_cache[AREA][area_id] = Area(*area)
+            self.result_cache[AREA_REQUESTS].add(area_id)
+        log.debug(*log_helper("Loaded %s artists and %s areas from the store.", len(self.result_cache[ARTIST]), len(self.result_cache[AREA])))
+
+    def _cache_artist(self, artist_id, artist_info):
+        """Add the artist information to the result cache and the store.
+
+        Args:
+            artist_id (str): MBID of the artist.
+            artist_info (dict): Dictionary of information for the artist.
+        """
+        self.result_cache[ARTIST][artist_id] = artist_info
+        self.store.save(ARTIST, artist_id, artist_info)
+        for area_details in (False, True):
+            self.artist_variables.pop((artist_id, area_details), None)
+
+    def _cache_area(self, area_id, area):
+        """Add the area to the result cache and the store.
+
+        Args:
+            area_id (str): MBID of the area.
+            area (Area): Area information.
+        """
+        if area_id in self.result_cache[AREA] and self.result_cache[AREA][area_id] != area:
+            # The area may be a link in a chain which has already been drilled.
+            self.drilled_areas.clear()
+            self.artist_variables.clear()
+        self.result_cache[AREA][area_id] = area
+        self.store.save(AREA, area_id, area)
 
     def _make_empty_target(self, album_id):
         """Create an empty album target node if it doesn't exist.
@@ -168,7 +286,7 @@ class ArtistDetailsPlugin:
             album_id (str): MBID of the album.
         """
         if album_id not in self.albums:
-            self.albums[album_id] = {ALBUM_ARTISTS: set(), TRACKS: []}
+            self.albums[album_id] = {ALBUM: None, ALBUM_ARTISTS: set(), TRACKS: []}
 
     def _add_target(self, album_id, artists, target_metadata):
         """Add a metadata target to update for an album.
@@ -179,6 +297,8 @@ class ArtistDetailsPlugin:
             target_metadata (Metadata): Target metadata to update.
         """
         self._make_empty_target(album_id)
+        # Add album artists to track so they are available in the metadata
+        artists = self.albums[album_id][ALBUM_ARTISTS].union(artists)
         self.albums[album_id][TRACKS].append(MetadataPair(artists, target_metadata))
 
     def _remove_album(self, album_id):
@@ -230,6 +350,7 @@ class ArtistDetailsPlugin:
             album_metadata (Metadata): Metadata object for the album.
             _release_metadata (dict): Dictionary of release data from MusicBrainz api.
         """
+        self._load_store()
         artists = set(artist.id for artist in album.get_album_artists())
         self._make_empty_target(album.id)
         self.albums[album.id][ALBUM_ARTISTS] = artists
@@ -281,48 +402,137 @@ class ArtistDetailsPlugin:
                 self._get_artist_info(temp_id, album)
             else:
                 log.debug(*log_helper('%s artist ID %s information available from cache.', source_type, temp_id))
+                self._get_missing_areas(temp_id, album)
         self._add_target(album.id, artists, destination_metadata)
         self._save_artist_metadata(album.id)
+        if self.albums[album.id][TRACKS] and not self.albums[album.id][ALBUM]:
+            # Keep the album loading until its targets have been saved.
+            self.albums[album.id][ALBUM] = album
+            self._album_add_request(album)
+
+    def _get_missing_areas(self, artist_id, album):
+        """Retrieves the first missing area in the chain of each area of a stored artist,
+        e.g. if it could not be retrieved when the artist was stored.
+
+        Args:
+            artist_id (str): MBID of the artist.
+            album (Album): Album object to use for the processing.
+        """
+        artist_info = self.result_cache[ARTIST].get(artist_id, {})
+        for item in AREA_ITEMS:
+            area_id = artist_info.get(item, '')
+            i = 7   # Counter to avoid potential runaway processing (as in _drill_area)
+            while i and area_id:
+                i -= 1
+                if area_id not in self.result_cache[AREA_REQUESTS]:
+                    self._get_area_info(area_id, album)
+                    break
+                area = self.result_cache[AREA].get(area_id)
+                if area is None or area.country:
+                    break
+                area_id = area.parent
+
+    def _artist_ready(self, artist_id):
+        """Checks whether the information for an artist is complete, i.e. neither the artist
+        nor any area in the chains of its areas is still being retrieved.
+
+        Args:
+            artist_id (str): MBID of the artist.
+
+        Returns:
+            bool: True if the artist's variables can be saved.
+        """
+        if artist_id in self.pending:
+            return False
+        artist_info = self.result_cache[ARTIST].get(artist_id, {})
+        for item in AREA_ITEMS:
+            area_id = artist_info.get(item, '')
+            i = 7   # Counter to avoid potential runaway processing (as in _drill_area)
+            while i and area_id:
+                i -= 1
+                if area_id in self.pending:
+                    return False
+                area = self.result_cache[AREA].get(area_id)
+                if area is None or area.country:
+                    break
+                area_id = area.parent
+        return True
 
     def _save_artist_metadata(self, album_id):
-        """Saves the new artist details variables to the metadata targets for the specified album.
+        """Saves the new artist details variables to the metadata targets for the specified album
+        whose artists are all complete.  Each target is saved once, and then removed.
 
         Args:
             album_id (str): MBID of the album to process.
         """
-        if album_id in self.album_processing_count and self.album_processing_count[album_id]:
-            return
-        if album_id not in self.albums or not self.albums[album_id][TRACKS]:
-            log.error(*log_helper("No metadata targets found for album '%s'", album_id))
+        if album_id not in self.albums:
             return
+        ready = {}
+        waiting = []
         for item in self.albums[album_id][TRACKS]:
-            # Add album artists to track so they are available in the metadata
-            artists = self.albums[album_id][ALBUM_ARTISTS].copy().union(item.artists)
-            destination_metadata = item.target
-            for artist in artists:
-                if artist in self.result_cache[ARTIST]:
-                    self._set_artist_metadata(destination_metadata, artist, self.result_cache[ARTIST][artist])
-
-    def _set_artist_metadata(self, destination_metadata, artist_id, artist_info):
+            for artist in item.artists:
+                if artist not in ready:
+                    ready[artist] = self._artist_ready(artist)
+            if all(ready[artist] for artist in item.artists):
+                for artist in item.artists:
+                    self._set_artist_metadata(item.target, artist)
+            else:
+                waiting.append(item)
+        self.albums[album_id][TRACKS] = waiting
+        album = self.albums[album_id][ALBUM]
+        if album and not waiting:
+            self.albums[album_id][ALBUM] = None
+            self._album_remove_request(album)
+
+    def _save_all_artist_metadata(self):
+        """Saves the variables to the targets of all albums whose artists are complete.  Artists
+        may be retrieved for another album than the one waiting for them.
+        """
+        for album_id in list(self.albums):
+            if self.albums[album_id][TRACKS]:
+                self._save_artist_metadata(album_id)
+
+    def _get_artist_variables(self, artist_id):
+        """Gets the variables for an artist, which are worked out once for each setting of the
+        area details option.
+
+        Args:
+            artist_id (str): MBID of the artist.
+
+        Returns:
+            dict: Variable names and values.
+        """
+        key = (artist_id, config.setting[OPT_AREA_DETAILS])
+        if key not in self.artist_variables:
+            variables = {}
+
+            def _set_item(key, value):
+                variables[f"~artist_{artist_id}_{key.replace('-', '_')}"] = value
+
+            artist_info = self.result_cache[ARTIST][artist_id]
+            for item in artist_info.keys():
+                if item in AREA_ITEMS:
+                    country, location = self._drill_area(artist_info[item])
+                    if country:
+                        _set_item(item.replace('area', 'country'), country)
+                    if location:
+                        _set_item(item.replace('area', 'location'), location)
+                else:
+                    _set_item(item, artist_info[item])
+            self.artist_variables[key] = variables
+        return self.artist_variables[key]
+
+    def _set_artist_metadata(self, destination_metadata, artist_id):
         """Adds the artist information to the destination metadata.
 
         Args:
             destination_metadata (Metadata): Metadata object to update with new variables.
             artist_id (str): MBID of the artist to update.
-            artist_info (dict): Dictionary of information for the artist.
         """
-        def _set_item(key, value):
-            destination_metadata[f"~artist_{artist_id}_{key.replace('-', '_')}"] = value
-
-        for item in artist_info.keys():
-            if item in {'area', 'begin-area', 'end-area'}:
-                country, location = self._drill_area(artist_info[item])
-                if country:
-                    _set_item(item.replace('area', 'country'), country)
-                if location:
-                    _set_item(item.replace('area', 'location'), location)
-            else:
-                _set_item(item, artist_info[item])
+        if artist_id not in self.result_cache[ARTIST]:
+            return
+        for key, value in self._get_artist_variables(artist_id).items():
+            destination_metadata[key] = value
 
     def _get_artist_info(self, artist_id, album):
         """Gets the artist information from the MusicBrainz website.
@@ -331,6 +541,7 @@ class ArtistDetailsPlugin:
             artist_id (str): MBID of the artist to retrieve.
             album (Album): The Album object to use for the processing.
         """
+        self.pending.add(artist_id)
         self._album_add_request(album)
         helper = CustomHelper(album.tagger.webservice)
         handler = partial(
@@ -355,16 +566,17 @@ class ArtistDetailsPlugin:
                 for item in ['begin', 'end']:
                     if item in document['life-span'] and document['life-span'][item]:
                         artist_info[item] = document['life-span'][item]
-            for item in ['area', 'begin-area', 'end-area']:
+            for item in AREA_ITEMS:
                 if item in document and document[item] and 'id' in document[item] and document[item]['id']:
                     area_id = document[item]['id']
                     artist_info[item] = area_id
                     if area_id not in self.result_cache[AREA_REQUESTS]:
                         self._get_area_info(area_id, album)
-            self.result_cache[ARTIST][artist] = artist_info
+            self._cache_artist(artist, artist_info)
         finally:
+            self.pending.discard(artist)
+            self._save_all_artist_metadata()
             self._album_remove_request(album)
-            self._save_artist_metadata(album.id)
 
     def _get_area_info(self, area_id, album):
         """Gets the area information from the MusicBrainz website.
@@ -374,6 +586,7 @@ class ArtistDetailsPlugin:
             album (Album): The Album object to use for the processing.
         """
         self.result_cache[AREA_REQUESTS].add(area_id)
+        self.pending.add(area_id)
         self._album_add_request(album)
         log.debug(*log_helper('Retrieving area ID %s from MusicBrainz.', area_id))
         helper = CustomHelper(album.tagger.webservice)
@@ -394,13 +607,14 @@ class ArtistDetailsPlugin:
             (_id, name, country, _type, type_text) = self._parse_area(document)
             if _type == AREA_TYPE_COUNTRY and _id not in self.result_cache[AREA]:
                 self._area_logger(_id, f"{name} ({country})", type_text)
-                self.result_cache[AREA][_id] = Area('', name, country, _type, type_text)
+                self._cache_area(_id, Area('', name, country, _type, type_text))
             if 'relations' in document:
                 for rel in document['relations']:
                     self._parse_area_relation(_id, rel, album, name, _type, type_text)
         finally:
+            self.pending.discard(area)
+            self._save_all_artist_metadata()
             self._album_remove_request(album)
-            self._save_artist_metadata(album.id)
 
     @staticmethod
     def _area_logger(area_id, area_name, area_type):
@@ -433,12 +647,12 @@ class ArtistDetailsPlugin:
         if 'direction' in area_relation and area_relation['direction'] == 'backward':
             if area_id not in self.result_cache[AREA]:
                 self._area_logger(area_id, area_name, area_type_text)
-                self.result_cache[AREA][area_id] = Area(_id, area_name, '', area_type, type_text)
+                self._cache_area(area_id, Area(_id, area_name, '', area_type, type_text))
                 self.result_cache[AREA_REQUESTS].add(area_id)
             if _type == AREA_TYPE_COUNTRY:
                 if _id not in self.result_cache[AREA]:
                     self._area_logger(_id, f"{name} ({country})", type_text)
-                    self.result_cache[AREA][_id] = Area('', name, country, _type, type_text)
+                    self._cache_area(_id, Area('', name, country, _type, type_text))
                     self.result_cache[AREA_REQUESTS].add(_id)
             else:
                 if _id not in self.result_cache[AREA] and _id not in self.result_cache[AREA_REQUESTS]:
@@ -446,7 +660,7 @@ class ArtistDetailsPlugin:
         else:
             self._area_logger(_id, name, type_text)
             self.result_cache[AREA_REQUESTS].add(_id)
-            self.result_cache[AREA][_id] = Area(area_id, name, '', _type, type_text)
+            self._cache_area(_id, Area(area_id, name, '', _type, type_text))
 
     @staticmethod
     def _parse_area(area_info):
@@ -491,6 +705,9 @@ class ArtistDetailsPlugin:
         Returns:
             tuple: The two-character country code and full location description for the area.
         """
+        key = (area_id, config.setting[OPT_AREA_DETAILS])
+        if key in self.drilled_areas:
+            return self.drilled_areas[key]
         country = ''
         location = []
         i = 7   # Counter to avoid potential runaway processing
@@ -501,6 +718,9 @@ class ArtistDetailsPlugin:
             area_id = area.parent
             if not location or config.setting[OPT_AREA_DETAILS] or area.type not in EXCLUDE_AREA_TYPES:
                 location.append(area.name)
+        if country:
+            # Only complete chains are kept, as the areas of the others may still be retrieved.
+            self.drilled_areas[key] = (country, ', '.join(location))
         return country, ', '.join(location)
 
 
@@ -81,14 +81,14 @@ on GitHub here</a> for full details.
 #
 # The main control routine is at the end of the module
 
-PLUGIN_VERSION = '2.0.14'
+PLUGIN_VERSION = '2.0.15'
 PLUGIN_API_VERSIONS = ["2.0", "2.1", "2.2", "2.3", "2.4", "2.5", "2.6", "2.7"]
 PLUGIN_LICENSE = "GPL-2.0"
 PLUGIN_LICENSE_URL = "https://www.gnu.org/licenses/gpl-2.0.html"
 
 from picard.ui.options import register_options_page, OptionsPage
 from picard.plugins.classical_extras.ui_options_classical_extras import Ui_ClassicalExtrasOptionsPage
-import picard.plugins.classical_extras.suffixtree
+from picard.plugins.classical_extras import suffixtree
 from picard import config, log
 from picard.config import ConfigSection, BoolOption, IntOption, TextOption
 from picard.util import LockableObject, uniqify
@@ -96,8 +96,9 @@ from picard.util import LockableObject, uniqify
 # note that in 2.0 picard.webservice changed to picard.util.xml
 from picard.util.xml import XmlNode
 from picard.util import translate_from_sortname
+from picard.util import thread
 from picard.metadata import register_track_metadata_processor, Metadata
-from functools import partial
+from functools import partial, lru_cache, wraps
 from datetime import datetime
 import collections
 import re
@@ -109,6 +110,13 @@ from PyQt5.QtCore import QXmlStreamReader
 from picard.const import USER_DIR
 import operator
 import ast
+import bisect
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import weakref
 import picard.plugins.classical_extras.const
 
 
@@ -132,12 +140,42 @@ RE_SCALES = r'(major|minor)?(?:\b|$)'
 RE_KEYS = re.compile(
     RE_NOTES + RE_ACCENTS + RE_SCALES,
     re.UNICODE | re.IGNORECASE)
+# OPUS NUMBERS (see canonize_opus)
+RE_OPUS = re.compile(
+    r'\b((?:op|no|k|kk|kv|L|B|Hob|S|D|M)|\w+WV)\W?\s?(\d+\-?\u2013?\u2014?\d*\w*)\b',
+    re.IGNORECASE)
+RE_OPUS_NO = re.compile(r'^\W*no\b', re.IGNORECASE)
+RE_KEY_SHARP = re.compile(r'\-sharp|\u266F', re.IGNORECASE)
+RE_KEY_FLAT = re.compile(r'\-flat|\u266D', re.IGNORECASE)
+# TITLE WORDS (see SynonymTable.listify_regexes)
+OPUS_REGEX_ITEM = r'(?:op|no|k|kk|kv|L|B|Hob|S|D|M|\w+WV)'
+HYPHEN_SPLIT_PATTERN = r"(?:\b|\"|\')(\w+['’]?\w*)|(?:\b\w+\b)|(\B\&\B)"
+# treat em-dash and en-dash as hyphens
+HYPHEN_EMBED_PATTERN = r"(?:\b|\"|\')(\w+['’\-\u2013\u2014]?\w*)|(?:\b\w+\b)|(\B\&\B)"
+# BOILING (see boil_string) - spellings are replaced in sequence, so the order matters
+BOIL_SPELLINGS = (('sch', 'sh'), (u'\xdf', 'ss'), ('sz', 'ss'), (u'\u0153', 'oe'), ('oe', 'o'),
+                  (u'\u00fc', 'ue'), ('ue', 'u'), (u'\u00e6', 'ae'), ('ae', 'a'))
+BOIL_SYMBOLS = str.maketrans({u'\u266F': 'sharp', u'\u266D': 'flat', u'\u2013': '-', u'\u2014': '-'})
+RE_BOIL_PUNC = re.compile(r'\W*', re.ASCII)
+BOIL_CACHE_SIZE = 8192  # number of boiled strings to remember
+PROFILE_RECENT_RELEASES = 20  # number of releases listed in the session profile
+SELECTOR_CACHE_SIZE = 1024  # number of parse_data match paths to remember (some include work ids)
+# REFERENCES
+REFERENCE_CACHE_VERSION = 1  # change if the format of the parsed references changes
+# LONGEST COMMON SUBSTRINGS (see turbo_lcs)
+# heuristic (mean length squared x number of lists) above which the suffix automaton is faster than
+# chained pairwise DP - measured on lists of 2 to 50 lyrics of 5 to 200 words
+LCS_SUFFIX_THRESHOLD = 800
+
+# WORK STORE
+WORK_STORE_MAX_AGE = 90 * 24 * 60 * 60  # seconds before a stored work record is looked up again
+WORK_STORE_MAX_ENTRIES = 20000  # least recently used work records are removed above this
 
 # LOGGING
 
 # If logging occurs before any album is loaded, the startup log file will
 # be written
-log_files = collections.defaultdict(dict)
+log_files = set()
 # entries are release-ids: to keep track of which log files are open
 release_status = collections.defaultdict(dict)
 # release_status[release_id]['works'] = True indicates that we are still processing works for release_id
@@ -148,6 +186,80 @@ release_status = collections.defaultdict(dict)
 # release_status[release_id]['file_objects'] holds a cumulative list of file objects (tagger seems a bit unreliable)
 # release_status[release_id]['file_found'] = False indicates that "No file
 # with matching trackid" has (yet) been found
+# release_status[release_id]['debug'], ['warnings'] and ['errors'] hold the messages for the session log
+# (as dict keys, so that repeated messages are only held once, in order of first occurrence)
+# release_status[release_id]['profile'] holds the time spent in each processing stage and counts of
+# cache hits and bytes received (see profile_stage)
+
+
+class LogWriter(threading.Thread):
+    """
+    Writes the custom log files in the background, so that logging does not wait on the disk.
+    A log file is opened with the first line written for its release_id and closed by close().
+    Files are flushed whenever there is nothing left to write, so they stay reasonably up to date.
+    Other files (e.g. profiles) are replaced as a whole by replace().
+    """
+
+    REPLACE = object()
+    # marker for the queue entries of replace()
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='Classical Extras log writer', daemon=True)
+        self.queue = queue.Queue()
+
+    def write(self, release_id, header, line):
+        """
+        :param release_id: name for log file
+        :param header: written first if the file is not open yet
+        :param line:
+        :return:
+        """
+        self.queue.put((release_id, header, line))
+
+    def close(self, release_id):
+        self.queue.put((release_id, None, None))
+
+    def replace(self, filename, content):
+        """
+        :param filename: name of the file in the log directory
+        :param content: new content of the file
+        :return:
+        """
+        self.queue.put((filename, content, self.REPLACE))
+
+    def run(self):
+        log_dir = os.path.join(USER_DIR, "Classical_Extras")
+        files = {}
+        while True:
+            release_id, header, line = self.queue.get()
+            filename = release_id + ".log"
+            try:
+                if line is self.REPLACE:
+                    filename = release_id
+                    path = os.path.join(log_dir, filename)
+                    os.makedirs(log_dir, exist_ok=True)
+                    with open(path + '.tmp', 'w', encoding='utf8') as out_file:
+                        out_file.write(header)
+                    os.replace(path + '.tmp', path)
+                    continue
+                if line is None:
+                    if release_id in files:
+                        files.pop(release_id).close()
+                    continue
+                if release_id not in files:
+                    os.makedirs(log_dir, exist_ok=True)
+                    files[release_id] = open(os.path.join(log_dir, filename), 'w', encoding='utf8')
+                    files[release_id].write(header)
+                files[release_id].write(line)
+                if self.queue.empty():
+                    for log_file in files.values():
+                        log_file.flush()
+            except (IOError, OSError):
+                log.error('Unable to write to log file %s', filename)
+
+
+log_writer = LogWriter()
+log_writer.start()
 
 
 def write_log(release_id, log_type, message, *args):
@@ -157,6 +269,7 @@ def write_log(release_id, log_type, message, *args):
     to aid in debugging - the log file is release_id.log. Any startup messages (i.e. before a release has been loaded)
     are written to session.log. Summary information for each release is also written to session.log even if log_info
     is not set.
+    Nothing is formatted unless the message is actually going to be logged.
     :param release_id: name for log file - usually =musicbrainz_albumid
         unless called outside metadata processor
     :param log_type: 'error', 'warning', 'debug' or 'info'
@@ -165,6 +278,16 @@ def write_log(release_id, log_type, message, *args):
     :return:
     """
     options = config.setting
+    # if log_info is True, all log messages will be written to the custom log, regardless of other log_... settings
+    # basic session log will always be written (summary of releases and
+    # processing times)
+    to_file = log_type == "basic" or options["log_info"]
+    # Only debug, warning and error messages will be written to the main
+    # Picard log, if those options have been set
+    to_picard = log_type in ('debug', 'warning', 'error') and options["log_" + log_type]
+    if not to_file and not to_picard:
+        return
+
     if not isinstance(message, str):
         msg = repr(message)
     else:
@@ -172,92 +295,144 @@ def write_log(release_id, log_type, message, *args):
     if args:
         msg = msg % args
 
-    if options["log_info"] or log_type == "basic":
-        # if log_info is True, all log messages will be written to the custom log, regardless of other log_... settings
-        # basic session log will always be written (summary of releases and
-        # processing times)
-        filename = release_id + ".log"
-        log_dir = os.path.join(USER_DIR, "Classical_Extras")
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+    if to_file:
+        header = None
         if release_id not in log_files:
-            try:
-                if release_id == 'session':
-                    log_file = open(
-                        os.path.join(
-                            log_dir,
-                            filename),
-                        'w',
-                        encoding='utf8',
-                        buffering=1)
-                    # buffering=1 so that session log (low volume) is up to
-                    # date even if not closed
-                else:
-                    log_file = open(
-                        os.path.join(
-                            log_dir,
-                            filename),
-                        'w',
-                        encoding='utf8')  # , buffering=1)
-                    # default buffering for speed, buffering = 1 for currency
-                log_files[release_id] = log_file
-                log_file.write(
-                    PLUGIN_NAME +
-                    ' Version:' +
-                    PLUGIN_VERSION +
-                    '\n')
-                if release_id == 'session':
-                    log_file.write('session' + '\n')
-                else:
-                    log_file.write('Release id: ' + release_id + '\n')
-                    if release_id in release_status and 'name' in release_status[release_id]:
-                        log_file.write(
-                            'Album name: ' + release_status[release_id]['name'] + '\n')
-            except IOError:
-                log.error('Unable to open file %s for writing log', filename)
-                return
-        else:
-            log_file = log_files[release_id]
-        try:
-            log_file.write(log_type[0].upper() + ': ')
-            log_file.write(str(datetime.now()) + ' : ')
-            log_file.write(msg)
-            log_file.write("\n")
-        except IOError:
-            log.error('Unable to write to log file %s', filename)
-            return
-    # Only debug, warning and error messages will be written to the main
-    # Picard log, if those options have been set
+            log_files.add(release_id)
+            header = PLUGIN_NAME + ' Version:' + PLUGIN_VERSION + '\n'
+            if release_id == 'session':
+                header += 'session' + '\n'
+            else:
+                header += 'Release id: ' + release_id + '\n'
+                if release_id in release_status and 'name' in release_status[release_id]:
+                    header += 'Album name: ' + release_status[release_id]['name'] + '\n'
+        log_writer.write(
+            release_id,
+            header,
+            log_type[0].upper() + ': ' + str(datetime.now()) + ' : ' + msg + '\n')
+    if not to_picard:
+        return
+
     if log_type != 'info' and log_type != 'basic':  # i.e. non-custom log items
         message2 = PLUGIN_NAME + ': ' + message
     else:
         message2 = message
-    if log_type == 'debug' and options["log_debug"]:
-        if release_id in release_status and 'debug' in release_status[release_id]:
-            add_list_uniquely(release_status[release_id]['debug'], msg)
-        else:
-            release_status[release_id]['debug'] = [msg]
+    messages = {'debug': 'debug', 'warning': 'warnings', 'error': 'errors'}[log_type]
+    release_status[release_id].setdefault(messages, {})[msg] = None
+    if log_type == 'debug':
         log.debug(message2, *args)
-    if log_type == 'warning' and options["log_warning"]:
-        if release_id in release_status and 'warnings' in release_status[release_id]:
-            add_list_uniquely(release_status[release_id]['warnings'], msg)
-        else:
-            release_status[release_id]['warnings'] = [msg]
+    elif log_type == 'warning':
         if args:
             log.warning(message2, *args)
         else:
             log.warning(message2)
-    if log_type == 'error' and options["log_error"]:
-        if release_id in release_status and 'errors' in release_status[release_id]:
-            add_list_uniquely(release_status[release_id]['errors'], msg)
-        else:
-            release_status[release_id]['errors'] = [msg]
+    else:
         if args:
             log.error(message2, *args)
         else:
             log.error(message2)
 
 
+# PROFILING
+
+session_profile = {'releases': 0, 'recent': collections.deque(maxlen=PROFILE_RECENT_RELEASES),
+                   'stages': {}, 'lookups': 0, 'cache_hits': 0, 'bytes_received': 0}
+# totals for the session and the durations of the latest releases, written to session.profile.json
+# as each release is completed (the full profile of each release is in its own file)
+profile_local = threading.local()
+# stages being timed in the current thread, so that recursive calls are only timed once
+
+
+def release_profile(release_id):
+    """
+    :param release_id:
+    :return: release_status[release_id]['profile'] - cumulative timings of stages and counts
+    """
+    return release_status[release_id].setdefault(
+        'profile', {'stages': {}, 'cache_hits': 0, 'bytes_received': 0})
+
+
+def count_profile(release_id, counter, amount=1):
+    """
+    Add to a counter ('cache_hits' or 'bytes_received') in the release profile
+    :param release_id:
+    :param counter:
+    :param amount:
+    :return:
+    """
+    if release_id in release_status:
+        release_profile(release_id)[counter] += amount
+
+
+def profile_stage(stage, release_arg):
+    """
+    Decorator to add the wall and CPU time of each call to the profile of the release
+    :param stage: name of the stage in the profile
+    :param release_arg: position of the release_id argument, or a function of the arguments returning it
+    :return:
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not hasattr(profile_local, 'active'):
+                profile_local.active = set()
+            if stage in profile_local.active:
+                return func(*args, **kwargs)
+            profile_local.active.add(stage)
+            release_id = release_arg(*args) if callable(release_arg) else args[release_arg]
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile_local.active.discard(stage)
+                if release_id in release_status:
+                    timing = release_profile(release_id)['stages'].setdefault(
+                        stage, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+                    timing['calls'] += 1
+                    timing['wall'] += time.perf_counter() - wall
+                    timing['cpu'] += time.process_time() - cpu
+        return wrapper
+    return decorator
+
+
+def reply_size(reply):
+    """
+    :param reply: QNetworkReply (or None if the response was not looked up)
+    :return: the Content-Length of the reply, or 0 if not known
+    """
+    if reply is None:
+        return 0
+    try:
+        return int(bytes(reply.rawHeader(b'Content-Length')) or 0)
+    except ValueError:
+        return 0
+
+
+def write_profile(release_id, summary):
+    """
+    Write the profile of a completed release (if log_info is set) and the session totals as JSON,
+    in the background (see LogWriter)
+    :param release_id:
+    :param summary: release profile, plus durations and lookups
+    :return:
+    """
+    session_profile['releases'] += 1
+    session_profile['recent'].append(
+        {key: summary[key] for key in ('release_id', 'name', 'duration', 'lookups')})
+    session_profile['lookups'] += summary['lookups']
+    for counter in ('cache_hits', 'bytes_received'):
+        session_profile[counter] += summary[counter]
+    for stage, timing in summary['stages'].items():
+        total = session_profile['stages'].setdefault(stage, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+        for key in total:
+            total[key] += timing[key]
+    profile = dict(session_profile, recent=list(session_profile['recent']))
+    log_writer.replace('session.profile.json', json.dumps(profile, indent=1))
+    if config.setting['log_info']:
+        log_writer.replace(release_id + '.profile.json', json.dumps(summary, indent=1))
+
+
 def close_log(release_id, caller):
     # close the custom log file if we are done
     if release_id == 'session':   # shouldn't happen but, just in case, don't close the session log
@@ -277,6 +452,13 @@ def close_log(release_id, caller):
     if release_id in release_status:
         duration = datetime.now() - release_status[release_id]['start']
         lookups = release_status[release_id]['lookups']
+        summary = dict(release_profile(release_id))
+        del release_status[release_id]['profile']
+        summary.update({
+            'release_id': release_id,
+            'name': release_status[release_id].get('name', ''),
+            'duration': duration.total_seconds(),
+            'lookups': lookups})
         done_lookups = release_status[release_id]['done-lookups']
         lookup_time = done_lookups - release_status[release_id]['start']
         album_process_time = duration - lookup_time
@@ -289,6 +471,12 @@ def close_log(release_id, caller):
         del release_status[release_id]['done-lookups']
         del release_status[release_id]['artists-done']
         del release_status[release_id]['works-done']
+        summary.update({
+            'lookup_time': lookup_time.total_seconds(),
+            'album_process_time': album_process_time.total_seconds(),
+            'artists_time': artists_time.total_seconds(),
+            'works_time': works_time.total_seconds()})
+        write_profile(release_id, summary)
     if release_id in log_files:
         write_log(
             release_id,
@@ -297,8 +485,8 @@ def close_log(release_id, caller):
             duration,
             lookups)
         write_log(release_id, 'info', 'Closing log file for %s', release_id)
-        log_files[release_id].close()
-        del log_files[release_id]
+        log_writer.close(release_id)
+        log_files.discard(release_id)
     if 'session' in log_files and release_id in release_status:
         write_log(
             'session',
@@ -343,6 +531,15 @@ def close_log(release_id, caller):
             lookup_time,
             album_process_time,
             lookups)
+        for stage, timing in summary['stages'].items():
+            write_log(
+                'session',
+                'basic',
+                'Stage %s: calls = %s, wall time = %.3fs, CPU time = %.3fs.',
+                stage,
+                timing['calls'],
+                timing['wall'],
+                timing['cpu'])
     if release_id in release_status:
         del release_status[release_id]
 
@@ -390,6 +587,77 @@ def get_preferred_artist_language(config):
         return ''
 
 
+class Selector():
+    """
+    A match path for parse_data(), split into its steps once so that the many
+    calls with the same path need not re-split the match specs.
+    Each step is a (key, test selector, test value) tuple - the test selector
+    is None unless the step is a value comparison "child.path:value"
+    """
+
+    def __init__(self, match):
+        self.steps = tuple(self.compile_step(item) for item in match)
+
+    @staticmethod
+    def compile_step(item):
+        if ':' in item:
+            test = item.split(':')
+            return item, get_selector(*test[0].split('.')), test[1]
+        return item, None, None
+
+    def select(self, obj, response_list, index=0):
+        """
+        Append all objects matching the steps from index onwards to response_list
+        :param obj: an XmlNode or JSON object, list or dictionary containing nodes
+        :param response_list: list to append the matches to
+        :param index: first step to match
+        :return: response_list
+        """
+        last = len(self.steps) - 1
+        while True:
+            # XmlNode instances are not iterable, so need to convert to dict
+            if isinstance(obj, XmlNode):
+                obj = obj.__dict__
+            if isinstance(obj, list):
+                for item in obj:
+                    self.select(item, response_list, index)
+                return response_list
+            if not isinstance(obj, dict):
+                return response_list
+            key, test, value = self.steps[index]
+            if key in obj:
+                if index == last:
+                    if obj[key] is not None:  # To prevent adding NoneTypes to list
+                        response_list.append(obj[key])
+                    return response_list
+                obj = obj[key]
+                index += 1
+            elif test is not None:
+                test_data = test.select(obj, [])
+                # latter is because Booleans are stored as such, not as
+                # strings, in JSON
+                if not (value in test_data or (value == 'True') in test_data):
+                    return response_list
+                if index == last:
+                    response_list.append(obj)
+                    return response_list
+                index += 1
+            elif 'children' in obj:
+                obj = obj['children']
+            else:
+                return response_list
+
+
+@lru_cache(maxsize=SELECTOR_CACHE_SIZE)
+def get_selector(*match):
+    """
+    Bounded, as paths comparing values (e.g. 'work.id:' + workId) differ for each work
+    :param match: list of items to search for in node (see parse_data)
+    :return: the (shared) Selector for match
+    """
+    return Selector(match)
+
+
 def parse_data(release_id, obj, response_list, *match):
     """
     This function takes any XmlNode object, or list thereof, or a JSON object
@@ -399,7 +667,7 @@ def parse_data(release_id, obj, response_list, *match):
     :param release_id: name for log file - usually =musicbrainz_albumid
         unless called outside metadata processor
     :param obj: an XmlNode or JSON object, list or dictionary containing nodes
-    :param response_list: working memory for recursive calls
+    :param response_list: list to which matches are appended
     :param match: list of items to search for in node (see detailed notes below)
     :return: a list of matching items (always a list, even if only one item)
 
@@ -410,120 +678,15 @@ def parse_data(release_id, obj, response_list, *match):
       (Note: childname can be a dot-list if the text is more than one level down - e.g. child1.child2
       # TODO - Check this works fully )
     """
-    if '!log' in response_list:
-        DEBUG = True
-        INFO = True
-    else:
-        DEBUG = False
-        INFO = False
     # Normally logging options are off as these can be VERY wordy
     # They can be turned on by using !log in the call
-
-    # XmlNode instances are not iterable, so need to convert to dict
-    if isinstance(obj, XmlNode):
-        obj = obj.__dict__
-    if DEBUG or INFO:
+    if '!log' in response_list:
         write_log(release_id, 'debug', 'Parsing data - looking for %s', match)
-    if INFO:
         write_log(release_id, 'info', 'Looking in object: %s', obj)
-    if isinstance(obj, list):
-        objlen = len(obj)
-        for i, item in enumerate(obj):
-            if isinstance(item, XmlNode):
-                item = item.__dict__
-            if INFO:
-                write_log(
-                    release_id,
-                    'info',
-                    'Getting response for list item no.%s of %s - object is: %s',
-                    i + 1,
-                    objlen,
-                    item)
-            parse_data(release_id, item, response_list, *match)
-            if INFO:
-                write_log(
-                    release_id,
-                    'info',
-                    'response_list for list item no.%s of %s is %s',
-                    i + 1,
-                    objlen,
-                    response_list)
-        return response_list
-    elif isinstance(obj, dict):
-        if match[0] in obj:
-            if len(match) == 1:
-                response = obj[match[0]]
-                if response is not None:  # To prevent adding NoneTypes to list
-                    response_list.append(response)
-                if INFO:
-                    write_log(
-                        release_id,
-                        'info',
-                        'response_list (last match item): %s',
-                        response_list)
-            else:
-                match_list = list(match)
-                match_list.pop(0)
-                parse_data(release_id, obj[match[0]],
-                           response_list, *match_list)
-                if INFO:
-                    write_log(
-                        release_id,
-                        'info',
-                        'response_list (passing up): %s',
-                        response_list)
-            return response_list
-        elif ':' in match[0]:
-            test = match[0].split(':')
-            match2 = test[0].split('.')
-            test_data = parse_data(release_id, obj, [], *match2)
-            if INFO:
-                write_log(
-                    release_id,
-                    'info',
-                    'Value comparison - looking in %s for value %s',
-                    test_data,
-                    test[1])
-            if len(test) > 1:
-                # latter is because Booleans are stored as such, not as
-                # strings, in JSON
-                if (test[1] in test_data) or (
-                        (test[1] == 'True') in test_data):
-                    if len(match) == 1:
-                        response = obj
-                        if response is not None:
-                            response_list.append(response)
-                    else:
-                        match_list = list(match)
-                        match_list.pop(0)
-                        parse_data(release_id, obj, response_list, *match_list)
-            else:
-                parse_data(release_id, obj, response_list, *match2)
-            if INFO:
-                write_log(
-                    release_id,
-                    'info',
-                    'response_list (from value look-up): %s',
-                    response_list)
-            return response_list
-        else:
-            if 'children' in obj:
-                parse_data(release_id, obj['children'], response_list, *match)
-            if INFO:
-                write_log(
-                    release_id,
-                    'info',
-                    'response_list (from children): %s',
-                    response_list)
-            return response_list
-    else:
-        if INFO:
-            write_log(
-                release_id,
-                'info',
-                'response_list (obj is not a list or dict): %s',
-                response_list)
+        get_selector(*match).select(obj, response_list)
+        write_log(release_id, 'info', 'response_list: %s', response_list)
         return response_list
+    return get_selector(*match).select(obj, response_list)
 
 
 def create_dict_from_ref_list(options, release_id, ref_list, keys, tags):
@@ -544,6 +707,8 @@ def create_dict_from_ref_list(options, release_id, ref_list, keys, tags):
 def get_references_from_file(release_id, path, filename):
     """
     Lookup Muso Reference.xml or similar
+    The parsed references are kept in a JSON file in the Classical_Extras user directory,
+    so that the reference file is only parsed again after it has changed
     :param release_id: name of log file
     :param path: Reference file path
     :param filename: Reference file name
@@ -554,8 +719,20 @@ def get_references_from_file(release_id, path, filename):
     period_dict_list = []
     genre_dict_list = []
     xml_file = None
+    ref_path = os.path.join(path, filename)
+    cache_path = os.path.join(USER_DIR, "Classical_Extras", "references.json")
+    try:
+        ref_stat = os.stat(ref_path)
+        identity = [REFERENCE_CACHE_VERSION, os.path.abspath(ref_path), ref_stat.st_mtime_ns, ref_stat.st_size]
+        with open(cache_path, encoding="utf8") as cache_file:
+            cached = json.load(cache_file)
+        if cached.get('identity') == identity:
+            write_log(release_id, 'info', 'Using references parsed from %s', ref_path)
+            return cached['references']
+    except (OSError, ValueError, AttributeError):
+        pass
     try:
-        xml_file = open(os.path.join(path, filename), encoding="utf8")
+        xml_file = open(ref_path, encoding="utf8")
         reply = xml_file.read()
         xml_file.close()
         document = _read_xml(QXmlStreamReader(reply))
@@ -588,6 +765,18 @@ def get_references_from_file(release_id, path, filename):
         tags = ['Name']
         genre_dict_list = create_dict_from_ref_list(
             options, release_id, genre_list, keys, tags)
+        references = {
+            'composers': composer_dict_list,
+            'periods': period_dict_list,
+            'genres': genre_dict_list}
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + '.tmp', 'w', encoding="utf8") as cache_file:
+                json.dump({'identity': identity, 'references': references}, cache_file)
+            os.replace(cache_path + '.tmp', cache_path)
+        except OSError:
+            write_log(release_id, 'warning', 'Unable to save parsed references to %s', cache_path)
+        return references
 
     except (IOError, FileNotFoundError, UnicodeDecodeError):
         if options['cwp_muso_genres'] or options['cwp_muso_classical'] or options['cwp_muso_dates'] or options['cwp_muso_periods']:
@@ -595,9 +784,7 @@ def get_references_from_file(release_id, path, filename):
                 release_id,
                 'error',
                 'File %s does not exist or is corrupted',
-                os.path.join(
-                    path,
-                    filename))
+                ref_path)
     finally:
         if xml_file:
             xml_file.close()
@@ -606,6 +793,84 @@ def get_references_from_file(release_id, path, filename):
             'periods': period_dict_list,
             'genres': genre_dict_list}
 
+
+def get_periods(period_list):
+    """
+    Convert Muso periods to {name: (start, end)}, as for the period map option
+    :param period_list: list of period dicts from the reference file
+    :return:
+    """
+    periods = {}
+    for p_item in period_list:
+        start = list_to_str(p_item.get('start') or [u'-9999'])
+        end = list_to_str(p_item.get('end') or [u'2525'])
+        period = list_to_str(p_item.get('name') or ['NOT SPECIFIED']).strip()
+        if start.lstrip('-').isdigit() and end.lstrip('-').isdigit():
+            periods[period] = (int(start), int(end))
+        else:
+            periods[period] = (
+                9999,
+                'ERROR - start and/or end of ' +
+                period +
+                ' are not integers')
+    return periods
+
+
+class PeriodIndex():
+    """
+    Periods sorted by start year, to look up the periods containing a year
+    """
+
+    def __init__(self, periods):
+        """
+        :param periods: {name: (start, end)}, where end is an error message if the period is invalid
+        """
+        self.errors = [end for start, end in periods.values() if isinstance(end, str)]
+        self.periods = sorted((start, end, period) for period, (start, end) in periods.items()
+                              if not isinstance(end, str))
+        self.starts = [start for start, end, period in self.periods]
+
+    def find(self, *years):
+        """
+        :param years:
+        :return: names of the periods containing any of years, in order of start year
+        """
+        found = set()
+        for year in years:
+            for i in range(bisect.bisect_right(self.starts, year)):
+                if year <= self.periods[i][1]:
+                    found.add(i)
+        return [self.periods[i][2] for i in sorted(found)]
+
+
+@lru_cache(maxsize=8)
+def get_period_map_index(period_map):
+    """
+    :param period_map: the period map option - "name, start, end; ..."
+    :return: PeriodIndex of the period map
+    """
+    periods = {}
+    for p in [p.strip() for p in period_map.split(';')]:
+        p = p.split(',')
+        if len(p) == 3:
+            period = p[0].strip()
+            start = p[1].strip()
+            end = p[2].strip()
+            if start.lstrip(
+                    '-').isdigit() and end.lstrip('-').isdigit():
+                periods[period] = (int(start), int(end))
+            else:
+                periods[period] = (
+                    9999,
+                    'ERROR - start and/or end of ' +
+                    period +
+                    ' are not integers')
+        else:
+            periods[p[0]] = (
+                9999, 'ERROR in period map - each item must contain 3 elements')
+    return PeriodIndex(periods)
+
+
 # OPTIONS
 
 
@@ -616,6 +881,7 @@ def get_preserved_tags():
     return preserved
 
 
+@profile_stage('get_options', 0)
 def get_options(release_id, album, track):
     """
     Get the saved options from a release and use them according to flags set on the "advanced" tab
@@ -1176,6 +1442,7 @@ def get_artists(options, release_id, tm, relations, relation_type):
     return artist_dict
 
 
+@profile_stage('create_artist_data', 0)
 def create_artist_data(release_id, options, log_options, tm, relations,
                        relation_type, artist_type, artists, instruments):
     """
@@ -1738,6 +2005,224 @@ def replace_roman_numerals(s):
     return s
 
 
+@lru_cache(maxsize=1)
+def combining_marks():
+    """Translation table removing all combining marks (e.g. accents separated by NFD normalisation)"""
+    return dict.fromkeys(
+        cp for cp in range(sys.maxunicode + 1) if unicodedata.category(chr(cp)) == 'Mn')
+
+
+@lru_cache(maxsize=BOIL_CACHE_SIZE)
+def boil_string(s):
+    """
+    Remove punctuation, spaces, capitals and accents for string comparisons
+    (the same strings are boiled for every track, so results are remembered)
+    :param s:
+    :return:
+    """
+    s = replace_roman_numerals(s.lower())
+    for spelling, replacement in BOIL_SPELLINGS:
+        s = s.replace(spelling, replacement)
+    s = s.translate(BOIL_SYMBOLS)
+    s = unicodedata.normalize('NFD', s).translate(combining_marks())
+    return RE_BOIL_PUNC.sub('', s).strip().lower().rstrip("s'")
+
+
+@lru_cache(maxsize=32)
+def parse_text_tuples(text_type, text):
+    """
+    Parse a synonyms or replacements option (see PartLevels.get_text_tuples) - options are the same
+    for most tracks, so the parsed tuples are shared
+    :param text_type: 'replacements' or 'synonyms'
+    :param text: option string, e.g. "(1, one) / (2, two)"
+    :return: tuple of tuples, and a tuple of (problem, entry) for entries omitted, where problem is
+    'blank', 'duplicate' or 'format'
+    """
+    synonyms = []
+    problems = []
+    for syn in re.split(r'(?<!\\)/', text):
+        tup_match = re.search(r'\((.*)\)', syn)
+        if tup_match:
+            # to ignore escaped commas
+            tup = re.split(r'(?<!\\),', tup_match.group(1))
+        else:
+            tup = ''
+        if len(tup) >= 2:
+            for i, ts in enumerate(tup):
+                tup[i] = ts.strip("' ").strip('"')
+                if len(
+                        tup[i]) > 4 and tup[i][0] == "!" and tup[i][1] == "!" and tup[i][-1] == "!" and tup[i][-2] == "!":
+                    # we have a reg ex inside - this deals with legacy
+                    # replacement text where enclosure in double-shouts was
+                    # required
+                    tup[i] = tup[i][2:-2]
+                if (i < len(tup) - 1 or text_type ==
+                        'synonyms') and not tup[i]:
+                    problems.append(('blank', syn))
+                    tup[i] = "**BAD**"
+                elif [tup for t in synonyms if tup[i] in t]:
+                    problems.append(('duplicate', syn))
+                    tup[i] = "**BAD**"
+            if "**BAD**" not in tup:
+                synonyms.append(tuple(tup))
+        else:
+            problems.append(('format', syn))
+    return tuple(synonyms), tuple(problems)
+
+
+class SynonymTable():
+    """
+    Regular expressions derived from a tuple of synonym tuples (the last in each tuple being the
+    canonical form), compiled once and shared by all tracks with the same synonyms option
+    """
+
+    def __init__(self, tuples):
+        self.tuples = tuples
+        self.found = {}
+        self.regexes = {}
+        self.separate = {}
+        # regexes of the tuples which cannot be part of the alternation - {index: [regex for each synonym]}
+        combined = []
+        for index, syn_tup in enumerate(tuples):
+            pattern = '|'.join('(?:' + syn + ')' for syn in syn_tup)
+            try:
+                groups = re.compile(pattern).groups
+            except re.error:
+                groups = None
+            if groups == 0:
+                combined.append('(?P<s' + str(index) + '>' + pattern + ')')
+                continue
+            # groups in user regexes would be renumbered or clash by name in the alternation,
+            # breaking backreferences, so each synonym of the tuple is matched on its own
+            self.separate[index] = []
+            for syn in syn_tup:
+                try:
+                    self.separate[index].append(re.compile(r'(?:^|\W)' + syn + r'(?:$|\W)', re.IGNORECASE))
+                except re.error as err:
+                    write_log('session', 'error', 'Invalid regular expression in synonym %s: %s', syn, err)
+        if combined:
+            # a single alternation, with a named group for each tuple
+            self.regex = re.compile(
+                r'(?:^|(?<=\W))(?:' + '|'.join(combined) + r')(?=$|\W)', re.IGNORECASE)
+        else:
+            self.regex = None
+
+    def canonize(self, s):
+        """
+        Replace synonyms in s by their canonical form (see PartLevels.canonize_synonyms)
+        :param s: A string
+        :return:
+        """
+        if not self.regex and not self.separate:
+            return s
+        first_matches = {}
+        if self.regex:
+            for match in self.regex.finditer(s):
+                syn_ind = int(match.lastgroup[1:])
+                if syn_ind not in first_matches:
+                    start, end = match.span()
+                    # including any adjacent non-word characters, as matched by the boundaries
+                    first_matches[syn_ind] = s[max(start - 1, 0):end + 1].strip()
+        for syn_ind, regexes in self.separate.items():
+            # the leftmost match, and the first synonym matching there, as for an alternation
+            matches = [match for match in (regex.search(s) for regex in regexes) if match]
+            if matches:
+                first_matches[syn_ind] = min(matches, key=lambda match: match.start()).group().strip()
+        s_canon = s
+        for syn_ind in sorted(first_matches):
+            s_canon = s_canon.replace(first_matches[syn_ind], self.tuples[syn_ind][-1])
+        return s_canon
+
+    def find(self, reg_item):
+        """
+        Extend regex item to include synonyms (see PartLevels.find_synonyms)
+        :param reg_item: A regex portion
+        :return: reg_new: A replacement for reg_item that includes all its synonyms
+         (if reg_item matches the last in a synonym tuple), and a list of all the synonyms
+        """
+        if reg_item not in self.found:
+            syn_others = []
+            syn_all = []
+            regex = re.compile(r'^\s*' + reg_item + r'\s*$', re.IGNORECASE)
+            for syn_tup in self.tuples:
+                # to get the last synonym in the tuple - the canonical form
+                if regex.match(syn_tup[-1]):
+                    syn_others += syn_tup[:-1]
+                    syn_all += syn_tup
+            if syn_others:
+                reg_new = '(?:' + ')|(?:'.join(syn_others) + ')|(?:' + reg_item + ')'
+            else:
+                reg_new = reg_item
+            self.found[reg_item] = reg_new, syn_all
+        return self.found[reg_item]
+
+    def listify_regexes(self, split_hyphenated):
+        """
+        Regular expressions for PartLevels.listify
+        :param split_hyphenated: option to treat hyphenated words as separate words
+        :return: regex_1 (matching opus numbers and keys), regex_2 (matching synonyms and remaining words)
+         and, for the groups in regex_1 which may contain synonyms, the compiled synonyms
+        """
+        if split_hyphenated not in self.regexes:
+            # just list anything that is a synonym (with word boundary markers)
+            syn_pattern = '|'.join(
+                [r'(?:^|\W|\b)' + x + r'(?:$|\W)' for y in self.tuples for x in y])
+            op_groups, op_all = self.find(OPUS_REGEX_ITEM)
+            notes_groups, notes_all = self.find(r'[ABCDEFG]')
+            sharp_groups, sharp_all = self.find(r'sharp')
+            flat_groups, flat_all = self.find(r'flat')
+            major_groups, major_all = self.find(r'major')
+            minor_groups, minor_all = self.find(r'minor')
+            opus_pattern = r"(?:\b((?:(" + op_groups + \
+                r"))\W?\s?\d+\-?\u2013?\u2014?\d*\w*)\b)"
+            note_pattern = r"(\b" + notes_groups + r")"
+            accent_pattern = r"(?:\-(" + sharp_groups + r")(?:\s+|\b)|\-(" + flat_groups + r")(?:\s+|\b)|\s(" + \
+                sharp_groups + r")(?:\s+|\b)|\s(" + flat_groups + \
+                r")(?:\s+|\b)|\u266F(?:\s+|\b)|\u266D(?:\s+|\b)|(?:[:,.]?\s+|$|\-))"
+            scale_pattern = r"(?:((" + major_groups + \
+                r")|(" + minor_groups + r"))?\b)"
+            key_pattern = note_pattern + accent_pattern + scale_pattern
+            regex_1 = re.compile(opus_pattern + r"|(" + key_pattern + r")", re.UNICODE | re.IGNORECASE)
+            if split_hyphenated:
+                regex_2 = r"(" + syn_pattern + r")|" + HYPHEN_SPLIT_PATTERN
+            else:
+                regex_2 = r"(" + syn_pattern + r")|" + HYPHEN_EMBED_PATTERN
+            all_synonyms_lists = [
+                op_all,
+                notes_all,
+                sharp_all,
+                flat_all,
+                sharp_all,
+                flat_all,
+                major_all,
+                minor_all]
+            self.regexes[split_hyphenated] = (
+                regex_1,
+                re.compile(regex_2, re.UNICODE | re.IGNORECASE),
+                [[re.compile(pattern, re.IGNORECASE) for pattern in synonyms_list]
+                 for synonyms_list in all_synonyms_lists])
+        return self.regexes[split_hyphenated]
+
+
+@lru_cache(maxsize=8)
+def get_synonym_table(tuples):
+    """
+    :param tuples: tuple of synonym tuples (see parse_text_tuples)
+    :return: the (shared) SynonymTable for tuples
+    """
+    return SynonymTable(tuples)
+
+
+@lru_cache(maxsize=8)
+def compile_replacements(tuples):
+    """
+    :param tuples: tuple of replacement tuples (see parse_text_tuples)
+    :return: tuple of (compiled regex, replacement), to be applied in sequence
+    """
+    return tuple((re.compile(tup[ind], re.IGNORECASE), tup[-1])
+                 for tup in tuples for ind in range(0, len(tup) - 1))
+
+
 def from_roman(s):
     romanNumeralMap = (('M', 1000),
                        ('CM', 900),
@@ -1792,32 +2277,29 @@ def turbo_lcs(release_id, multi_list):
             return multi_list[0]  # Nothing to do!
         else:
             return []
-    # for big matches, use the generalised suffix tree method
-    if ((list_sum / list_len) ** 2) * list_len > 1000:
-        # heuristic: may need to tweak the 1000 in the light of results
+    # for big matches, use the suffix automaton method
+    if ((list_sum / list_len) ** 2) * list_len > LCS_SUFFIX_THRESHOLD:
         lcs_dict = suffixtree.multi_lcs(multi_list)
-        # NB suffixtree may be shown as an unresolved reference in the IDE,
-        # but it should work provided it is included in the package
         if "error" not in lcs_dict:
             if "response" in lcs_dict:
                 write_log(
                         release_id,
                         'info',
-                        'Longest common string was returned from suffix tree algo')
+                        'Longest common string was returned from suffix automaton algo')
                 return lcs_dict['response']
 
-     ## If suffix tree fails, write errors to log before proceeding with alternative
+     ## If suffix automaton fails, write errors to log before proceeding with alternative
             else:
                 write_log(
                         release_id,
                         'error',
-                        'Suffix tree failure for release %s. Error unknown. Using standard lcs algo instead',
+                        'Suffix automaton failure for release %s. Error unknown. Using standard lcs algo instead',
                         release_id)
         else:
             write_log(
                     release_id,
                     'error',
-                    'Suffix tree failure for release %s. Error message: %s. Using standard lcs algo instead',
+                    'Suffix automaton failure for release %s. Error message: %s. Using standard lcs algo instead',
                     release_id,
                     lcs_dict['error'])
     # otherwise, or if gst fails, use the standard algorithm
@@ -1837,7 +2319,7 @@ def turbo_lcs(release_id, multi_list):
 
 def longest_common_substring(s1, s2):
     """
-    Standard lcs algo for short strings, or if suffix tree does not work
+    Standard lcs algo for short strings, or if suffix automaton does not work
     :param s1: substring 1
     :param s2: substring 2
     :return: {'string': the longest common substring,
@@ -1845,17 +2327,19 @@ def longest_common_substring(s1, s2):
         'length': the length of the common substring}
     NB this also works on list arguments - i.e. it will find the longest common sub-list
     """
-    m = [[0] * (1 + len(s2)) for i in range(1 + len(s1))]
+    # only the previous row of the DP matrix is needed
+    previous = [0] * (1 + len(s2))
     longest, x_longest = 0, 0
     for x in range(1, 1 + len(s1)):
+        current = [0] * (1 + len(s2))
+        item = s1[x - 1]
         for y in range(1, 1 + len(s2)):
-            if s1[x - 1] == s2[y - 1]:
-                m[x][y] = m[x - 1][y - 1] + 1
-                if m[x][y] > longest:
-                    longest = m[x][y]
+            if item == s2[y - 1]:
+                current[y] = previous[y - 1] + 1
+                if current[y] > longest:
+                    longest = current[y]
                     x_longest = x
-            else:
-                m[x][y] = 0
+        previous = current
     return {'string': s1[x_longest - longest: x_longest],
             'start': x_longest - longest, 'length': longest}
 
@@ -1908,6 +2392,7 @@ def get_ui_tags():
     return ui_tags
 
 
+@profile_stage('map_tags', 1)
 def map_tags(options, release_id, album, tm):
     """
     Do the common tag processing - including for the genres and tag-mapping sections
@@ -1996,23 +2481,22 @@ def map_tags(options, release_id, album, tm):
                           composer_list)
             lc_composer_list = [c.lower() for c in composer_list]
             for ind, composer in enumerate(lc_composer_list):
-                for classical_composer in COMPOSER_DICT:
-                    if composer in classical_composer['lc_name']:
-                        if options['cwp_muso_classical']:
-                            candidate_genres.append('Classical')
-                            is_classical = True
-                        if options['cwp_muso_dates']:
-                            composer_born_list = classical_composer['birth']
-                            composer_died_list = classical_composer['death']
-                        composer_found = True
-                        if no_composer_in_metadata:
-                            composersort = composersort_list[ind]
-                            append_tag(release_id, tm, 'composer', composer_list[ind])
-                            append_tag(release_id, tm, '~cwp_composer_names', composer_list[ind])
-                            append_tag(release_id, tm, 'composersort', composersort)
-                            append_tag(release_id, tm, '~cwp_composers_sort', composersort)
-                            append_tag(release_id, tm, '~cwp_composer_lastnames', composersort.split(', ')[0])
-                        break
+                classical_composer = COMPOSER_INDEX.get(composer)
+                if classical_composer:
+                    if options['cwp_muso_classical']:
+                        candidate_genres.append('Classical')
+                        is_classical = True
+                    if options['cwp_muso_dates']:
+                        composer_born_list = classical_composer['birth']
+                        composer_died_list = classical_composer['death']
+                    composer_found = True
+                    if no_composer_in_metadata:
+                        composersort = composersort_list[ind]
+                        append_tag(release_id, tm, 'composer', composer_list[ind])
+                        append_tag(release_id, tm, '~cwp_composer_names', composer_list[ind])
+                        append_tag(release_id, tm, 'composersort', composersort)
+                        append_tag(release_id, tm, '~cwp_composers_sort', composersort)
+                        append_tag(release_id, tm, '~cwp_composer_lastnames', composersort.split(', ')[0])
                 if not composer_found:
                     composer_index = lc_composer_list.index(composer)
                     orig_composer = composer_list[composer_index]
@@ -2037,16 +2521,15 @@ def map_tags(options, release_id, album, tm):
                     tm['~cea_arranger_names']) + str_to_list(tm['~cwp_arranger_names'])
                 lc_arranger_list = [c.lower() for c in arranger_list]
                 for arranger in lc_arranger_list:
-                    for classical_arranger in COMPOSER_DICT:
-                        if arranger in classical_arranger['lc_name']:
-                            if options['cwp_muso_classical'] and options['cwp_genres_arranger_as_composer']:
-                                candidate_genres.append('Classical')
-                                is_classical = True
-                            if options['cwp_muso_dates'] and options['cwp_periods_arranger_as_composer']:
-                                arranger_born_list = classical_arranger['birth']
-                                arranger_died_list = classical_arranger['death']
-                            arranger_found = True
-                            break
+                    classical_arranger = COMPOSER_INDEX.get(arranger)
+                    if classical_arranger:
+                        if options['cwp_muso_classical'] and options['cwp_genres_arranger_as_composer']:
+                            candidate_genres.append('Classical')
+                            is_classical = True
+                        if options['cwp_muso_dates'] and options['cwp_periods_arranger_as_composer']:
+                            arranger_born_list = classical_arranger['birth']
+                            arranger_died_list = classical_arranger['death']
+                        arranger_found = True
                     if not arranger_found:
                         arranger_index = lc_arranger_list.index(arranger)
                         orig_arranger = arranger_list[arranger_index]
@@ -2073,8 +2556,7 @@ def map_tags(options, release_id, album, tm):
                 '8. No composer reference file. Check log for error messages re path name.')
 
     if options['cwp_use_muso_refdb'] and options['cwp_muso_genres'] and GENRE_DICT:
-        main_classical_genres_list = [list_to_str(
-            mg['name']).strip() for mg in GENRE_DICT]
+        main_classical_genres_list = MUSO_GENRES[:]
     else:
         main_classical_genres_list = [
             sg.strip() for sg in options['cwp_genres_classical_main'].split(',')]
@@ -2251,53 +2733,13 @@ def map_tags(options, release_id, album, tm):
                 prem)
 
     # periods
-    PERIODS = {}
+    periods = None
     if options['cwp_period_map']:
         if options['cwp_use_muso_refdb'] and options['cwp_muso_periods'] and PERIOD_DICT:
-            for p_item in PERIOD_DICT:
-                if 'start' not in p_item or p_item['start'] == []:
-                    p_item['start'] = [u'-9999']
-                if 'end' not in p_item or p_item['end'] == []:
-                    p_item['end'] = [u'2525']
-                if 'name' not in p_item or p_item['name'] == []:
-                    p_item['name'] = ['NOT SPECIFIED']
-            PERIODS = {list_to_str(mp['name']).strip(): (
-                list_to_str(mp['start']),
-                list_to_str(mp['end']))
-                for mp in PERIOD_DICT}
-            for period in PERIODS:
-                if PERIODS[period][0].lstrip(
-                        '-').isdigit() and PERIODS[period][1].lstrip('-').isdigit():
-                    PERIODS[period] = (int(PERIODS[period][0]),
-                                       int(PERIODS[period][1]))
-                else:
-                    PERIODS[period] = (
-                        9999,
-                        'ERROR - start and/or end of ' +
-                        period +
-                        ' are not integers')
-
+            periods = MUSO_PERIODS
         else:
-            periods = [p.strip() for p in options['cwp_period_map'].split(';')]
-            for p in periods:
-                p = p.split(',')
-                if len(p) == 3:
-                    period = p[0].strip()
-                    start = p[1].strip()
-                    end = p[2].strip()
-                    if start.lstrip(
-                            '-').isdigit() and end.lstrip('-').isdigit():
-                        PERIODS[period] = (int(start), int(end))
-                    else:
-                        PERIODS[period] = (
-                            9999,
-                            'ERROR - start and/or end of ' +
-                            period +
-                            ' are not integers')
-                else:
-                    PERIODS[p[0]] = (
-                        9999, 'ERROR in period map - each item must contain 3 elements')
-    if options['cwp_period_tag'] and PERIODS:
+            periods = get_period_map_index(options['cwp_period_map'])
+    if options['cwp_period_tag'] and periods and (periods.periods or periods.errors):
         if earliest_date == 9999:  # i.e. no work date found
             if options['cwp_use_muso_refdb'] and options['cwp_muso_dates']:
                 for composer_born in composer_born_list + arranger_born_list:
@@ -2311,35 +2753,26 @@ def map_tags(options, release_id, album, tm):
                                 latest_date = max(latest_date, deathdate)
                             else:
                                 latest_date = datetime.now().year
-        # sort into start date order before writing tags
-        sorted_periods = collections.OrderedDict(
-            sorted(PERIODS.items(), key=lambda t: t[1]))
-        for period in sorted_periods:
-            if isinstance(
-                    sorted_periods[period][1],
-                    str) and 'ERROR' in sorted_periods[period][1]:
-                tm[options['cwp_period_tag']] = ''
+        if periods.errors:
+            tm[options['cwp_period_tag']] = ''
+            append_tag(
+                release_id,
+                tm,
+                '001_errors:9',
+                '9. ' +
+                periods.errors[0])
+        else:
+            years = []
+            if earliest_date < 9999:
+                years.append(earliest_date)
+            if latest_date > -9999:
+                years.append(latest_date)
+            for period in periods.find(*years):
                 append_tag(
                     release_id,
                     tm,
-                    '001_errors:9',
-                    '9. ' +
-                    sorted_periods[period])
-                break
-            if earliest_date < 9999:
-                if sorted_periods[period][0] <= earliest_date <= sorted_periods[period][1]:
-                    append_tag(
-                        release_id,
-                        tm,
-                        options['cwp_period_tag'],
-                        period)
-            if latest_date > -9999:
-                if sorted_periods[period][0] <= latest_date <= sorted_periods[period][1]:
-                    append_tag(
-                        release_id,
-                        tm,
-                        options['cwp_period_tag'],
-                        period)
+                    options['cwp_period_tag'],
+                    period)
 
     # generic tag mapping
     sort_tags = options['cea_tag_sort']
@@ -2978,6 +3411,87 @@ def strip_excess_punctuation(s):
     return s
 
 
+###############
+###############
+# ALBUM STATE #
+###############
+###############
+
+
+class AlbumStateOwner():
+    """
+    Base for the classes holding per-album state in dictionaries (ALBUM_STATE lists their names).
+    Keys may be the album, a track of the album or a tuple containing either.
+    All the state of an album is released when the album is removed from Picard,
+    so that albums loaded during a long session do not stay in memory.
+    """
+
+    ALBUM_STATE = ()
+
+    def watch_album(self, album):
+        """
+        Register an album so that its state is released when it is removed
+        :param album:
+        :return:
+        """
+        if not hasattr(self, 'albums'):
+            self.albums = weakref.WeakSet()
+            # albums with state - weak, so as not to keep albums alive
+            album.tagger.album_removed.connect(self.remove_album)
+        self.albums.add(album)
+
+    @staticmethod
+    def is_album_key(key, album):
+        if isinstance(key, tuple):
+            return any(AlbumStateOwner.is_album_key(k, album) for k in key)
+        return key is album or getattr(key, 'album', None) is album
+
+    def album_keys(self, album):
+        """
+        :param album:
+        :return: {attribute name: list of keys belonging to album}
+        """
+        keys = {}
+        for name in self.ALBUM_STATE:
+            keys[name] = [key for key in getattr(self, name) if self.is_album_key(key, album)]
+        return keys
+
+    def album_state_size(self, album):
+        """
+        Debug report of the state held for an album
+        :param album:
+        :return: {attribute name: (number of entries, approximate size in bytes)}
+        """
+        report = {}
+        for name, keys in self.album_keys(album).items():
+            state = getattr(self, name)
+            size = 0
+            for key in keys:
+                size += sys.getsizeof(state[key])
+                if isinstance(state[key], (dict, list)):
+                    size += sum(sys.getsizeof(value) for value in state[key])
+            report[name] = (len(keys), size)
+        return report
+
+    def remove_album(self, album):
+        """
+        Release all state held for an album
+        :param album:
+        :return:
+        """
+        if album not in self.albums:
+            return
+        release_id = album.id
+        if config.setting['log_debug']:
+            write_log(release_id, 'debug', '%s state released for album: %s',
+                      type(self).__name__, self.album_state_size(album))
+        for name, keys in self.album_keys(album).items():
+            state = getattr(self, name)
+            for key in keys:
+                del state[key]
+        self.albums.discard(album)
+
+
 #################
 #################
 # EXTRA ARTISTS #
@@ -2985,7 +3499,10 @@ def strip_excess_punctuation(s):
 #################
 
 
-class ExtraArtists():
+class ExtraArtists(AlbumStateOwner):
+
+    ALBUM_STATE = ('album_artists', 'track_listing', 'options', 'globals', 'album_performers',
+                   'album_instruments', 'artist_credits', 'release_artists_sort', 'lyricist_filled')
 
     # CONSTANTS
     def __init__(self):
@@ -3054,6 +3571,7 @@ class ExtraArtists():
             release_status[release_id]['lookups'] = 0
         release_status[release_id]['name'] = track_metadata['album']
         release_status[release_id]['artists'] = True
+        self.watch_album(album)
         if config.setting['log_debug'] or config.setting['log_info']:
             write_log(
                 release_id,
@@ -4016,6 +4534,74 @@ class ExtraArtists():
                             self.append_tag(
                                 release_id, tm, '~cea_support_performers_sort', sort_name)
 
+##############
+##############
+# WORK STORE #
+##############
+##############
+
+
+class WorkStore():
+    """
+    Persistent store of MusicBrainz work records (names, aliases, tags and relations),
+    so that works seen in earlier sessions need not be looked up again.
+    Records are keyed on the lookup path and includes. They are refreshed after
+    WORK_STORE_MAX_AGE and the least recently used are removed above WORK_STORE_MAX_ENTRIES.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, isolation_level=None)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS works ('
+                'key TEXT PRIMARY KEY, response TEXT, fetched REAL, accessed REAL)')
+            self.db.execute(
+                'DELETE FROM works WHERE fetched < ? OR key IN '
+                '(SELECT key FROM works ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (time.time() - WORK_STORE_MAX_AGE, WORK_STORE_MAX_ENTRIES))
+        return self.db
+
+    def get(self, key):
+        """
+        Get a stored work record
+        :param key: lookup path and includes
+        :return: the JSON response of the lookup, or None if not stored or too old
+        """
+        try:
+            db = self.connect()
+            now = time.time()
+            row = db.execute(
+                'SELECT response FROM works WHERE key = ? AND fetched >= ?',
+                (key, now - WORK_STORE_MAX_AGE)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE works SET accessed = ? WHERE key = ?', (now, key))
+            return json.loads(row[0])
+        except (OSError, sqlite3.Error) as err:
+            log.warning('Classical Extras: Unable to read work store: %s', err)
+            return None
+
+    def set(self, key, response):
+        """
+        Store a work record
+        :param key: lookup path and includes
+        :param response: the JSON response of the lookup
+        :return:
+        """
+        try:
+            now = time.time()
+            self.connect().execute(
+                'INSERT OR REPLACE INTO works VALUES (?, ?, ?, ?)',
+                (key, json.dumps(response), now, now))
+        except (OSError, sqlite3.Error) as err:
+            log.warning('Classical Extras: Unable to write work store: %s', err)
+
+
 ##############
 ##############
 # WORK PARTS #
@@ -4023,7 +4609,12 @@ class ExtraArtists():
 ##############
 
 
-class PartLevels():
+class PartLevels(AlbumStateOwner):
+
+    ALBUM_STATE = ('partof', 'top_works', 'trackback', 'work_listing', 'top', 'options', 'synonyms',
+                   'replacements', 'file_works', 'album_artists', 'artist_credits', 'release_artists_sort',
+                   'lyricist_filled', 'orphan_tracks', 'tracks')
+
     # QUEUE-HANDLING
     class WorksQueue(LockableObject):
         """Object for managing the queue of lookups"""
@@ -4069,6 +4660,15 @@ class PartLevels():
             self.unlock()
             return value
 
+        def remove_album(self, album):
+            """Drop the (track, album) pairs of an album, and any ids left without pairs"""
+            self.lock_for_write()
+            for name in list(self.queue):
+                self.queue[name] = [value for value in self.queue[name] if value[1] is not album]
+                if not self.queue[name]:
+                    del self.queue[name]
+            self.unlock()
+
         # INITIALISATION
 
     def __init__(self):
@@ -4076,6 +4676,16 @@ class PartLevels():
         # maintains list of parent of each workid, or None if no parent found,
         # so that XML lookup need only executed if no existing record
 
+        self.work_store = WorkStore(os.path.join(USER_DIR, "Classical_Extras", "works.db"))
+        # persistent store of work lookups, shared between sessions
+
+        self.prefetching = {}
+        # work lookups issued ahead of need - {store key: [(workId, tries) waiting for the response]}
+
+        self.prefetched_works = {}
+        # prefetched work records not yet needed - {store key: (album which prefetched it, response)},
+        # dropped with the album as they are also in the work store
+
         self.partof = collections.defaultdict(dict)
         # the inverse of the above (immediate children of each parent)
         # but note that this is specific to the album as children may vary between albums
@@ -4156,6 +4766,23 @@ class PartLevels():
     # SECTION 1 - Initial track processing #
     ########################################
 
+    def remove_album(self, album):
+        """
+        Release all state held for an album, including its tracks waiting for work lookups,
+        so that lookups completing after the album has been removed are ignored,
+        and the work records it prefetched which are still unclaimed
+        :param album:
+        :return:
+        """
+        if album not in self.albums:
+            return
+        self.works_queue.remove_album(album)
+        for waiting in self.prefetching.values():
+            waiting[:] = [(workId, tries) for workId, tries in waiting if workId in self.works_queue]
+        for store_key in [key for key, (owner, response) in self.prefetched_works.items() if owner is album]:
+            del self.prefetched_works[store_key]
+        super().remove_album(album)
+
     def add_work_info(
             self,
             album,
@@ -4177,6 +4804,7 @@ class PartLevels():
             release_status[release_id]['lookups'] = 0
         release_status[release_id]['name'] = track_metadata['album']
         release_status[release_id]['works'] = True
+        self.watch_album(album)
         if config.setting['log_debug'] or config.setting['log_info']:
             write_log(
                 release_id,
@@ -4540,6 +5168,7 @@ class PartLevels():
                 if workId_tuple in self.works_cache:
                     del self.works_cache[workId_tuple]
             self.work_not_in_cache(release_id, album, track, workId_tuple)
+        self.prefetch_parent_works(release_id, album, trackXmlNode, not_in_cache)
 
 
     def get_sk_tags(self, release_id, album, track, tm, options):
@@ -4767,35 +5396,50 @@ class PartLevels():
                 workId,
                 (track,
                  album)):  # All work combos are queued, but only new workIds are passed to XML lookup
-            host = config.setting["server_host"]
-            port = config.setting["server_port"]
-            path = "/ws/2/%s/%s" % ('work', workId)
-            if config.setting['cwp_aliases'] and config.setting['cwp_aliases_tag_text']:
-                if config.setting['cwp_aliases_tags_user'] and user_data:
-                    login = True
-                    tag_type = '+tags +user-tags'
-                else:
-                    login = False
-                    tag_type = '+tags'
-            else:
-                login = False
-                tag_type = ''
-            queryargs = {
-                "inc": "work-rels+artist-rels+label-rels+place-rels+aliases" +
-                tag_type}
+            path, queryargs, login, store_key = self.work_query(workId, user_data)
             write_log(
                     release_id,
                     'debug',
                     "Initiating XML lookup for %s......",
                     workId)
+            if store_key in self.prefetched_works:
+                write_log(
+                        release_id,
+                        'debug',
+                        "Using prefetched work record for %s",
+                        workId)
+                count_profile(release_id, 'cache_hits')
+                thread.to_main(self.work_process, workId, tries, self.prefetched_works.pop(store_key)[1], None, None)
+                return
+            if store_key in self.prefetching:
+                write_log(
+                        release_id,
+                        'debug',
+                        "Waiting for prefetch of work record for %s",
+                        workId)
+                self.prefetching[store_key].append((workId, tries))
+                return
+            if config.setting['use_cache']:
+                response = self.work_store.get(store_key)
+                if response is not None:
+                    write_log(
+                            release_id,
+                            'debug',
+                            "Using stored work record for %s",
+                            workId)
+                    count_profile(release_id, 'cache_hits')
+                    # processed later from the event loop, as for a lookup
+                    thread.to_main(self.work_process, workId, tries, response, None, None)
+                    return
             if release_id in release_status and 'lookups' in release_status[release_id]:
                 release_status[release_id]['lookups'] += 1
             return album.tagger.webservice.get(
-                host,
-                port,
+                config.setting["server_host"],
+                config.setting["server_port"],
                 path,
                 partial(
-                    self.work_process,
+                    self.work_lookup_process,
+                    store_key,
                     workId,
                     tries),
                 # parse_response_type="xml",
@@ -4810,11 +5454,144 @@ class PartLevels():
                     "Work is already in queue: %s",
                     workId)
 
+    @staticmethod
+    def work_query(workId, user_data=True):
+        """
+        Path and arguments for looking up a work
+        :param workId:
+        :param user_data: include user tags (requires login)
+        :return: path, queryargs, login and the key of the work record in the work store
+        """
+        path = "/ws/2/%s/%s" % ('work', workId)
+        if config.setting['cwp_aliases'] and config.setting['cwp_aliases_tag_text']:
+            if config.setting['cwp_aliases_tags_user'] and user_data:
+                login = True
+                tag_type = '+tags +user-tags'
+            else:
+                login = False
+                tag_type = '+tags'
+        else:
+            login = False
+            tag_type = ''
+        queryargs = {
+            "inc": "work-rels+artist-rels+label-rels+place-rels+aliases" +
+            tag_type}
+        return path, queryargs, login, path + '?' + queryargs['inc']
+
+    def prefetch_parent_works(self, release_id, album, trackXmlNode, workId_tuples):
+        """
+        Look up the parents of works which are being looked up, without waiting for the works' own look-ups,
+        so that each level of the hierarchy does not wait for the level below.
+        The parents are known from the work-level relationships in the release data.
+        :param release_id:
+        :param album:
+        :param trackXmlNode: JSON returned by the webservice
+        :param workId_tuples: the work ids being looked up
+        :return:
+        """
+        for workId_tuple in workId_tuples:
+            for workId in workId_tuple:
+                parentIds = parse_data(
+                    release_id,
+                    trackXmlNode,
+                    [],
+                    'recording',
+                    'relations',
+                    'target-type:work',
+                    'work.id:' + workId,
+                    'work',
+                    'relations',
+                    'target-type:work',
+                    'type:parts',
+                    'direction:backward',
+                    'work',
+                    'id')
+                for parentId in parentIds:
+                    # no need if the parent's own parents are already known
+                    if self.USE_CACHE and (
+                            (parentId,) in self.works_cache or 'no_parent' in self.parts.get((parentId,), {})):
+                        continue
+                    self.prefetch_work(release_id, album, parentId)
+
+    def prefetch_work(self, release_id, album, workId):
+        """
+        Look up a work record ahead of it being needed - see work_add_track
+        :param release_id:
+        :param album:
+        :param workId:
+        :return:
+        """
+        path, queryargs, login, store_key = self.work_query(workId)
+        if workId in self.works_queue or store_key in self.prefetching or store_key in self.prefetched_works:
+            return
+        if config.setting['use_cache'] and self.work_store.get(store_key) is not None:
+            return
+        write_log(release_id, 'debug', "Prefetching work %s", workId)
+        if release_id in release_status and 'lookups' in release_status[release_id]:
+            release_status[release_id]['lookups'] += 1
+        self.prefetching[store_key] = []
+        album.tagger.webservice.get(
+            config.setting["server_host"],
+            config.setting["server_port"],
+            path,
+            partial(self.work_prefetched, release_id, album, store_key),
+            priority=True,
+            important=False,
+            mblogin=login,
+            queryargs=queryargs)
+
+    def work_prefetched(self, release_id, album, store_key, response, reply, error):
+        """
+        Keep a prefetched work record until it is needed, or process it if it is already needed
+        :param release_id: release which initiated the prefetch
+        :param album: album which initiated the prefetch
+        :param store_key: key for the work store
+        :param response:
+        :param reply:
+        :param error:
+        :return:
+        """
+        waiting = self.prefetching.pop(store_key, [])
+        count_profile(release_id, 'bytes_received', reply_size(reply))
+        if not error and isinstance(response, dict):
+            self.work_store.set(store_key, response)
+            if not waiting and album in self.albums:
+                self.prefetched_works[store_key] = (album, response)
+        for workId, tries in waiting:
+            self.work_process(workId, tries, response, reply, error)
+
     ##########################################################################
     # SECTION 2 - Works processing                                                                     #
     # NB These functions may operate asynchronously over multiple albums (as well as multiple tracks)  #
     ##########################################################################
 
+    def work_lookup_process(self, store_key, workId, tries, response, reply, error):
+        """
+        Store the response from the lookup before processing it
+        :param store_key: key for the work store
+        :param workId:
+        :param tries:
+        :param response:
+        :param reply:
+        :param error:
+        :return:
+        """
+        count_profile(self.work_release_id(workId), 'bytes_received', reply_size(reply))
+        if not error and isinstance(response, dict):
+            self.work_store.set(store_key, response)
+        self.work_process(workId, tries, response, reply, error)
+
+    def work_release_id(self, workId):
+        """
+        :param workId:
+        :return: the release of the first track waiting for the work, for profiling
+        """
+        tuples = self.works_queue[workId]
+        if tuples:
+            return tuples[0][0].metadata['musicbrainz_albumid']
+        return None
+
+    @profile_stage('work_process', lambda self, workId, *args: self.work_release_id(workId))
     def work_process(self, workId, tries, response, reply, error):
         """
         Top routine to process the XML/JSON node response from the lookup
@@ -4828,7 +5605,8 @@ class PartLevels():
         """
 
         if error:
-            tuples = self.works_queue.remove(workId)
+            tuples = self.works_queue.remove(workId) or []
+            # none left if the albums waiting for the work have been removed
             for track, album in tuples:
                 release_id = track.metadata['musicbrainz_albumid']
                 write_log(
@@ -5798,6 +6576,7 @@ class PartLevels():
         # SECTION 4 - Process tracks within album #
         ###########################################
 
+    @profile_stage('process_trackback', 1)
     def process_trackback(
             self,
             release_id,
@@ -6658,6 +7437,7 @@ class PartLevels():
     # SECTION 5 - Extend work metadata using titles #
     #################################################
 
+    @profile_stage('extend_metadata', 1)
     def extend_metadata(self, release_id, top_info, track, ref_height, depth):
         """
         Combine MB work and title data according to user options
@@ -7647,6 +8427,7 @@ class PartLevels():
         write_log(release_id, 'info', "Stripped work after punctuation removal: %s", stripped_work)
         return stripped_work, parent
 
+    @profile_stage('diff_pair', 1)
     def diff_pair(
             self,
             release_id,
@@ -7731,9 +8512,8 @@ class PartLevels():
         #  replacements
         replacements = self.replacements[track]
         write_log(release_id, 'info', "Replacement: %s", replacements)
-        for tup in replacements:
-            for ind in range(0, len(tup) - 1):
-                ti = re.sub(tup[ind], tup[-1], ti, flags=re.IGNORECASE)
+        for regex, replacement in compile_replacements(replacements):
+            ti = regex.sub(replacement, ti)
         write_log(
                 release_id,
                 'debug',
@@ -8120,20 +8900,13 @@ class PartLevels():
         write_log(release_id, 'debug', 'Canonizing: %s', s)
         # Canonize catalogue & opus numbers (e.g. turn K. 126 into K126 or K
         # 345a into K345a or op. 144 into op144):
-        regex = re.compile(
-            r'\b((?:op|no|k|kk|kv|L|B|Hob|S|D|M)|\w+WV)\W?\s?(\d+\-?\u2013?\u2014?\d*\w*)\b',
-            re.IGNORECASE)
-        regex_match = regex.search(s)
+        regex_match = RE_OPUS.search(s)
         s_canon = s
         if regex_match and len(regex_match.groups()) == 2:
             pt1 = regex_match.group(1) or ''
             pt2 = regex_match.group(2) or ''
             if regex_match.group(1) and regex_match.group(2):
-                pt1 = re.sub(
-                    r'^\W*no\b',
-                    '',
-                    regex_match.group(1),
-                    flags=re.IGNORECASE)
+                pt1 = RE_OPUS_NO.sub('', regex_match.group(1))
             s_canon = pt1 + pt2
         write_log(release_id, 'info', 'canonized item = %s', s_canon)
         return s_canon
@@ -8152,12 +8925,8 @@ class PartLevels():
         s_canon = s
         if match:
             if match.group(2):
-                k2 = re.sub(
-                    r'\-sharp|\u266F',
-                    'sharp',
-                    match.group(2),
-                    flags=re.IGNORECASE)
-                k2 = re.sub(r'\-flat|\u266D', 'flat', k2, flags=re.IGNORECASE)
+                k2 = RE_KEY_SHARP.sub('sharp', match.group(2))
+                k2 = RE_KEY_FLAT.sub('flat', k2)
                 k2 = k2.replace('-', '')
             else:
                 k2 = ''
@@ -8179,28 +8948,12 @@ class PartLevels():
         """
         make synonyms equal
         :param release_id:
-        :param tuples
+        :param tuples: tuple of synonym tuples
         :param s: A string
         :return:
         """
         write_log(release_id, 'debug', 'Canonizing: %s', s)
-        s_canon = s
-        syn_patterns = []
-        syn_subs = []
-        for syn_tup in tuples:
-            syn_pattern = r'((?:^|\W)' + \
-                r'(?:$|\W)|(?:^|\W)'.join(syn_tup) + r'(?:$|\W))'
-            syn_patterns.append(syn_pattern)
-            # to get the last synonym in the tuple - the canonical form
-            syn_sub = syn_tup[-1:][0]
-            syn_subs.append(syn_sub)
-        for syn_ind, pattern in enumerate(syn_patterns):
-            regex = re.compile(pattern, re.IGNORECASE)
-            regex_match = regex.search(s)
-            if regex_match:
-                test_reg = regex_match.group().strip()
-                s_canon = s_canon.replace(test_reg, syn_subs[syn_ind])
-
+        s_canon = get_synonym_table(tuples).canonize(s)
         write_log(release_id, 'info', 'canonized item = %s', s_canon)
         return s_canon
 
@@ -8214,18 +8967,7 @@ class PartLevels():
          (if reg_item matches the last in a synonym tuple)
         """
         write_log(release_id, 'debug', 'Finding synonyms of: %s', reg_item)
-        syn_others = []
-        syn_all = []
-        for syn_tup in self.synonyms[track]:
-            # to get the last synonym in the tuple - the canonical form
-            syn_last = syn_tup[-1:][0]
-            if re.match(r'^\s*' + reg_item + r'\s*$', syn_last, re.IGNORECASE):
-                syn_others += syn_tup[:-1]
-                syn_all += syn_tup
-        if syn_others:
-            reg_item = '(?:' + ')|(?:'.join(syn_others) + \
-                ')|(?:' + reg_item + ')'
-
+        reg_item, syn_all = get_synonym_table(self.synonyms[track]).find(reg_item)
         write_log(release_id, 'info', 'new regex item = %s', reg_item)
         return reg_item, syn_all
 
@@ -8240,60 +8982,17 @@ class PartLevels():
                  s_test_tuple: a tuple of the matched and canonized words and phrases (i.e. a tuple of strings, not objects)
         """
         tuples = self.synonyms[track]
-        # just list anything that is a synonym (with word boundary markers)
-        syn_pattern = '|'.join(
-            [r'(?:^|\W|\b)' + x + r'(?:$|\W)' for y in self.synonyms[track] for x in y])
-        op = self.find_synonyms(
-            release_id,
-            track,
-            r'(?:op|no|k|kk|kv|L|B|Hob|S|D|M|\w+WV)')
-        op_groups = op[0]
-        op_all = op[1]
-        notes = self.find_synonyms(release_id, track, r'[ABCDEFG]')
-        notes_groups = notes[0]
-        notes_all = notes[1]
-        sharp = self.find_synonyms(release_id, track, r'sharp')
-        sharp_groups = sharp[0]
-        sharp_all = sharp[1]
-        flat = self.find_synonyms(release_id, track, r'flat')
-        flat_groups = flat[0]
-        flat_all = flat[1]
-        major = self.find_synonyms(release_id, track, r'major')
-        major_groups = major[0]
-        major_all = major[1]
-        minor = self.find_synonyms(release_id, track, r'minor')
-        minor_groups = minor[0]
-        minor_all = minor[1]
-        opus_pattern = r"(?:\b((?:(" + op_groups + \
-            r"))\W?\s?\d+\-?\u2013?\u2014?\d*\w*)\b)"
-        note_pattern = r"(\b" + notes_groups + r")"
-        accent_pattern = r"(?:\-(" + sharp_groups + r")(?:\s+|\b)|\-(" + flat_groups + r")(?:\s+|\b)|\s(" + sharp_groups + \
-                         r")(?:\s+|\b)|\s(" + flat_groups + r")(?:\s+|\b)|\u266F(?:\s+|\b)|\u266D(?:\s+|\b)|(?:[:,.]?\s+|$|\-))"
-        scale_pattern = r"(?:((" + major_groups + \
-            r")|(" + minor_groups + r"))?\b)"
-        key_pattern = note_pattern + accent_pattern + scale_pattern
-        hyphen_split_pattern = r"(?:\b|\"|\')(\w+['’]?\w*)|(?:\b\w+\b)|(\B\&\B)"
-        # treat em-dash and en-dash as hyphens
-        hyphen_embed_pattern = r"(?:\b|\"|\')(\w+['’\-\u2013\u2014]?\w*)|(?:\b\w+\b)|(\B\&\B)"
+        regex_1, regex_2, all_synonyms_lists = get_synonym_table(tuples).listify_regexes(
+            self.options[track]["cwp_split_hyphenated"])
 
         # The regex is split into two iterations as putting it all together can have unpredictable consequences
         # - may match synonyms before op's even though that is later in the string
 
         # First match the op's and keys
-        regex_1 = opus_pattern + r"|(" + key_pattern + r")"
-        matches_1 = re.finditer(regex_1, s, re.UNICODE | re.IGNORECASE)
+        matches_1 = regex_1.finditer(s)
         s_list = []
         s_test_list = []
         s_scrubbed = s
-        all_synonyms_lists = [
-            op_all,
-            notes_all,
-            sharp_all,
-            flat_all,
-            sharp_all,
-            flat_all,
-            major_all,
-            minor_all]
         matches_list = [2, 4, 5, 6, 7, 8, 10, 11]
         for match in matches_1:
             test_a = match.group()
@@ -8315,9 +9014,10 @@ class PartLevels():
             # 11. minor match
             for i, all_synonyms_list in enumerate(all_synonyms_lists):
                 if all_synonyms_list and match_a[matches_list[i]]:
-                    match_regex = [re.match(pattern, match_a[matches_list[i]], re.IGNORECASE).group()
-                                   for pattern in all_synonyms_list
-                                   if re.match(pattern, match_a[matches_list[i]], re.IGNORECASE)]
+                    match_regex = [regex_match.group()
+                                   for regex_match in (regex.match(match_a[matches_list[i]])
+                                                       for regex in all_synonyms_list)
+                                   if regex_match]
                     if match_regex:
                         match_a[matches_list[i]] = self.canonize_synonyms(
                             release_id, tuples, match_a[matches_list[i]])
@@ -8354,17 +9054,11 @@ class PartLevels():
             s_scrubbed = ''.join(s_scrubbed_list)
 
         # Then match the synonyms and remaining words
-        if self.options[track]["cwp_split_hyphenated"]:
-            regex_2 = r"(" + syn_pattern + r")|" + hyphen_split_pattern
-            # allow ampersands and non-latin characters as word characters. Treat apostrophes as part of words.
-            # Treat opus and catalogue entries - e.g. K. 657 or OP.5 or op. 35a or CD 144 or BWV 243a - as one word
-            # also treat ranges of opus numbers (connected by dash, en dash or
-            # em dash) as one word
-        else:
-            regex_2 = r"(" + syn_pattern + r")|" + hyphen_embed_pattern
-            # as previous but also treat embedded hyphens as part of words.
-        matches_2 = re.finditer(
-            regex_2, s_scrubbed, re.UNICODE | re.IGNORECASE)
+        # allow ampersands and non-latin characters as word characters. Treat apostrophes as part of words.
+        # Treat opus and catalogue entries - e.g. K. 657 or OP.5 or op. 35a or CD 144 or BWV 243a - as one word
+        # also treat ranges of opus numbers (connected by dash, en dash or
+        # em dash) as one word (and embedded hyphens, unless cwp_split_hyphenated)
+        matches_2 = regex_2.finditer(s_scrubbed)
         for match in matches_2:
             if match.group(1) and match.group(1) == match.group():
                 s_test_list.append(
@@ -8390,63 +9084,39 @@ class PartLevels():
         :param track:
         :param text_type: 'replacements' or 'synonyms'
         Note that code in this method refers to synonyms (as that was written first), but applies equally to replacements and ui_tags
-        :return:
+        :return: tuple of tuples
         """
         tm = track.metadata
-        strsyns = re.split(r'(?<!\\)/',
-                           self.options[track]["cwp_" + text_type])
-        synonyms = []
-        for syn in strsyns:
-            tup_match = re.search(r'\((.*)\)', syn)
-            if tup_match:
-                # to ignore escaped commas
-                tup = re.split(r'(?<!\\),', tup_match.group(1))
-            else:
-                tup = ''
-            if len(tup) >= 2:
-                for i, ts in enumerate(tup):
-                    tup[i] = ts.strip("' ").strip('"')
-                    if len(
-                            tup[i]) > 4 and tup[i][0] == "!" and tup[i][1] == "!" and tup[i][-1] == "!" and tup[i][-2] == "!":
-                        # we have a reg ex inside - this deals with legacy
-                        # replacement text where enclosure in double-shouts was
-                        # required
-                        tup[i] = tup[i][2:-2]
-                    if (i < len(tup) - 1 or text_type ==
-                            'synonyms') and not tup[i]:
-                        write_log(
-                            release_id,
-                            'warning',
-                            '%s: entries must not be blank - error in %s',
-                            text_type,
-                            syn)
-                        if self.WARNING:
-                            self.append_tag(
-                            release_id,
-                            tm,
-                            '~cwp_warning',
-                            '7. ' + text_type + ': entries must not be blank - error in ' + syn)
-                        tup[i] = "**BAD**"
-                    elif [tup for t in synonyms if tup[i] in t]:
-                        write_log(
-                            release_id,
-                            'warning',
-                            '%s: keys cannot duplicate any in existing %s - error in %s '
-                            '- omitted from %s. To fix, place all %s in one tuple.',
-                            text_type,
-                            text_type,
-                            syn,
-                            text_type,
-                            text_type)
-                        if self.WARNING:
-                            self.append_tag(release_id, tm, '~cwp_warning',
-                                        '7. ' + text_type + ': keys cannot duplicate any in existing ' + text_type + ' - error in ' +
-                                        syn + ' - omitted from ' + text_type + '. To fix, place all ' + text_type + ' in one tuple.')
-                        tup[i] = "**BAD**"
-                if "**BAD**" in tup:
-                    continue
-                else:
-                    synonyms.append(tup)
+        synonyms, problems = parse_text_tuples(text_type, self.options[track]["cwp_" + text_type])
+        for problem, syn in problems:
+            if problem == 'blank':
+                write_log(
+                    release_id,
+                    'warning',
+                    '%s: entries must not be blank - error in %s',
+                    text_type,
+                    syn)
+                if self.WARNING:
+                    self.append_tag(
+                    release_id,
+                    tm,
+                    '~cwp_warning',
+                    '7. ' + text_type + ': entries must not be blank - error in ' + syn)
+            elif problem == 'duplicate':
+                write_log(
+                    release_id,
+                    'warning',
+                    '%s: keys cannot duplicate any in existing %s - error in %s '
+                    '- omitted from %s. To fix, place all %s in one tuple.',
+                    text_type,
+                    text_type,
+                    syn,
+                    text_type,
+                    text_type)
+                if self.WARNING:
+                    self.append_tag(release_id, tm, '~cwp_warning',
+                                '7. ' + text_type + ': keys cannot duplicate any in existing ' + text_type + ' - error in ' +
+                                syn + ' - omitted from ' + text_type + '. To fix, place all ' + text_type + ' in one tuple.')
             else:
                 write_log(
                     release_id,
@@ -8518,31 +9188,8 @@ class PartLevels():
         :param s:
         :return:
         """
-        write_log(release_id, 'debug', "boiling %s", s)
-        s = s.lower()
-        s = replace_roman_numerals(s)
-        s = s.replace('sch', 'sh')\
-            .replace(u'\xdf', 'ss')\
-            .replace('sz', 'ss')\
-            .replace(u'\u0153', 'oe')\
-            .replace('oe', 'o')\
-            .replace(u'\u00fc', 'ue')\
-            .replace('ue', 'u')\
-            .replace(u'\u00e6', 'ae')\
-            .replace('ae', 'a')\
-            .replace(u'\u266F', 'sharp')\
-            .replace(u'\u266D', 'flat')\
-            .replace(u'\u2013', '-')\
-            .replace(u'\u2014', '-')
-        # first term above is to remove the markers used for synonyms, to
-        # enable a true comparison
-        punc = re.compile(r'\W*', re.ASCII)
-        s = ''.join(
-            c for c in unicodedata.normalize(
-                'NFD',
-                s) if unicodedata.category(c) != 'Mn')
-        boiled = punc.sub('', s).strip().lower().rstrip("s'")
-        write_log(release_id, 'debug', "boiled result = %s", boiled)
+        boiled = boil_string(s)
+        write_log(release_id, 'debug', "boiled %s, result = %s", s, boiled)
         return boiled
 
 
@@ -8721,16 +9368,22 @@ write_log('session', 'info', REF_DICT)
 COMPOSER_DICT = REF_DICT['composers']
 if config.setting['cwp_muso_classical'] and not COMPOSER_DICT:
     write_log('session', 'error', 'No composer roster found')
+COMPOSER_INDEX = {}
+# composers by lower-case name (the first composer listed for a name is used)
 for cd in COMPOSER_DICT:
     cd['lc_name'] = [c.lower() for c in cd['name']]
     cd['lc_sort'] = [c.lower() for c in cd['sort']]
+    for lc_name in cd['lc_name']:
+        COMPOSER_INDEX.setdefault(lc_name, cd)
 PERIOD_DICT = REF_DICT['periods']
 if (config.setting['cwp_muso_dates']
         or config.setting['cwp_muso_periods']) and not PERIOD_DICT:
     write_log('session', 'error', 'No period map found')
+MUSO_PERIODS = PeriodIndex(get_periods(PERIOD_DICT))
 GENRE_DICT = REF_DICT['genres']
 if config.setting['cwp_muso_genres'] and not GENRE_DICT:
     write_log('session', 'error', 'No classical genre list found')
+MUSO_GENRES = [list_to_str(mg['name']).strip() for mg in GENRE_DICT]
 
 # API CALLS
 register_track_metadata_processor(PartLevels().add_work_info)
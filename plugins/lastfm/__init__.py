@@ -3,15 +3,24 @@
 PLUGIN_NAME = 'Last.fm'
 PLUGIN_AUTHOR = 'Lukáš Lalinský, Philipp Wolfer'
 PLUGIN_DESCRIPTION = 'Use tags from Last.fm as genre.'
-PLUGIN_VERSION = "0.10.1"
+PLUGIN_VERSION = "0.12.1"
 PLUGIN_API_VERSIONS = ["2.0"]
 
+import json
+import os
 import re
-from functools import partial
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache, partial
 from PyQt5 import QtCore
 from picard import config, log
 from picard.config import BoolOption, IntOption, TextOption
-from picard.metadata import register_track_metadata_processor
+from picard.const import USER_DIR
+from picard.metadata import (
+    register_album_metadata_processor,
+    register_track_metadata_processor,
+)
 from picard.plugins.lastfm.ui_options_lastfm import Ui_LastfmOptionsPage
 from picard.ui.options import register_options_page, OptionsPage
 from picard.util import build_qurl
@@ -27,13 +36,118 @@ LASTFM_API_KEY = '0a210a4a6741f2ec8f27a791b9d5d971'
 # second, averaged over a 5 minute period, without prior written consent. […]
 ratecontrol.set_minimum_delay((LASTFM_HOST, LASTFM_PORT), 200)
 
-# Cache for Tags to avoid re-requesting tags within same Picard session
-_cache = {}
+# Number of tag lists kept in memory, in front of the cache on disk
+CACHE_MEMORY_ENTRIES = 1000
+# Maximum number of entries in the cache on disk
+CACHE_MAX_ENTRIES = 100000
+# Check the size of the cache after this many writes
+CACHE_EVICT_INTERVAL = 100
+# Maximum number of prefetch requests sent to Last.fm and not yet returned
+PREFETCH_MAX_REQUESTS = 5
+
+DAY = 24 * 60 * 60
+
+
+class TagCache:
+    """Persistent cache of the top tags of artists and tracks, shared by all
+    Picard sessions on this host, with the most recently used held in memory.
+
+    Tags are stored as returned by Last.fm (name and usage count), so changes
+    to the tag options apply without looking them up again. Keys are made of
+    the API method and the case folded artist and track names.
+    The least recently used entries are removed once the cache holds more than
+    CACHE_MAX_ENTRIES entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.memory = OrderedDict()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(method, artist, track=''):
+        return '\n'.join(' '.join(name.split()).casefold()
+                         for name in (method, artist, track))
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS tags ('
+                'id TEXT PRIMARY KEY, value TEXT, fetched REAL, accessed REAL)')
+            self._evict()
+        return self.db
+
+    def _remember(self, key, fetched, tags):
+        self.memory[key] = (fetched, tags)
+        self.memory.move_to_end(key)
+        if len(self.memory) > CACHE_MEMORY_ENTRIES:
+            self.memory.popitem(last=False)
+
+    def _read(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        try:
+            db = self._connect()
+            row = db.execute('SELECT value, fetched FROM tags WHERE id = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE tags SET accessed = ? WHERE id = ?', (time.time(), key))
+            fetched, tags = row[1], [tuple(tag) for tag in json.loads(row[0])]
+            self._remember(key, fetched, tags)
+            return fetched, tags
+        except (OSError, sqlite3.Error, ValueError) as e:
+            log.warning('Last.fm: Failed to read from cache: %s', e)
+            return None
+
+    def get(self, key, ttl):
+        """Returns a list of (tag name, count) pairs, or None if not cached
+        or older than ttl seconds."""
+        entry = self._read(key)
+        if entry is None or entry[0] + ttl < time.time():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, tags):
+        now = time.time()
+        self._remember(key, now, tags)
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)',
+                (key, json.dumps(tags), now, now))
+            self.writes += 1
+            if self.writes % CACHE_EVICT_INTERVAL == 0:
+                self._evict()
+        except (OSError, sqlite3.Error) as e:
+            log.warning('Last.fm: Failed to write to cache: %s', e)
+
+    def _evict(self):
+        self.db.execute(
+            'DELETE FROM tags WHERE id IN '
+            '(SELECT id FROM tags ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (CACHE_MAX_ENTRIES,))
+
+
+# Cache for Tags to avoid re-requesting tags
+_cache = TagCache(os.path.join(USER_DIR, 'lastfm', 'cache.db'))
 
 # Keeps track of requests for tags made to webservice API but not yet returned
-# (to avoid re-requesting the same URIs)
+# (to avoid re-requesting the same tags)
+# key: cache key, value: list of functions waiting for the tags
 _pending_requests = {}
 
+# Prefetch requests not yet sent (see prefetch_album): (album, key, queryargs)
+_prefetch_queue = deque()
+_prefetch_active = 0
+
 # TODO: move this to an options page
 TRANSLATE_TAGS = {
     "hip hop": "Hip-Hop",
@@ -43,30 +157,57 @@ TRANSLATE_TAGS = {
 TITLE_CASE = True
 
 
+class IgnoredTags:
+    """Matches tags against the ignored tags option, ignoring case.
+
+    Tag names are looked up in a set and the /regular expressions/ are
+    matched as one alternation, so the cost of a match does not grow
+    with the number of names. Expressions with groups (which may be
+    referred to by backreferences) are matched on their own, as their
+    numbers or names would change in the alternation.
+    """
+
+    def __init__(self, names, patterns):
+        self.names = frozenset(names)
+        self.patterns = [pattern for pattern in patterns if pattern.groups]
+        self.regex = None
+        combined = [pattern for pattern in patterns if not pattern.groups]
+        if combined:
+            try:
+                self.regex = re.compile('|'.join('(?:%s)' % pattern.pattern for pattern in combined))
+            except re.error:
+                # e.g. inline flags, which cannot be combined
+                self.patterns = patterns
+
+    def __bool__(self):
+        return bool(self.names or self.regex or self.patterns)
+
+    def matches(self, tag):
+        if not tag or not self:
+            return False
+        tag = tag.lower().strip()
+        if tag in self.names:
+            return True
+        if self.regex is not None and self.regex.match(tag):
+            return True
+        return any(pattern.match(tag) for pattern in self.patterns)
+
+
+@lru_cache(maxsize=4)
 def parse_ignored_tags(ignore_tags_setting):
-    ignore_tags = []
+    names = []
+    patterns = []
     for tag in ignore_tags_setting.lower().split(','):
         tag = tag.strip()
         if tag.startswith('/') and tag.endswith('/'):
             try:
-                tag = re.compile(tag[1:-1])
+                patterns.append(re.compile(tag[1:-1]))
+                continue
             except re.error:
                 log.error(
                     'Error parsing ignored tag "%s"', tag, exc_info=True)
-        ignore_tags.append(tag)
-    return ignore_tags
-
-
-def matches_ignored(ignore_tags, tag):
-    tag = tag.lower().strip()
-    for pattern in ignore_tags:
-        if hasattr(pattern, 'match'):
-            match = pattern.match(tag)
-        else:
-            match = pattern == tag
-        if match:
-            return True
-    return False
+        names.append(tag)
+    return IgnoredTags(names, patterns)
 
 
 def _tags_finalize(album, metadata, tags, next_):
@@ -81,44 +222,24 @@ def _tags_finalize(album, metadata, tags, next_):
             metadata["genre"] = tags
 
 
-def _tags_downloaded(album, metadata, min_usage, ignore, next_, current, data,
-                     reply, error):
-    if error:
-        album._requests -= 1
-        album._finalize_loading(None)
-        return
-
-    try:
+def _filter_tags(tags, min_usage, ignore):
+    filtered = []
+    for name, count in tags:
+        if count < min_usage:
+            break
         try:
-            intags = data.lfm[0].toptags[0].tag
-        except AttributeError:
-            intags = []
-        tags = []
-        for tag in intags:
-            name = tag.name[0].text.strip()
-            try:
-                count = int(tag.count[0].text.strip())
-            except ValueError:
-                count = 0
-            if count < min_usage:
-                break
-            try:
-                name = TRANSLATE_TAGS[name]
-            except KeyError:
-                pass
-            if not matches_ignored(ignore, name):
-                tags.append(name.title())
-        url = reply.url().toString()
-        _cache[url] = tags
-        _tags_finalize(album, metadata, current + tags, next_)
-
-        # Process any pending requests for the same URL
-        if url in _pending_requests:
-            pending = _pending_requests[url]
-            del _pending_requests[url]
-            for delayed_call in pending:
-                delayed_call()
+            name = TRANSLATE_TAGS[name]
+        except KeyError:
+            pass
+        if not ignore.matches(name):
+            filtered.append(name.title())
+    return filtered
 
+
+def _tags_received(album, metadata, min_usage, ignore, next_, current, tags):
+    try:
+        _tags_finalize(album, metadata,
+                       current + _filter_tags(tags, min_usage, ignore), next_)
     except Exception:
         log.error('Problem processing download tags', exc_info=True)
     finally:
@@ -126,27 +247,95 @@ def _tags_downloaded(album, metadata, min_usage, ignore, next_, current, data,
         album._finalize_loading(None)
 
 
-def get_tags(album, metadata, queryargs, min_usage, ignore, next_, current):
-    """Get tags from an URL."""
-    url = build_qurl(
-        LASTFM_HOST, LASTFM_PORT, LASTFM_PATH, queryargs).toString()
-    if url in _cache:
-        _tags_finalize(album, metadata, current + _cache[url], next_)
+def _tags_downloaded(key, data, reply, error):
+    tags = []
+    if not error:
+        try:
+            try:
+                intags = data.lfm[0].toptags[0].tag
+            except AttributeError:
+                intags = []
+            for tag in intags:
+                name = tag.name[0].text.strip()
+                try:
+                    count = int(tag.count[0].text.strip())
+                except ValueError:
+                    count = 0
+                tags.append((name, count))
+            _cache.set(key, tags)
+        except Exception:
+            log.error('Problem processing download tags', exc_info=True)
+            tags = []
+    log.debug('Last.fm: %d tag cache hits, %d misses',
+              _cache.hits, _cache.misses)
+    # Process all requests for the same tags
+    for delayed_call in _pending_requests.pop(key, []):
+        delayed_call(tags)
+
+
+def get_tags(album, metadata, queryargs, ttl, min_usage, ignore, next_,
+             current):
+    """Get tags from the cache or, if not cached, from Last.fm."""
+    key = TagCache.key(queryargs['method'], queryargs['artist'],
+                       queryargs.get('track', ''))
+    tags = _cache.get(key, ttl)
+    if tags is not None:
+        _tags_finalize(album, metadata,
+                       current + _filter_tags(tags, min_usage, ignore), next_)
+        return
+    album._requests += 1
+    callback = partial(_tags_received, album, metadata, min_usage, ignore,
+                       next_, current)
+    # If we have already sent a request for these tags, delay this call
+    if key in _pending_requests:
+        _pending_requests[key].append(callback)
     else:
-        # If we have already sent a request for this URL, delay this call
-        if url in _pending_requests:
-            _pending_requests[url].append(
-                partial(get_tags, album, metadata, queryargs, min_usage,
-                        ignore, next_, current))
-        else:
-            _pending_requests[url] = []
-            album._requests += 1
-            album.tagger.webservice.get(
-                LASTFM_HOST, LASTFM_PORT, LASTFM_PATH,
-                partial(_tags_downloaded, album, metadata, min_usage, ignore,
-                        next_, current),
-                queryargs=queryargs, parse_response_type='xml',
-                priority=True, important=True)
+        _pending_requests[key] = [callback]
+        _request_tags(album, queryargs, partial(_tags_downloaded, key))
+
+
+def _request_tags(album, queryargs, handler):
+    album.tagger.webservice.get(
+        LASTFM_HOST, LASTFM_PORT, LASTFM_PATH, handler,
+        queryargs=get_queryargs(queryargs), parse_response_type='xml',
+        priority=True, important=True)
+
+
+def _prefetch_finished(album, tags):
+    album._requests -= 1
+    album._finalize_loading(None)
+
+
+def _prefetch_downloaded(key, data, reply, error):
+    global _prefetch_active
+    _prefetch_active -= 1
+    try:
+        _tags_downloaded(key, data, reply, error)
+    finally:
+        _send_prefetch_requests()
+
+
+def _send_prefetch_requests():
+    global _prefetch_active
+    while _prefetch_queue and _prefetch_active < PREFETCH_MAX_REQUESTS:
+        album, key, queryargs = _prefetch_queue.popleft()
+        _prefetch_active += 1
+        _request_tags(album, queryargs, partial(_prefetch_downloaded, key))
+
+
+def prefetch_tags(album, queryargs, ttl):
+    """Request tags which are not cached, before the tracks need them.
+
+    The request counts as pending from now on, so tracks asking for the
+    same tags wait for it, even while it is queued behind other prefetches.
+    """
+    key = TagCache.key(queryargs['method'], queryargs['artist'],
+                       queryargs.get('track', ''))
+    if key in _pending_requests or _cache.get(key, ttl) is not None:
+        return
+    album._requests += 1
+    _pending_requests[key] = [partial(_prefetch_finished, album)]
+    _prefetch_queue.append((album, key, queryargs))
 
 
 def encode_str(s):
@@ -163,22 +352,67 @@ def get_queryargs(queryargs):
 def get_track_tags(album, metadata, artist, track, min_usage,
                    ignore, next_, current):
     """Get track top tags."""
-    queryargs = get_queryargs({
+    queryargs = {
         'method': 'Track.getTopTags',
         'artist': artist,
         'track': track,
-    })
-    get_tags(album, metadata, queryargs, min_usage, ignore, next_, current)
+    }
+    get_tags(album, metadata, queryargs,
+             config.setting["lastfm_track_tags_ttl"] * DAY,
+             min_usage, ignore, next_, current)
 
 
 def get_artist_tags(album, metadata, artist, min_usage,
                     ignore, next_, current):
     """Get artist top tags."""
-    queryargs = get_queryargs({
+    queryargs = {
         'method': 'Artist.getTopTags',
         'artist': artist,
-    })
-    get_tags(album, metadata, queryargs, min_usage, ignore, next_, current)
+    }
+    get_tags(album, metadata, queryargs,
+             config.setting["lastfm_artist_tags_ttl"] * DAY,
+             min_usage, ignore, next_, current)
+
+
+def _credited_artist(node):
+    return ''.join(credit['name'] + credit.get('joinphrase', '')
+                   for credit in node.get('artist-credit', []))
+
+
+def prefetch_album(album, metadata, release):
+    """Look up the tags of all distinct artists and tracks of the release at
+    once, so that the tracks are filled from the results without waiting for
+    each other's requests.
+
+    The names are taken as credited on the release. Tracks whose tag names
+    differ (e.g. with standardized artist names) look up their own tags in
+    process_track.
+    """
+    use_track_tags = config.setting["lastfm_use_track_tags"]
+    use_artist_tags = config.setting["lastfm_use_artist_tags"]
+    if not (use_track_tags or use_artist_tags):
+        return
+    artist_ttl = config.setting["lastfm_artist_tags_ttl"] * DAY
+    track_ttl = config.setting["lastfm_track_tags_ttl"] * DAY
+    for medium in release.get('media', []):
+        for track in medium.get('tracks', []):
+            recording = track.get('recording', {})
+            artist = _credited_artist(track) or _credited_artist(recording)
+            title = track.get('title') or recording.get('title')
+            if not artist:
+                continue
+            if title and use_track_tags:
+                prefetch_tags(album, {
+                    'method': 'Track.getTopTags',
+                    'artist': artist,
+                    'track': title,
+                }, track_ttl)
+            if use_artist_tags:
+                prefetch_tags(album, {
+                    'method': 'Artist.getTopTags',
+                    'artist': artist,
+                }, artist_ttl)
+    _send_prefetch_requests()
 
 
 def process_track(album, metadata, track, release):
@@ -216,6 +450,8 @@ class LastfmOptionsPage(OptionsPage):
         TextOption("setting", "lastfm_ignore_tags",
                    "seen live, favorites, /\\d+ of \\d+ stars/"),
         TextOption("setting", "lastfm_join_tags", ""),
+        IntOption("setting", "lastfm_artist_tags_ttl", 90),
+        IntOption("setting", "lastfm_track_tags_ttl", 30),
     ]
 
     def __init__(self, parent=None):
@@ -230,19 +466,20 @@ class LastfmOptionsPage(OptionsPage):
         self.ui.min_tag_usage.setValue(setting["lastfm_min_tag_usage"])
         self.ui.ignore_tags.setText(setting["lastfm_ignore_tags"])
         self.ui.join_tags.setEditText(setting["lastfm_join_tags"])
+        self.ui.artist_tags_ttl.setValue(setting["lastfm_artist_tags_ttl"])
+        self.ui.track_tags_ttl.setValue(setting["lastfm_track_tags_ttl"])
 
     def save(self):
-        global _cache
         setting = config.setting
-        if setting["lastfm_min_tag_usage"] != self.ui.min_tag_usage.value() \
-           or setting["lastfm_ignore_tags"] != str(self.ui.ignore_tags.text()):
-            _cache = {}
         setting["lastfm_use_track_tags"] = self.ui.use_track_tags.isChecked()
         setting["lastfm_use_artist_tags"] = self.ui.use_artist_tags.isChecked()
         setting["lastfm_min_tag_usage"] = self.ui.min_tag_usage.value()
         setting["lastfm_ignore_tags"] = str(self.ui.ignore_tags.text())
         setting["lastfm_join_tags"] = str(self.ui.join_tags.currentText())
+        setting["lastfm_artist_tags_ttl"] = self.ui.artist_tags_ttl.value()
+        setting["lastfm_track_tags_ttl"] = self.ui.track_tags_ttl.value()
 
 
+register_album_metadata_processor(prefetch_album)
 register_track_metadata_processor(process_track)
 register_options_page(LastfmOptionsPage)
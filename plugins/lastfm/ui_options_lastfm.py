@@ -88,9 +88,54 @@ class Ui_LastfmOptionsPage(object):
         self.hboxlayout1.addWidget(self.min_tag_usage)
         self.vboxlayout2.addLayout(self.hboxlayout1)
         self.vboxlayout.addWidget(self.rename_files_2)
+        self.cache = QtWidgets.QGroupBox(LastfmOptionsPage)
+        self.cache.setObjectName("cache")
+        self.vboxlayout3 = QtWidgets.QVBoxLayout(self.cache)
+        self.vboxlayout3.setContentsMargins(9, 9, 9, 9)
+        self.vboxlayout3.setSpacing(2)
+        self.vboxlayout3.setObjectName("vboxlayout3")
+        self.hboxlayout2 = QtWidgets.QHBoxLayout()
+        self.hboxlayout2.setContentsMargins(0, 0, 0, 0)
+        self.hboxlayout2.setSpacing(6)
+        self.hboxlayout2.setObjectName("hboxlayout2")
+        self.label_artist_tags_ttl = QtWidgets.QLabel(self.cache)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Preferred)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.label_artist_tags_ttl.sizePolicy().hasHeightForWidth())
+        self.label_artist_tags_ttl.setSizePolicy(sizePolicy)
+        self.label_artist_tags_ttl.setObjectName("label_artist_tags_ttl")
+        self.hboxlayout2.addWidget(self.label_artist_tags_ttl)
+        self.artist_tags_ttl = QtWidgets.QSpinBox(self.cache)
+        self.artist_tags_ttl.setMinimum(1)
+        self.artist_tags_ttl.setMaximum(3650)
+        self.artist_tags_ttl.setObjectName("artist_tags_ttl")
+        self.hboxlayout2.addWidget(self.artist_tags_ttl)
+        self.vboxlayout3.addLayout(self.hboxlayout2)
+        self.hboxlayout3 = QtWidgets.QHBoxLayout()
+        self.hboxlayout3.setContentsMargins(0, 0, 0, 0)
+        self.hboxlayout3.setSpacing(6)
+        self.hboxlayout3.setObjectName("hboxlayout3")
+        self.label_track_tags_ttl = QtWidgets.QLabel(self.cache)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Preferred)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.label_track_tags_ttl.sizePolicy().hasHeightForWidth())
+        self.label_track_tags_ttl.setSizePolicy(sizePolicy)
+        self.label_track_tags_ttl.setObjectName("label_track_tags_ttl")
+        self.hboxlayout3.addWidget(self.label_track_tags_ttl)
+        self.track_tags_ttl = QtWidgets.QSpinBox(self.cache)
+        self.track_tags_ttl.setMinimum(1)
+        self.track_tags_ttl.setMaximum(3650)
+        self.track_tags_ttl.setObjectName("track_tags_ttl")
+        self.hboxlayout3.addWidget(self.track_tags_ttl)
+        self.vboxlayout3.addLayout(self.hboxlayout3)
+        self.vboxlayout.addWidget(self.cache)
         spacerItem = QtWidgets.QSpacerItem(263, 21, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
         self.vboxlayout.addItem(spacerItem)
         self.label_4.setBuddy(self.min_tag_usage)
+        self.label_artist_tags_ttl.setBuddy(self.artist_tags_ttl)
+        self.label_track_tags_ttl.setBuddy(self.track_tags_ttl)
 
         self.retranslateUi(LastfmOptionsPage)
         QtCore.QMetaObject.connectSlotsByName(LastfmOptionsPage)
@@ -108,3 +153,8 @@ class Ui_LastfmOptionsPage(object):
         self.join_tags.setItemText(2, _translate("LastfmOptionsPage", ", "))
         self.label_4.setText(_translate("LastfmOptionsPage", "Minimal tag usage:"))
         self.min_tag_usage.setSuffix(_translate("LastfmOptionsPage", " %"))
+        self.cache.setTitle(_translate("LastfmOptionsPage", "Cache"))
+        self.label_artist_tags_ttl.setText(_translate("LastfmOptionsPage", "Keep artist tags for:"))
+        self.artist_tags_ttl.setSuffix(_translate("LastfmOptionsPage", " days"))
+        self.label_track_tags_ttl.setText(_translate("LastfmOptionsPage", "Keep track tags for:"))
+        self.track_tags_ttl.setSuffix(_translate("LastfmOptionsPage", " days"))
@@ -20,7 +20,7 @@ An action consists in a command line executed for each album or each track along
 with a few options to tweak the behaviour. 
 This can be used to run external programs and pass some variables to it. 
 """
-PLUGIN_VERSION = "0.1"
+PLUGIN_VERSION = "0.4"
 PLUGIN_API_VERSIONS = ["2.10", "2.11"]
 PLUGIN_LICENSE = "GPL-2.0"
 PLUGIN_LICENSE_URL = "https://www.gnu.org/licenses/gpl-2.0.html"
@@ -40,18 +40,15 @@ from .options_post_tagging_actions import Ui_PostTaggingActions
 from .actions_status import Ui_ActionsStatus
 from PyQt5 import QtCore, QtWidgets, QtGui
 
-from collections import namedtuple
-from queue import PriorityQueue
-from threading import Thread, Lock
+from collections import Counter, defaultdict, deque, namedtuple
+from threading import Condition, Lock
 from concurrent import futures
-from os import path, cpu_count
+from os import path, cpu_count, stat
 import re
 import shlex
 import subprocess  # nosec B404
 import time
 
-WIDGET_UPDATE_INTERVAL = 0.5
-
 # Additional special variables.
 TRACK_SPECIAL_VARIABLES = {
     "filepath": lambda file: file,
@@ -72,26 +69,34 @@ ALBUM_SPECIAL_VARIABLES = {
 # Settings.
 CANCEL = "pta_cancel"
 MAX_WORKERS = "pta_max_workers"
-OPTIONS = ("pta_command", "pta_wait_for_exit", "pta_execute_for_tracks", "pta_refresh_tags")
+OPTIONS = ("pta_command", "pta_wait_for_exit", "pta_execute_for_tracks", "pta_refresh_tags", "pta_max_concurrent")
+# Used for actions saved before an option existed.
+OPTION_DEFAULTS = ("", "False", "False", "False", "0")
 
 Options = namedtuple("Options", ("variables", *[option[4:] for option in OPTIONS]))
-Action = namedtuple("Action", ("commands", "album", "options"))
-PriorityAction = namedtuple("PriorityAction", ("priority", "counter", "action"))
-action_queue = PriorityQueue()
+Action = namedtuple("Action", ("priority", "commands", "album", "options", "queued_at"))
 variables_pattern = re.compile(r'%.*?%')
 
 
+def load_option_rows():
+    """Returns the saved actions, one tuple of option values for each action.
+    """
+    columns = [config.setting[name] for name in OPTIONS]
+    number_of_actions = len(columns[0])
+    columns = [column + [default] * (number_of_actions - len(column))
+               for column, default in zip(columns, OPTION_DEFAULTS)]
+    return zip(*columns)
+
+
 class ActionLoader:
     """Adds actions to the execution queue.
 
     Attributes:
         action_options (list): Stores the actions' information loaded from the options page.
-        action_counter (int): The count of actions that have been added to the queue, used for priority.
     """
 
     def __init__(self):
         self.action_options = []
-        self.action_counter = 0
         self.load_actions()
 
     def _create_options(self, command, *other_options):
@@ -110,10 +115,8 @@ class ActionLoader:
         """
         if not sys.IS_WIN:
             commands = [shlex.split(command) for command in commands]
-        action = Action(commands, album, options)
-        priority_action = PriorityAction(priority, self.action_counter, action)
-        action_queue.put(priority_action)
-        self.action_counter += 1
+        action = Action(priority, commands, album, options, time.monotonic())
+        action_runner.add_action(action)
 
     def _replace_variables(self, variables, item):
         """Returns a list where each variable is replaced with its value.
@@ -154,33 +157,130 @@ class ActionLoader:
         This gets called when the plugin is loaded or when the user saves the options.
         """
         self.action_options = []
-        option_tuples = zip(*[config.setting[name] for name in OPTIONS])
-        for option_tuple in option_tuples:
+        for option_tuple in load_option_rows():
             command = option_tuple[0]
             other_options = [eval(option) for option in option_tuple[1:]]  # nosec B307
             self._create_options(command, *other_options)
 
 
+class ActionMetrics:
+    """Counters about the actions handled by the action runner.
+
+    Attributes:
+        queued (int): The number of actions waiting to run.
+        running (int): The number of actions currently running.
+        finished (Counter): The number of finished runs of each action, by position in the table.
+        wait_time (Counter): The total time each action spent waiting in the queue, in seconds.
+        run_time (Counter): The total time each action spent running, in seconds.
+        commands (dict): The command line of each action, by position in the table.
+        first_started_at (float): When the first action started running, used for the throughput.
+        version (int): Incremented whenever a counter changes.
+    """
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.finished = Counter()
+        self.wait_time = Counter()
+        self.run_time = Counter()
+        self.commands = {}
+        self.first_started_at = None
+        self.version = 0
+
+    @property
+    def pending(self):
+        return self.queued + self.running
+
+    def action_queued(self):
+        self.queued += 1
+        self.version += 1
+
+    def action_started(self, action, started_at):
+        self.queued -= 1
+        self.running += 1
+        self.wait_time[action.priority] += started_at - action.queued_at
+        if self.first_started_at is None:
+            self.first_started_at = started_at
+        self.version += 1
+
+    def action_finished(self, action, started_at, finished_at):
+        self.running -= 1
+        self.finished[action.priority] += 1
+        self.run_time[action.priority] += finished_at - started_at
+        self.commands[action.priority] = action.options.command
+        self.version += 1
+
+    def snapshot(self):
+        """Returns the current values of the counters as a dictionary.
+
+        The "actions" list holds, for each action that finished at least once, its
+        position in the table, its command, the number of finished runs and the
+        average time spent waiting and running. "throughput" is the number of
+        finished actions per minute since the first action started.
+        """
+        total_finished = sum(self.finished.values())
+        throughput = 0.0
+        if self.first_started_at is not None:
+            elapsed = time.monotonic() - self.first_started_at
+            if elapsed > 0:
+                throughput = total_finished * 60 / elapsed
+        return {
+            "version": self.version,
+            "queued": self.queued,
+            "running": self.running,
+            "pending": self.pending,
+            "finished": total_finished,
+            "throughput": throughput,
+            "actions": [
+                {
+                    "position": priority,
+                    "command": self.commands[priority],
+                    "finished": count,
+                    "average_wait": self.wait_time[priority] / count,
+                    "average_run": self.run_time[priority] / count,
+                }
+                for priority, count in sorted(self.finished.items())
+            ],
+        }
+
+
 class ActionRunner:
-    """Runs actions in the execution queue.
+    """Runs the actions added by the action loader.
+
+    Each album has its own chain of actions, executed in the order of the actions
+    table. Chains of different albums run concurrently, so an action which waits
+    for its process to finish only holds back the following actions of the same album.
+    An action can limit how many albums run it at the same time.
 
     Attributes:
         action_thread_pool (ThreadPoolExecutor): Pool used to run processes with the subprocess module.
         refresh_tags_pool (ThreadPoolExecutor): Pool used to reload tags from files and refresh albums.
-        worker (Thread): Worker thread that picks actions from the execution queue.
-        update_widget (Thread): Thread that updates the number of pending actions in the status bar.
+        chains (dict): The actions waiting to run for each album, in order of execution.
+        blocked_albums (set): Albums waiting for an action to finish before their next action can start.
+        running (Counter): The number of albums currently running each action, by position in the table.
+        album_actions (Counter): The number of queued and running actions of each album.
+        file_stats (dict): Size and modification time of each album's files before its actions ran.
+        refresh_albums (set): Albums to refresh once all their actions finished.
+        metrics (ActionMetrics): Queue depth and latency of the actions.
+        metrics_listeners (list): Functions called with a metrics snapshot whenever the metrics change.
     """
 
     def __init__(self):
         self.action_thread_pool = futures.ThreadPoolExecutor(config.setting[MAX_WORKERS])
         self.refresh_tags_pool = futures.ThreadPoolExecutor(1)
-        self.worker = Thread(target = self._execute)
-        self.update_widget = Thread(target = self._update_widget)
-        self.worker.start()
 
-        self.keep_updating = True
-        self.currently_executing = 0
-        self.currently_executing_lock = Lock()
+        self.lock = Lock()
+        self.idle = Condition(self.lock)
+        self.stopping = False
+        self.chains = defaultdict(deque)
+        self.blocked_albums = set()
+        self.running = Counter()
+        self.album_actions = Counter()
+        self.file_stats = {}
+        self.refresh_albums = set()
+        self.metrics = ActionMetrics()
+        self.metrics_listeners = []
+        self.published_version = -1
         self.status_widget = ActionsStatus()
 
         # This is used to register functions that run when the application is being closed.
@@ -201,24 +301,150 @@ class ActionRunner:
         """Adds the pending actions widget to the right of the other icons in the statusbar.
         """
         window.statusBar().insertPermanentWidget(1, self.status_widget)
-        self.update_widget.start()
+        self.status_widget.update_metrics(self.get_metrics())
+
+    def get_metrics(self):
+        with self.lock:
+            return self.metrics.snapshot()
+
+    def _publish_metrics(self):
+        """Pushes the metrics to the main thread.
+
+        This gets called only when an action is queued, starts or finishes.
+        """
+        thread.to_main(self._notify_metrics, self.get_metrics())
 
-    def _update_widget(self):
-        """Updates the number of pending actions in the status bar at regular intervals.
+    def _notify_metrics(self, snapshot):
+        """Updates the status bar and the listeners on the main thread.
+
+        Snapshots can arrive out of order from different threads, older ones are dropped.
+        """
+        if snapshot["version"] <= self.published_version:
+            return
+        self.published_version = snapshot["version"]
+        self.status_widget.update_metrics(snapshot)
+        for listener in list(self.metrics_listeners):
+            try:
+                listener(snapshot)
+            except Exception as e:
+                log.error("Post Tagging Actions: metrics listener failed: %s", e)
+
+    def add_action(self, action):
+        """Adds the action at the end of its album's chain.
+
+        When the album has no other pending actions, the size and modification
+        time of its files are recorded, to find the files changed by the actions.
+        """
+        album = action.album
+        with self.lock:
+            if self.stopping:
+                return
+            starts_chain = not self.album_actions[album]
+            self.album_actions[album] += 1
+        if starts_chain:
+            file_stats = {file: self._file_stat(file) for file in album.iterfiles()}
+            with self.lock:
+                self.file_stats[album] = file_stats
+        with self.lock:
+            self.chains[album].append(action)
+            self.metrics.action_queued()
+        self._dispatch(changed = True)
+
+    def _can_start(self, album, action):
+        if album in self.blocked_albums:
+            return False
+        limit = action.options.max_concurrent
+        return not limit or self.running[action.priority] < limit
+
+    def _dispatch(self, changed = False):
+        """Starts the first action of every album chain that is allowed to run.
+
+        The metrics are published if the caller changed them or if an action started.
+        """
+        to_start = []
+        with self.lock:
+            for album, chain in list(self.chains.items()):
+                while chain and self._can_start(album, chain[0]):
+                    action = chain.popleft()
+                    self.running[action.priority] += 1
+                    if action.options.wait_for_exit:
+                        self.blocked_albums.add(album)
+                    to_start.append(action)
+                if not chain:
+                    del self.chains[album]
+        for action in to_start:
+            self._start(action)
+        if changed or to_start:
+            self._publish_metrics()
+
+    def _start(self, action):
+        """Submits the action's commands to the thread pool.
         """
-        while self.keep_updating:
-            number_of_actions = action_queue.qsize() + self.currently_executing
-            thread.to_main(self.status_widget.update_actions_count, number_of_actions)
-            time.sleep(WIDGET_UPDATE_INTERVAL)
+        started_at = time.monotonic()
+        with self.lock:
+            self.metrics.action_started(action, started_at)
+        if not action.commands:
+            self._action_finished(action, started_at)
+            return
+        remaining = [len(action.commands)]
+
+        def command_done(future):
+            with self.lock:
+                remaining[0] -= 1
+                finished = not remaining[0]
+            if finished:
+                self._action_finished(action, started_at)
 
-    def _refresh_tags(self, future_objects, album):
-        """Reloads tags from the album's files and refreshes the album.
+        for command in action.commands:
+            future = self.action_thread_pool.submit(self._run_process, command)
+            future.add_done_callback(command_done)
 
-        First, it makes sure that the action has finished running. This is used for
-        when an external process changes a file's tags.
+    def _action_finished(self, action, started_at):
+        """Releases the action's concurrency slot and starts the actions that were waiting for it.
+        """
+        album = action.album
+        file_stats = None
+        with self.lock:
+            self.running[action.priority] -= 1
+            if action.options.wait_for_exit:
+                self.blocked_albums.discard(album)
+            self.metrics.action_finished(action, started_at, time.monotonic())
+            if action.options.refresh_tags:
+                self.refresh_albums.add(album)
+            self.album_actions[album] -= 1
+            if not self.album_actions[album]:
+                # The album's chain is over, refresh it once for all its actions.
+                del self.album_actions[album]
+                if album in self.refresh_albums and not self.stopping:
+                    file_stats = self.file_stats.get(album, {})
+                self.refresh_albums.discard(album)
+                self.file_stats.pop(album, None)
+            self.idle.notify_all()
+        if file_stats is not None:
+            self.refresh_tags_pool.submit(self._refresh_tags, album, file_stats)
+        self._dispatch(changed = True)
+
+    @staticmethod
+    def _file_stat(file):
+        try:
+            file_stat = stat(file.filename)
+        except OSError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def _refresh_tags(self, album, file_stats):
+        """Reloads tags from the album's files that changed and refreshes the album.
+
+        This is used for when an external process changes a file's tags. Only
+        files whose size or modification time differ from the ones recorded
+        before the album's actions ran are reloaded.
         """
-        futures.wait(future_objects, return_when = futures.ALL_COMPLETED)
-        for file in album.iterfiles():
+        changed_files = [file for file in album.iterfiles()
+                         if self._file_stat(file) != file_stats.get(file)]
+        if not changed_files:
+            log.debug("Post Tagging Actions: no files changed in %r, skipping refresh", album)
+            return
+        for file in changed_files:
             file.set_pending()
             file.load(lambda file: None)
         thread.to_main(album.load, priority = True, refresh = True)
@@ -238,53 +464,24 @@ class ActionRunner:
         if answer[1]:
             log.error("Action error:\n%s", answer[1])
 
-    def _update_executing_count(self, future_objects):
-        """Decrements the count of executing actions once the given action finishes.
-        """
-        futures.wait(future_objects, return_when = futures.ALL_COMPLETED)
-        with self.currently_executing_lock:
-            self.currently_executing -= 1
-
-    def _execute(self):
-        """Takes actions from the execution queue and runs them.
+    def stop(self):
+        """Stops running new actions and shuts down the thread pools.
 
-        If it finds an action with priority -1, the loop stops. When the loop
-        stops, both ThreadPoolExecutors are shutdown.
+        This gets called when Picard is closed. Unless the actions in the queue
+        should be cancelled, it waits for all of them to finish before exiting.
         """
-        while True:
-            priority_action = action_queue.get()
-            if priority_action.priority == -1:
-                break
-            with self.currently_executing_lock:
-                self.currently_executing += 1
-            next_action = priority_action.action
-            commands = next_action.commands
-            future_objects = {self.action_thread_pool.submit(self._run_process, command) for command in commands}
-
-            if next_action.options.wait_for_exit:
-                futures.wait(future_objects, return_when = futures.ALL_COMPLETED)
-            if next_action.options.refresh_tags:
-                self.refresh_tags_pool.submit(self._refresh_tags, future_objects, next_action.album)
-            self.refresh_tags_pool.submit(self._update_executing_count, future_objects)
-            action_queue.task_done()
-
+        with self.lock:
+            if config.setting[CANCEL]:
+                self.metrics.queued = 0
+                for chain in self.chains.values():
+                    for action in chain:
+                        self.album_actions[action.album] -= 1
+                self.chains.clear()
+            self.idle.wait_for(lambda: not self.chains and not self.metrics.running)
+            self.stopping = True
         self.action_thread_pool.shutdown(wait = False, cancel_futures = True)
         self.refresh_tags_pool.shutdown(wait = False, cancel_futures = True)
 
-    def stop(self):
-        """Makes the worker thread exit its loop.
-
-        This gets called when Picard is closed. It waits for the processes that
-        are still executing to finish before exiting.
-        """
-        if not config.setting[CANCEL]:
-            action_queue.join()
-        action_queue.put(PriorityAction(-1, -1, None))
-        self.keep_updating = False
-        if self.update_widget.is_alive():
-            self.update_widget.join()
-        self.worker.join()
-
 
 class ExecuteAlbumActions(BaseAction):
 
@@ -344,7 +541,8 @@ class PostTaggingActionsOptions(OptionsPage):
             self.ui.action.text,
             self.ui.wait.isChecked,
             self.ui.tracks.isChecked,
-            self.ui.refresh.isChecked
+            self.ui.refresh.isChecked,
+            self.ui.max_concurrent.value
         ]
 
     def _open_file_dialog(self):
@@ -362,6 +560,7 @@ class PostTaggingActionsOptions(OptionsPage):
         self.ui.action.setText("")
         self.ui.wait.setChecked(False)
         self.ui.refresh.setChecked(False)
+        self.ui.max_concurrent.setValue(0)
         self.ui.albums.setChecked(True)
 
     def _add_action_to_table(self):
@@ -405,8 +604,7 @@ class PostTaggingActionsOptions(OptionsPage):
     def load(self):
         """Puts the plugin's settings into the actions table.
         """
-        settings = zip(*[config.setting[name] for name in OPTIONS])
-        for row, values in enumerate(settings):
+        for row, values in enumerate(load_option_rows()):
             self.ui.table.insertRow(row)
             for column in range(self.ui.table.columnCount()):
                 widget = QtWidgets.QTableWidgetItem(values[column])
@@ -447,9 +645,39 @@ class ActionsStatus(QtWidgets.QWidget, Ui_ActionsStatus):
         icon = QtGui.QIcon(":/images/16x16/applications-system.png")
         self.label.setPixmap(icon.pixmap(size))
 
-    def update_actions_count(self, count):
+    def update_metrics(self, snapshot):
+        """Shows the number of pending actions and the average times of each action in the tooltip.
+        """
+        count = snapshot["pending"]
         self.actions_count.setText(f"{count}")
         self.setVisible(count > 0)
+        lines = [f"Remaining actions: {count} ({snapshot['running']} running)"]
+        for action in snapshot["actions"]:
+            lines.append(
+                f"{action['command']}: {action['finished']} finished, "
+                f"{action['average_wait']:.1f} s waiting, {action['average_run']:.1f} s running on average"
+            )
+        self.setToolTip("\n".join(lines))
+
+
+def get_metrics():
+    """Returns a snapshot of the post tagging actions metrics.
+
+    This can be used by other plugins or scripts, see ActionMetrics.snapshot
+    for the content of the returned dictionary.
+    """
+    return action_runner.get_metrics()
+
+
+def register_metrics_listener(listener):
+    """Registers a function called on the main thread with a metrics snapshot
+    whenever an action is queued, starts or finishes.
+    """
+    action_runner.metrics_listeners.append(listener)
+
+
+def unregister_metrics_listener(listener):
+    action_runner.metrics_listeners.remove(listener)
 
 
 action_loader = ActionLoader()
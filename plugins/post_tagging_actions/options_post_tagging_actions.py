@@ -57,6 +57,24 @@ class Ui_PostTaggingActions(object):
         self.refresh = QtWidgets.QCheckBox(self.action_widget)
         self.refresh.setObjectName("refresh")
         self._2.addWidget(self.refresh)
+        self.widget_5 = QtWidgets.QWidget(self.action_widget)
+        self.widget_5.setObjectName("widget_5")
+        self.horizontalLayout_7 = QtWidgets.QHBoxLayout(self.widget_5)
+        self.horizontalLayout_7.setObjectName("horizontalLayout_7")
+        self.max_concurrent = QtWidgets.QSpinBox(self.widget_5)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Maximum, QtWidgets.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.max_concurrent.sizePolicy().hasHeightForWidth())
+        self.max_concurrent.setSizePolicy(sizePolicy)
+        self.max_concurrent.setMinimum(0)
+        self.max_concurrent.setMaximum(64)
+        self.max_concurrent.setObjectName("max_concurrent")
+        self.horizontalLayout_7.addWidget(self.max_concurrent)
+        self.label_4 = QtWidgets.QLabel(self.widget_5)
+        self.label_4.setObjectName("label_4")
+        self.horizontalLayout_7.addWidget(self.label_4)
+        self._2.addWidget(self.widget_5)
         self.widget_3 = QtWidgets.QWidget(self.action_widget)
         self.widget_3.setObjectName("widget_3")
         self.horizontalLayout_6 = QtWidgets.QHBoxLayout(self.widget_3)
@@ -106,7 +124,7 @@ class Ui_PostTaggingActions(object):
         self.table.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
         self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
         self.table.setObjectName("table")
-        self.table.setColumnCount(4)
+        self.table.setColumnCount(5)
         self.table.setRowCount(0)
         item = QtWidgets.QTableWidgetItem()
         self.table.setHorizontalHeaderItem(0, item)
@@ -116,6 +134,8 @@ class Ui_PostTaggingActions(object):
         self.table.setHorizontalHeaderItem(2, item)
         item = QtWidgets.QTableWidgetItem()
         self.table.setHorizontalHeaderItem(3, item)
+        item = QtWidgets.QTableWidgetItem()
+        self.table.setHorizontalHeaderItem(4, item)
         self.table.horizontalHeader().setDefaultSectionSize(150)
         self.vboxlayout.addWidget(self.table)
         self.line = QtWidgets.QFrame(self.scrollAreaWidgetContents)
@@ -171,6 +191,9 @@ class Ui_PostTaggingActions(object):
         self.wait.setText(_translate("PostTaggingActions", " Wait for process to finish"))
         self.refresh.setToolTip(_translate("PostTaggingActions", "<html><head/><body><p>If checked, the album will &quot;refresh&quot; after this action finishes.</p></body></html>"))
         self.refresh.setText(_translate("PostTaggingActions", " Refresh tags after process finishes"))
+        self.max_concurrent.setSpecialValueText(_translate("PostTaggingActions", "No limit"))
+        self.label_4.setToolTip(_translate("PostTaggingActions", "Limits how many albums can run this action at the same time."))
+        self.label_4.setText(_translate("PostTaggingActions", "   Maximum number of albums running this action in parallel"))
         self.albums.setToolTip(_translate("PostTaggingActions", "Makes the action execute once for each album tagged."))
         self.albums.setText(_translate("PostTaggingActions", "Execute for albums"))
         self.tracks.setToolTip(_translate("PostTaggingActions", "Makes the action run once for each track tagged."))
@@ -188,6 +211,8 @@ class Ui_PostTaggingActions(object):
         item.setText(_translate("PostTaggingActions", "   Execute for tracks   "))
         item = self.table.horizontalHeaderItem(3)
         item.setText(_translate("PostTaggingActions", "   Refresh tags   "))
+        item = self.table.horizontalHeaderItem(4)
+        item.setText(_translate("PostTaggingActions", "   Max parallel   "))
         self.cancel.setToolTip(_translate("PostTaggingActions", "<html><head/><body><p>If <span style=\" font-weight:700;\">not </span>checked, when Picard is closed, it will wait for the actions to finish in the background.</p></body></html>"))
         self.cancel.setText(_translate("PostTaggingActions", "Cancel actions in the queue when Picard is closed"))
         self.label_2.setToolTip(_translate("PostTaggingActions", "Sets the number of background threads executing the actions"))
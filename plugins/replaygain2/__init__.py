@@ -30,15 +30,20 @@ The following file formats are supported:
 
 This plugin is based on the original ReplayGain plugin by Philipp Wolfer and Sophist.
 '''
-PLUGIN_VERSION = "1.6"
+PLUGIN_VERSION = "1.8"
 PLUGIN_API_VERSIONS = ["2.0"]
 PLUGIN_LICENSE = "GPL-2.0"
 PLUGIN_LICENSE_URL = "https://www.gnu.org/licenses/gpl-2.0.html"
 
+from collections import deque
 from functools import partial
+import hashlib
+import json
 import subprocess  # nosec: B404
 import shutil
+import sqlite3
 import os
+import threading
 
 from PyQt5.QtWidgets import QFileDialog
 
@@ -61,6 +66,8 @@ from picard.formats import (
     WavPackFile,
 )
 from picard.album import Album
+from picard.const import USER_DIR
+from picard.file import register_file_post_save_processor
 from picard.track import Track, NonAlbumTrack
 from picard.util import thread
 from picard.ui.options import register_options_page, OptionsPage
@@ -185,20 +192,111 @@ def update_metadata(metadata, track_result, album_result, is_nat, r128_tags):
         if config.setting["reference_loudness"]:
             metadata.set("replaygain_reference_loudness", f"{float(config.setting['target_loudness']):.2f} LUFS")
 
-def calculate_replaygain(tracks, options):
-
-    # Make sure files are of supported type, build file list
-    files = list()
-    valid_tracks = list()
-    for track in tracks:
-        if not track.files:
-            continue
-        file = track.files[0]
-        if not type(file) in SUPPORTED_FORMATS:
-            raise Exception(f"ReplayGain 2.0: File '{file.filename}' is of unsupported format")
-        files.append(file.filename)
-        valid_tracks.append(track)
+class ResultCache:
+    """Persistent cache of rsgain results.
+
+    Track results are stored per file path and rsgain options, together with
+    the size and mtime of the file when it was scanned. Album results are
+    keyed on the options and the results of all their tracks, so they stay
+    valid as long as none of the tracks changed. After Picard saved the tags
+    of a file, its entries are moved to the new size and mtime of the file, as
+    saving tags does not change the audio. This is only done for entries
+    matching the size and mtime the file had when its results were last
+    looked up or stored, so that a file changed since is scanned again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        self.identities = {}
+        # size and mtime of the files when their results were last looked up or stored, by path
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "path TEXT, options TEXT, size INTEGER, mtime INTEGER, result TEXT, "
+                "PRIMARY KEY (path, options))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS albums (key TEXT PRIMARY KEY, result TEXT)"
+            )
+        return self.db
+
+    @staticmethod
+    def _identity(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def album_key(options, results):
+        data = json.dumps([options, [sorted(result.items()) for result in results]])
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()  # nosec: B303
+
+    def get_track(self, path, options):
+        size, mtime = self._identity(path)
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT result FROM tracks WHERE path = ? AND options = ? AND size = ? AND mtime = ?",
+                (path, options, size, mtime)
+            ).fetchone()
+            self.identities[path] = (size, mtime)
+        return json.loads(row[0]) if row else None
+
+    def set_track(self, path, options, result):
+        size, mtime = self._identity(path)
+        with self.lock, self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)",
+                (path, options, size, mtime, json.dumps(result))
+            )
+            self.identities[path] = (size, mtime)
+
+    def get_album(self, key):
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT result FROM albums WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_album(self, key, result):
+        with self.lock, self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO albums VALUES (?, ?)",
+                (key, json.dumps(result))
+            )
 
+    def file_saved(self, path, metadata):
+        """Keep the results of a file whose tags were saved, if the file was
+        unchanged before the save and the saved tags are the ones calculated
+        from the cached result."""
+        with self.lock:
+            identity = self.identities.pop(path, None)
+            if identity is None:
+                return
+            rows = self._connect().execute(
+                "SELECT options, result FROM tracks WHERE path = ? AND size = ? AND mtime = ?",
+                (path,) + identity
+            ).fetchall()
+        size, mtime = self._identity(path)
+        for options, result in rows:
+            result = json.loads(result)
+            if (metadata.get("replaygain_track_gain") == result["gain"] + " dB"
+                or metadata.get("r128_track_gain") == format_r128(result, config)):
+                with self.lock, self._connect() as db:
+                    db.execute(
+                        "UPDATE tracks SET size = ?, mtime = ? "
+                        "WHERE path = ? AND options = ? AND size = ? AND mtime = ?",
+                        (size, mtime, path, options) + identity
+                    )
+
+
+result_cache = ResultCache(os.path.join(USER_DIR, "replaygain2", "cache.db"))
+
+
+def run_rsgain(files, options, album_tags, progress=None):
     call = [config.setting["rsgain_command"]] + options + files
     for item in call:
         item.encode("utf-8")
@@ -210,45 +308,99 @@ def calculate_replaygain(tracks, options):
         si.dwFlags = subprocess.STARTF_USESHOWWINDOW
         si.wShowWindow = subprocess.SW_HIDE
 
-    # Execute the scan with rsgain
+    # Execute the scan with rsgain, parsing the result rows as they arrive
     lines = list()
+    results = list()
+    unexpected = False
     with subprocess.Popen(  # nosec: B603
         call,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         startupinfo=si,
         encoding="utf-8",
-        text=True
+        text=True,
+        bufsize=1
     ) as process:
-        (output, _unused) = process.communicate()
-        rc = process.poll()
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            log.debug(line)
+            lines.append(line)
+            if len(lines) == 1:
+                continue # Don't care about the table header
+            result = parse_result(line)
+            if result is None:
+                unexpected = True
+                continue
+            results.append(result)
+            if progress is not None and len(results) <= len(files):
+                progress()
+        rc = process.wait()
         if rc:
             raise Exception(f'ReplayGain 2.0: rsgain returned non-zero code ({rc})')
-        log.debug(output)
-        lines = output.splitlines()
-    album_tags = config.setting["album_tags"]
 
-    # Make sure the number of rows in the output is what we expected
-    if (len(lines) !=
-        1                            # Table header
-        + len(valid_tracks)          # 1 row per track
-        + 1 if album_tags else 0):   # Album result
+    # Make sure the number of rows in the output is what we expected:
+    # one row per track plus the album result
+    if (unexpected
+        or len(results) != len(files) + (1 if album_tags else 0)):
         raise Exception(f"ReplayGain 2.0: Unexpected output from rsgain: {lines}")
-    lines.pop(0) # Don't care about the table header
 
     # Parse album result
     album_result = None
     if album_tags:
-        album_result = parse_result(lines[-1])
-        lines.pop(-1)
+        album_result = results.pop(-1)
+    return results, album_result
 
-    # Parse track results
-    results = list()
-    for line in lines:
-        result = parse_result(line)
-        if result is None:
-            raise Exception("ReplayGain 2.0: Failed to parse result")
-        results.append(result)
+
+def calculate_replaygain(tracks, options, progress=None):
+
+    # Make sure files are of supported type, build file list
+    files = list()
+    valid_tracks = list()
+    for track in tracks:
+        if not track.files:
+            continue
+        file = track.files[0]
+        if not type(file) in SUPPORTED_FORMATS:
+            raise Exception(f"ReplayGain 2.0: File '{file.filename}' is of unsupported format")
+        files.append(file.filename)
+        valid_tracks.append(track)
+    album_tags = config.setting["album_tags"]
+
+    # Reuse the results of previous scans for unchanged files
+    use_cache = config.setting["rsgain_cache"]
+    cache_options = " ".join(options)
+    results = [None] * len(files)
+    album_result = None
+    if use_cache:
+        results = [result_cache.get_track(f, cache_options) for f in files]
+        if album_tags and None not in results:
+            album_result = result_cache.get_album(
+                result_cache.album_key(cache_options, results))
+
+    # Album gain needs all files of the album to be scanned together
+    if album_tags and album_result is None:
+        missing = list(range(len(files)))
+    else:
+        missing = [i for i, result in enumerate(results) if result is None]
+    if progress is not None:
+        for i in range(len(files) - len(missing)):
+            progress()
+
+    if missing:
+        scanned, scanned_album = run_rsgain([files[i] for i in missing], options,
+                                            album_tags, progress)
+        for i, result in zip(missing, scanned):
+            results[i] = result
+        if album_tags:
+            album_result = scanned_album
+        if use_cache:
+            for i in missing:
+                result_cache.set_track(files[i], cache_options, results[i])
+            if album_tags:
+                result_cache.set_album(
+                    result_cache.album_key(cache_options, results), album_result)
+    else:
+        log.debug("ReplayGain 2.0: Using cached results for %i files", len(files))
 
     # Update track metadata with results
     opus_r128 = config.setting["opus_mode"] == OPUS_MODE_R128
@@ -263,6 +415,70 @@ def calculate_replaygain(tracks, options):
             )
 
 
+def file_post_save(file):
+    if config.setting["rsgain_cache"] and type(file) in SUPPORTED_FORMATS:
+        try:
+            result_cache.file_saved(file.filename, file.metadata)
+        except (OSError, sqlite3.Error) as e:
+            log.warning("ReplayGain 2.0: Failed to update result cache: %s", e)
+
+
+class ScanScheduler:
+    """Runs the queued rsgain scans with a limited number of parallel processes
+    and reports the progress per scanned track."""
+
+    def __init__(self):
+        self.queue = deque()
+        self.running = 0
+        self.total_tracks = 0
+        self.done_tracks = 0
+        self.window = None
+
+    @staticmethod
+    def max_jobs():
+        jobs = config.setting["rsgain_jobs"]
+        if jobs > 0:
+            return jobs
+        return os.cpu_count() or 1
+
+    def add(self, window, tracks, options, callback):
+        self.window = window
+        self.queue.append((tracks, options, callback))
+        self.total_tracks += len(tracks)
+        self._start_jobs()
+
+    def _start_jobs(self):
+        while self.queue and self.running < self.max_jobs():
+            tracks, options, callback = self.queue.popleft()
+            self.running += 1
+            thread.run_task(
+                partial(calculate_replaygain, tracks, options,
+                        partial(thread.to_main, self._track_done)),
+                partial(self._job_done, callback)
+            )
+
+    def _track_done(self):
+        self.done_tracks += 1
+        if self.total_tracks > 1:
+            self.window.set_statusbar_message(
+                'Calculating ReplayGain (%(done)i/%(total)i tracks)...',
+                {
+                    'done': self.done_tracks,
+                    'total': self.total_tracks,
+                }
+            )
+
+    def _job_done(self, callback, result=None, error=None):
+        self.running -= 1
+        callback(result=result, error=error)
+        if not self.running and not self.queue:
+            self.total_tracks = self.done_tracks = 0
+        self._start_jobs()
+
+
+scheduler = ScanScheduler()
+
+
 class ScanTracks(BaseAction):
     NAME = "Calculate Replay&Gain..."
 
@@ -280,8 +496,10 @@ class ScanTracks(BaseAction):
             self.tagger.window.set_statusbar_message(
                 'Calculating ReplayGain for %i tracks...', num_tracks
             )
-        thread.run_task(
-            partial(calculate_replaygain, tracks, self.options),
+        scheduler.add(
+            self.tagger.window,
+            tracks,
+            self.options,
             partial(self._replaygain_callback, tracks)
         )
 
@@ -316,8 +534,10 @@ class ScanAlbums(BaseAction):
                 'Calculating ReplayGain for %i albums...', self.num_albums
             )
         for album in albums:
-            thread.run_task(
-                partial(calculate_replaygain, album.tracks, self.options),
+            scheduler.add(
+                self.tagger.window,
+                list(album.tracks),
+                self.options,
                 partial(self._albumgain_callback, album)
             )
 
@@ -367,7 +587,9 @@ class ReplayGain2OptionsPage(OptionsPage):
         IntOption("setting", "clip_mode", CLIP_MODE_POSITIVE),
         IntOption("setting", "max_peak", 0),
         IntOption("setting", "opus_mode", OPUS_MODE_STANDARD),
-        BoolOption("setting", "opus_m23", False)
+        BoolOption("setting", "opus_m23", False),
+        IntOption("setting", "rsgain_jobs", 0),
+        BoolOption("setting", "rsgain_cache", True)
     ]
 
     def __init__(self, parent=None):
@@ -395,6 +617,8 @@ class ReplayGain2OptionsPage(OptionsPage):
         self.ui.max_peak.setValue(self.config.setting["max_peak"])
         self.ui.opus_mode.setCurrentIndex(self.config.setting["opus_mode"])
         self.ui.opus_m23.setChecked(self.config.setting["opus_m23"])
+        self.ui.rsgain_jobs.setValue(self.config.setting["rsgain_jobs"])
+        self.ui.rsgain_cache.setChecked(self.config.setting["rsgain_cache"])
 
     def save(self):
         self.config.setting["rsgain_command"] = self.ui.rsgain_command.text()
@@ -406,6 +630,8 @@ class ReplayGain2OptionsPage(OptionsPage):
         self.config.setting["max_peak"] = self.ui.max_peak.value()
         self.config.setting["opus_mode"] = self.ui.opus_mode.currentIndex()
         self.config.setting["opus_m23"] = self.ui.opus_m23.isChecked()
+        self.config.setting["rsgain_jobs"] = self.ui.rsgain_jobs.value()
+        self.config.setting["rsgain_cache"] = self.ui.rsgain_cache.isChecked()
 
     def rsgain_command_browse(self):
         path, _filter = QFileDialog.getOpenFileName(self, "", self.ui.rsgain_command.text())
@@ -417,3 +643,4 @@ class ReplayGain2OptionsPage(OptionsPage):
 register_track_action(ScanTracks())
 register_album_action(ScanAlbums())
 register_options_page(ReplayGain2OptionsPage)
+register_file_post_save_processor(file_post_save)
@@ -136,6 +136,27 @@ class Ui_ReplayGain2OptionsPage(object):
         self.opus_m23 = QtWidgets.QCheckBox(self.replay_gain)
         self.opus_m23.setObjectName("opus_m23")
         self.vboxlayout1.addWidget(self.opus_m23)
+        self.label_7 = QtWidgets.QLabel(self.replay_gain)
+        font = QtGui.QFont()
+        font.setBold(True)
+        font.setWeight(75)
+        self.label_7.setFont(font)
+        self.label_7.setObjectName("label_7")
+        self.vboxlayout1.addWidget(self.label_7)
+        self.rsgain_jobs = QtWidgets.QSpinBox(self.replay_gain)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.rsgain_jobs.sizePolicy().hasHeightForWidth())
+        self.rsgain_jobs.setSizePolicy(sizePolicy)
+        self.rsgain_jobs.setMinimum(0)
+        self.rsgain_jobs.setMaximum(64)
+        self.rsgain_jobs.setObjectName("rsgain_jobs")
+        self.vboxlayout1.addWidget(self.rsgain_jobs)
+        self.rsgain_cache = QtWidgets.QCheckBox(self.replay_gain)
+        self.rsgain_cache.setChecked(True)
+        self.rsgain_cache.setObjectName("rsgain_cache")
+        self.vboxlayout1.addWidget(self.rsgain_cache)
         self.vboxlayout.addWidget(self.replay_gain)
         spacerItem = QtWidgets.QSpacerItem(263, 21, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
         self.vboxlayout.addItem(spacerItem)
@@ -160,3 +181,7 @@ class Ui_ReplayGain2OptionsPage(object):
         self.label_3.setText(_translate("ReplayGain2OptionsPage", "Max Peak (dB)"))
         self.label_4.setText(_translate("ReplayGain2OptionsPage", "Opus Files"))
         self.opus_m23.setText(_translate("ReplayGain2OptionsPage", "Always reference Opus R128_*_GAIN tags to -23 LUFS"))
+        self.label_7.setText(_translate("ReplayGain2OptionsPage", "Parallel Scans"))
+        self.rsgain_jobs.setToolTip(_translate("ReplayGain2OptionsPage", "Number of albums scanned at the same time, Auto uses one scan per CPU core"))
+        self.rsgain_jobs.setSpecialValueText(_translate("ReplayGain2OptionsPage", "Auto"))
+        self.rsgain_cache.setText(_translate("ReplayGain2OptionsPage", "Reuse the results of previous scans for unchanged files"))
@@ -8,14 +8,20 @@
 PLUGIN_NAME = 'Wikidata Genre'
 PLUGIN_AUTHOR = 'Daniel Sobey, Sambhav Kothari'
 PLUGIN_DESCRIPTION = 'Query wikidata to get genre tags'
-PLUGIN_VERSION = '1.4.5'
+PLUGIN_VERSION = '1.6.1'
 PLUGIN_API_VERSIONS = ["2.0", "2.1", "2.2"]
 PLUGIN_LICENSE = 'WTFPL'
 PLUGIN_LICENSE_URL = 'http://www.wtfpl.net/'
 
+import json
+import os
 import re
-from functools import partial
+import sqlite3
+import time
+from functools import lru_cache, partial
+from PyQt5 import QtCore
 from picard import config, log
+from picard.const import USER_DIR
 from picard.metadata import register_track_metadata_processor
 from picard.plugins.wikidata.ui_options_wikidata import Ui_WikidataOptionsPage
 from picard.ui.options import register_options_page, OptionsPage
@@ -27,34 +33,156 @@ WIKIDATA_PORT = 443
 
 ratecontrol.set_minimum_delay((WIKIDATA_HOST, WIKIDATA_PORT), 0)
 
+# Maximum number of entities per wbgetentities request
+WIKIDATA_BATCH_SIZE = 50
+# How long to wait for more items before fetching a batch, in milliseconds
+WIKIDATA_BATCH_DELAY = 200
+
+# How long looked up entities and genres are kept, in seconds
+CACHE_TTL = 30 * 24 * 60 * 60
+# How long entities without wikidata item or genres are kept, in seconds
+CACHE_NEGATIVE_TTL = 7 * 24 * 60 * 60
+# Maximum number of entries in each table of the cache
+CACHE_MAX_ENTRIES = 50000
+# Check the size of the cache after this many writes
+CACHE_EVICT_INTERVAL = 100
+
+
+class IgnoredTags:
+    """Matches tags against the ignored tags option, ignoring case.
+
+    Tag names are looked up in a set and the /regular expressions/ are
+    matched as one alternation, so the cost of a match does not grow
+    with the number of names. Expressions with groups (which may be
+    referred to by backreferences) are matched on their own, as their
+    numbers or names would change in the alternation.
+    """
+
+    def __init__(self, names, patterns):
+        self.names = frozenset(names)
+        self.patterns = [pattern for pattern in patterns if pattern.groups]
+        self.regex = None
+        combined = [pattern for pattern in patterns if not pattern.groups]
+        if combined:
+            try:
+                self.regex = re.compile('|'.join('(?:%s)' % pattern.pattern for pattern in combined))
+            except re.error:
+                # e.g. inline flags, which cannot be combined
+                self.patterns = patterns
+
+    def __bool__(self):
+        return bool(self.names or self.regex or self.patterns)
+
+    def matches(self, tag):
+        if not tag or not self:
+            return False
+        tag = tag.lower().strip()
+        if tag in self.names:
+            return True
+        if self.regex is not None and self.regex.match(tag):
+            return True
+        return any(pattern.match(tag) for pattern in self.patterns)
+
 
+@lru_cache(maxsize=4)
 def parse_ignored_tags(ignore_tags_setting):
-    ignore_tags = []
+    names = []
+    patterns = []
     for tag in ignore_tags_setting.lower().split(','):
         if not tag:
             break
         tag = tag.strip()
         if tag.startswith('/') and tag.endswith('/'):
             try:
-                tag = re.compile(tag[1:-1])
+                patterns.append(re.compile(tag[1:-1]))
+                continue
             except re.error:
                 log.error(
                     'Error parsing ignored tag "%s"', tag, exc_info=True)
-        ignore_tags.append(tag)
-    return ignore_tags
-
-
-def matches_ignored(ignore_tags, tag):
-    if ignore_tags:
-        tag = tag.lower().strip()
-        for pattern in ignore_tags:
-            if hasattr(pattern, 'match'):
-                match = pattern.match(tag)
-            else:
-                match = pattern == tag
-            if match:
-                return True
-    return False
+        names.append(tag)
+    return IgnoredTags(names, patterns)
+
+
+class GenreCache:
+    """Persistent cache of the wikidata items of MusicBrainz entities and of the
+    genres of wikidata items, shared by all Picard sessions on this host.
+
+    Empty results are stored as well, so entities without wikidata item and items
+    without genres are not looked up again until CACHE_NEGATIVE_TTL has passed.
+    The least recently used entries are removed once a table holds more than
+    CACHE_MAX_ENTRIES entries.
+    """
+
+    TABLES = ('entities', 'items')
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.writes = 0
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            for table in self.TABLES:
+                self.db.execute(
+                    'CREATE TABLE IF NOT EXISTS %s ('
+                    'id TEXT PRIMARY KEY, value TEXT, fetched REAL, accessed REAL)' % table)
+            self._evict()
+        return self.db
+
+    def _get(self, table, key):
+        try:
+            db = self._connect()
+            row = db.execute('SELECT value, fetched FROM %s WHERE id = ?' % table, (key,)).fetchone()
+            if row is None:
+                return None
+            value = json.loads(row[0])
+            ttl = CACHE_TTL if value else CACHE_NEGATIVE_TTL
+            now = time.time()
+            if row[1] + ttl < now:
+                return None
+            db.execute('UPDATE %s SET accessed = ? WHERE id = ?' % table, (now, key))
+            return value
+        except (OSError, sqlite3.Error) as e:
+            log.warning('WIKIDATA: Failed to read from cache: %s', e)
+            return None
+
+    def _set(self, table, key, value):
+        try:
+            now = time.time()
+            self._connect().execute(
+                'INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)' % table,
+                (key, json.dumps(value), now, now))
+            self.writes += 1
+            if self.writes % CACHE_EVICT_INTERVAL == 0:
+                self._evict()
+        except (OSError, sqlite3.Error) as e:
+            log.warning('WIKIDATA: Failed to write to cache: %s', e)
+
+    def _evict(self):
+        for table in self.TABLES:
+            self.db.execute(
+                'DELETE FROM %s WHERE id IN '
+                '(SELECT id FROM %s ORDER BY accessed DESC LIMIT -1 OFFSET ?)' % (table, table),
+                (CACHE_MAX_ENTRIES,))
+
+    def get_entity(self, mbid):
+        """Returns a list of [genre source type, wikidata item id] pairs for the entity,
+        or None if it is not cached."""
+        return self._get('entities', mbid)
+
+    def set_entity(self, mbid, items):
+        self._set('entities', mbid, items)
+
+    def get_item(self, item):
+        """Returns the English names of the genres of the wikidata item,
+        or None if it is not cached."""
+        return self._get('items', item)
+
+    def set_item(self, item, genres):
+        self._set('items', item, genres)
 
 
 class Wikidata:
@@ -74,6 +202,20 @@ class Wikidata:
         # key: mbid, value: list of strings containing the genre's
         self.cache = {}
 
+        # persistent cache of wikidata items and genres
+        self.store = GenreCache(os.path.join(USER_DIR, 'wikidata', 'cache.db'))
+
+        # wikidata items waiting to be fetched
+        # key: wikidata item id, value: list of (mbid, genre source type) waiting for it
+        self.pending_items = {}
+        self.fetch_timer = QtCore.QTimer()
+        self.fetch_timer.setSingleShot(True)
+        self.fetch_timer.timeout.connect(self.fetch_items)
+
+        # names of the genres found so far
+        # key: wikidata item id of the genre, value: English name
+        self.genre_labels = {}
+
         # metabrainz url
         self.mb_host = ''
         self.mb_port = ''
@@ -87,10 +229,10 @@ class Wikidata:
         self.use_artist_genres = False
         self.use_artist_only_if_no_release = False
         self.ignore_genres_from_these_artists = ''
-        self.ignore_genres_from_these_artists_list = []
+        self.ignore_genres_from_these_artists_list = parse_ignored_tags('')
         self.use_work_genres = True
         self.ignore_these_genres = ''
-        self.ignore_these_genres_list = []
+        self.ignore_these_genres_list = parse_ignored_tags('')
         self.genre_delimiter = ''
 
     # not used
@@ -125,6 +267,9 @@ class Wikidata:
             #sort the new genre list so that they don't appear as new entries (not a change) next time
             metadata["genre"] = self.genre_delimiter.join(sorted(new_genre))
             return
+        elif item_id not in self.itemAlbums and self.apply_stored_genres(metadata, item_id):
+            log.debug('WIKIDATA: Found item in persistent cache')
+            return
         else:
             # pending requests are handled by adding the metadata object to a
             # list of things to be updated when the genre is found
@@ -148,8 +293,29 @@ class Wikidata:
                                                                       metadata),
                             parse_response_type="xml", priority=False, important=False, queryargs=queryargs)
 
+    def apply_stored_genres(self, metadata, item_id):
+        """Applies the genres of the item from the persistent cache.
+
+        Returns False if the wikidata items of the entity or the genres of one of
+        them are not in the cache, in which case they need to be looked up.
+        """
+        items = self.store.get_entity(item_id)
+        if items is None:
+            return False
+        genres = []
+        for genre_source_type, item in items:
+            genre_list = self.store.get_item(item)
+            if genre_list is None:
+                return False
+            genres.append((genre_source_type, genre_list))
+        for genre_source_type, genre_list in genres:
+            self.update_genres(item_id, genre_source_type, genre_list, [metadata])
+        return True
+
     def musicbrainz_release_lookup(self, item_id, metadata, response, reply, error):
         found = False
+        if not error:
+            self.store.set_entity(item_id, self.find_wikidata_items(response))
         if error:
             log.error('WIKIDATA: Error retrieving release group info')
         else:
@@ -191,65 +357,158 @@ class Wikidata:
             self.requests.clear()
             log.info('WIKIDATA: Finished (A)')
 
+    def find_wikidata_items(self, response):
+        """Returns [genre source type, wikidata item id] pairs for the wikidata
+        relations of the looked up entity."""
+        items = []
+        if 'metadata' not in response.children:
+            return items
+        entities = (
+            ('release_group', Wikidata.RELEASE_GROUP),
+            ('artist', Wikidata.ARTIST),
+            ('work', Wikidata.WORK),
+        )
+        for name, genre_source_type in entities:
+            if name not in response.metadata[0].children:
+                continue
+            entity = getattr(response.metadata[0], name)[0]
+            if 'relation_list' in entity.children:
+                for relation in entity.relation_list[0].relation:
+                    if relation.type == 'wikidata' and 'target' in relation.children:
+                        items.append([genre_source_type, relation.target[0].text.split('/')[4]])
+        return items
+
     def process_wikidata(self, genre_source_type, wikidata_url, item_id):
         album = self.itemAlbums[item_id]
         album._requests += 1
         item = wikidata_url.split('/')[4]
-        path = "/wiki/Special:EntityData/" + item + ".rdf"
-        log.debug('WIKIDATA: Fetching from wikidata.org%s' % path)
-        self.ws.get(WIKIDATA_HOST, WIKIDATA_PORT, path,
-                    partial(self.parse_wikidata_response, item, item_id, genre_source_type),
-                    parse_response_type="xml", priority=False, important=False)
-
-    def parse_wikidata_response(self, item, item_id, genre_source_type, response, reply, error):
-        genre_entries = []
-        genre_list = []
-        if error:
+        genre_list = self.store.get_item(item)
+        if genre_list is not None:
+            log.debug('WIKIDATA: Found genres of %s in persistent cache' % item)
+            self.process_genres(item_id, genre_source_type, genre_list)
+            return
+        # items are fetched in batches, wait a moment for more items to come in
+        self.pending_items.setdefault(item, []).append((item_id, genre_source_type))
+        if len(self.pending_items) >= WIKIDATA_BATCH_SIZE:
+            self.fetch_items()
+        elif not self.fetch_timer.isActive():
+            self.fetch_timer.start(WIKIDATA_BATCH_DELAY)
+
+    def fetch_items(self):
+        self.fetch_timer.stop()
+        while self.pending_items:
+            batch = {}
+            for item in list(self.pending_items)[:WIKIDATA_BATCH_SIZE]:
+                batch[item] = self.pending_items.pop(item)
+            log.debug('WIKIDATA: Fetching claims of %s' % ', '.join(batch))
+            self.get_entities(list(batch), 'claims', partial(self.parse_claims_response, batch))
+
+    def get_entities(self, ids, props, handler):
+        queryargs = {
+            'action': 'wbgetentities',
+            'ids': '|'.join(ids),
+            'props': props,
+            'format': 'json',
+        }
+        if props == 'labels':
+            queryargs['languages'] = 'en'
+        self.ws.get(WIKIDATA_HOST, WIKIDATA_PORT, '/w/api.php', handler,
+                    parse_response_type="json", priority=False, important=False, queryargs=queryargs)
+
+    def parse_claims_response(self, batch, response, reply, error):
+        if error or 'entities' not in response:
             log.error('WIKIDATA: error getting data from wikidata.org')
+            self.finish_batch(batch, {})
+            return
+        item_genres = {}
+        for item, entity in response['entities'].items():
+            # entities that are redirected are returned under their new id
+            item = entity.get('redirects', {}).get('from', item)
+            genre_ids = []
+            for claim in entity.get('claims', {}).get('P136', []):
+                snak = claim.get('mainsnak', {})
+                if snak.get('snaktype') == 'value':
+                    genre_ids.append(snak['datavalue']['value']['id'])
+            log.debug('WIKIDATA: Found the wikidata ids for the genres of %s: %s' % (item, genre_ids))
+            item_genres[item] = genre_ids
+
+        unknown = sorted({genre_id for genre_ids in item_genres.values() for genre_id in genre_ids
+                          if genre_id not in self.genre_labels})
+        if not unknown:
+            self.finish_batch(batch, item_genres)
+            return
+        chunks = [unknown[i:i + WIKIDATA_BATCH_SIZE] for i in range(0, len(unknown), WIKIDATA_BATCH_SIZE)]
+        remaining = [len(chunks)]
+        # genre ids whose names could not be fetched
+        failed = set()
+        for chunk in chunks:
+            self.get_entities(chunk, 'labels',
+                              partial(self.parse_labels_response, batch, item_genres, remaining, chunk, failed))
+
+    def parse_labels_response(self, batch, item_genres, remaining, chunk, failed, response, reply, error):
+        if error or 'entities' not in response:
+            log.error('WIKIDATA: error getting genre names from wikidata.org')
+            failed.update(chunk)
         else:
-            if 'RDF' in response.children:
-                node = response.RDF[0]
-                for node1 in node.Description:
-                    if 'about' in node1.attribs:
-                        if node1.attribs.get('about') == 'http://www.wikidata.org/entity/%s' % item:
-                            for key, val in list(node1.children.items()):
-                                if key == 'P136':
-                                    for i in val:
-                                        if 'resource' in i.attribs:
-                                            tmp = i.attribs.get('resource')
-                                            if 'entity' == tmp.split('/')[3] and len(tmp.split('/')) == 5:
-                                                genre_id = tmp.split('/')[4]
-                                                log.debug(
-                                                    'WIKIDATA: Found the wikidata id for the genre: %s' % genre_id)
-                                                genre_entries.append(tmp)
-                        else:
-                            for tmp in genre_entries:
-                                if tmp == node1.attribs.get('about'):
-                                    list1 = node1.children.get('name')
-                                    if not list1:
-                                    	log.warning('WIKIDATA: Response does not contain a name field')
-                                    else:
-                                        for node2 in list1:
-                                            if node2.attribs.get('lang') == 'en':
-                                                genre = node2.text.title()
-                                                if not matches_ignored(self.ignore_these_genres_list, genre):
-                                                    genre_list.append(genre)
-                                                    log.debug('New genre has been found and ALLOWED: %s' % genre)
-                                                else:
-                                                    log.debug('New genre has been found, but IGNORED: %s' % genre)
+            failed.update(genre_id for genre_id in chunk if genre_id not in response['entities'])
+            for genre_id, entity in response['entities'].items():
+                label = entity.get('labels', {}).get('en')
+                if not label:
+                    log.warning('WIKIDATA: Response does not contain a name for %s' % genre_id)
+                    continue
+                self.genre_labels[genre_id] = label['value'].title()
+        remaining[0] -= 1
+        if not remaining[0]:
+            self.finish_batch(batch, item_genres, failed)
+
+    def finish_batch(self, batch, item_genres, failed=frozenset()):
+        for item, waiting in batch.items():
+            genre_list = []
+            if item in item_genres:
+                genre_list = [self.genre_labels[genre_id] for genre_id in item_genres[item]
+                              if genre_id in self.genre_labels]
+                # a partial list after a failed request is not kept, so the item is looked up again
+                if failed.isdisjoint(item_genres[item]):
+                    self.store.set_item(item, genre_list)
+            for item_id, genre_source_type in waiting:
+                self.process_genres(item_id, genre_source_type, genre_list)
+
+    def process_genres(self, item_id, genre_source_type, genre_list):
+        self.update_genres(item_id, genre_source_type, genre_list, self.requests[item_id])
+
+        log.debug('WIKIDATA: seeing if we can finalize tags...')
+
+        album = self.itemAlbums[item_id]
+        album._requests -= 1
+        if not album._requests:
+            self.itemAlbums = {k: v for k, v in self.itemAlbums.items() if v != album}
+            album._finalize_loading(None)
+        log.info('WIKIDATA: total remaining requests: %s' % album._requests)
+        if not self.itemAlbums:
+            self.requests.clear()
+            log.info('WIKIDATA: Finished (B)')
+
+    def update_genres(self, item_id, genre_source_type, genre_list, metadata_list):
+        allowed_genres = []
+        for genre in genre_list:
+            if not self.ignore_these_genres_list.matches(genre):
+                allowed_genres.append(genre)
+                log.debug('New genre has been found and ALLOWED: %s' % genre)
+            else:
+                log.debug('New genre has been found, but IGNORED: %s' % genre)
+        genre_list = allowed_genres
 
         if len(genre_list) > 0:
             log.debug('WIKIDATA: item_id: %s' % item_id)
-            log.debug('WIKIDATA: Final list of wikidata id found: %s' % genre_entries)
             log.debug('WIKIDATA: Final list of genre: %s' % genre_list)
-            log.info('WIKIDATA: Total items to update: %d ' % len(self.requests[item_id]))
+            log.info('WIKIDATA: Total items to update: %d ' % len(metadata_list))
 
-            for metadata in self.requests[item_id]:
+            for metadata in metadata_list:
                 if genre_source_type == Wikidata.RELEASE_GROUP:
                     metadata['~release_group_genre_sourced'] = True
                 elif genre_source_type == Wikidata.ARTIST:
                     if self.use_artist_only_if_no_release and metadata['~release_group_genre_sourced'] or \
-                            matches_ignored(self.ignore_genres_from_these_artists_list, metadata.get("artist")):
+                            self.ignore_genres_from_these_artists_list.matches(metadata.get("artist")):
                         if item_id not in self.cache:
                             self.cache[item_id] = []
                         log.debug('WIKIDATA: NOT setting Artist-sourced genre: %s ' % genre_list)
@@ -280,18 +539,6 @@ class Wikidata:
         else:
             log.debug('WIKIDATA: genre not found in wikidata')
 
-        log.debug('WIKIDATA: seeing if we can finalize tags...')
-
-        album = self.itemAlbums[item_id]
-        album._requests -= 1
-        if not album._requests:
-            self.itemAlbums = {k: v for k, v in self.itemAlbums.items() if v != album}
-            album._finalize_loading(None)
-        log.info('WIKIDATA: total remaining requests: %s' % album._requests)
-        if not self.itemAlbums:
-            self.requests.clear()
-            log.info('WIKIDATA: Finished (B)')
-
     def process_track(self, album, metadata, track, release):
         self.update_settings()
         self.ws = album.tagger.webservice
@@ -333,18 +580,16 @@ class Wikidata:
         if self.use_artist_only_if_no_release != config.setting["wikidata_use_artist_only_if_no_release"]:
             self.use_artist_only_if_no_release = config.setting["wikidata_use_artist_only_if_no_release"]
             self.cache.clear()
-        if self.ignore_genres_from_these_artists != parse_ignored_tags(
-                config.setting["wikidata_ignore_genres_from_these_artists"]):
-            self.ignore_genres_from_these_artists_list = parse_ignored_tags(
-                config.setting["wikidata_ignore_genres_from_these_artists"])
+        if self.ignore_genres_from_these_artists != config.setting["wikidata_ignore_genres_from_these_artists"]:
+            self.ignore_genres_from_these_artists = config.setting["wikidata_ignore_genres_from_these_artists"]
+            self.ignore_genres_from_these_artists_list = parse_ignored_tags(self.ignore_genres_from_these_artists)
             self.cache.clear()
         if self.use_work_genres != config.setting["wikidata_use_work_genres"]:
             self.use_work_genres = config.setting["wikidata_use_work_genres"]
             self.cache.clear()
-        if self.ignore_these_genres != parse_ignored_tags(config.setting["wikidata_ignore_these_genres"]):
-            self.ignore_these_genres = parse_ignored_tags(config.setting["wikidata_ignore_these_genres"])
-            self.ignore_these_genres_list = parse_ignored_tags(
-                config.setting["wikidata_ignore_these_genres"])
+        if self.ignore_these_genres != config.setting["wikidata_ignore_these_genres"]:
+            self.ignore_these_genres = config.setting["wikidata_ignore_these_genres"]
+            self.ignore_these_genres_list = parse_ignored_tags(self.ignore_these_genres)
             self.cache.clear()
         if config.setting["write_id3v23"]:
             self.genre_delimiter = config.setting["wikidata_genre_delimiter"]
@@ -0,0 +1,324 @@
+import json
+import random
+import re
+import sys
+import unicodedata
+from test.plugin_test_case import PluginTestCase
+from unittest.mock import Mock
+
+from picard.metadata import Metadata
+from picard.util.xml import XmlNode
+
+
+def old_parse_data(obj, response_list, *match):
+    # parse_data before match paths were compiled to selectors
+    if isinstance(obj, XmlNode):
+        obj = obj.__dict__
+    if isinstance(obj, list):
+        for item in obj:
+            old_parse_data(item, response_list, *match)
+        return response_list
+    elif isinstance(obj, dict):
+        if match[0] in obj:
+            if len(match) == 1:
+                if obj[match[0]] is not None:
+                    response_list.append(obj[match[0]])
+            else:
+                old_parse_data(obj[match[0]], response_list, *match[1:])
+            return response_list
+        elif ':' in match[0]:
+            test = match[0].split(':')
+            test_data = old_parse_data(obj, [], *test[0].split('.'))
+            if test[1] in test_data or (test[1] == 'True') in test_data:
+                if len(match) == 1:
+                    response_list.append(obj)
+                else:
+                    old_parse_data(obj, response_list, *match[1:])
+            return response_list
+        else:
+            if 'children' in obj:
+                old_parse_data(obj['children'], response_list, *match)
+            return response_list
+    return response_list
+
+
+def old_canonize_synonyms(tuples, s):
+    # canonize_synonyms before the synonyms were compiled into one regex
+    s_canon = s
+    for syn_tup in tuples:
+        pattern = r'((?:^|\W)' + r'(?:$|\W)|(?:^|\W)'.join(syn_tup) + r'(?:$|\W))'
+        regex_match = re.compile(pattern, re.IGNORECASE).search(s)
+        if regex_match:
+            s_canon = s_canon.replace(regex_match.group().strip(), syn_tup[-1])
+    return s_canon
+
+
+def old_boil_string(replace_roman_numerals, s):
+    # boil_string before it was memoised
+    s = s.lower()
+    s = replace_roman_numerals(s)
+    s = s.replace('sch', 'sh')\
+        .replace(u'\xdf', 'ss')\
+        .replace('sz', 'ss')\
+        .replace(u'\u0153', 'oe')\
+        .replace('oe', 'o')\
+        .replace(u'\u00fc', 'ue')\
+        .replace('ue', 'u')\
+        .replace(u'\u00e6', 'ae')\
+        .replace('ae', 'a')\
+        .replace(u'\u266F', 'sharp')\
+        .replace(u'\u266D', 'flat')\
+        .replace(u'\u2013', '-')\
+        .replace(u'\u2014', '-')
+    s = ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+    return re.sub(r'\W*', '', s, flags=re.ASCII).strip().lower().rstrip("s'")
+
+
+def brute_force_lcs_length(strings):
+    first = strings[0]
+    best = 0
+    for start in range(len(first)):
+        for end in range(start + best + 1, len(first) + 1):
+            if not all(contains(other, first[start:end]) for other in strings[1:]):
+                break
+            best = end - start
+    return best
+
+
+def contains(sequence, part):
+    if isinstance(sequence, str):
+        return part in sequence
+    return any(sequence[i:i + len(part)] == part for i in range(len(sequence) - len(part) + 1))
+
+
+def xml_node(text='', **attribs):
+    node = XmlNode()
+    node.text = text
+    node.attribs.update(attribs)
+    return node
+
+
+class TestClassicalExtras(PluginTestCase):
+    SETTINGS = {
+        "log_info": False,
+        "log_debug": False,
+        "log_warning": False,
+        "log_error": False,
+        "use_cache": False,
+        "ce_show_ui_tags": False,
+        "cwp_muso_path": "",
+        "cwp_muso_refdb": "",
+        "cwp_muso_classical": False,
+        "cwp_muso_dates": False,
+        "cwp_muso_periods": False,
+        "cwp_muso_genres": False,
+    }
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.set_config_values(setting=self.SETTINGS)
+        # the plugin refers to its const submodule as set on the package when first imported
+        for name in list(sys.modules):
+            if name.startswith("picard.plugins.classical_extras."):
+                del sys.modules[name]
+        self.plugin = self._test_plugin_install("Classical Extras", "classical_extras")
+
+    def create_album(self, release_id: str):
+        album = Mock(id=release_id, _requests=0)
+        track = Mock(album=album, metadata=Metadata(musicbrainz_albumid=release_id))
+        return album, track
+
+    def test_remove_album_mid_load(self) -> None:
+        parts = self.plugin.PartLevels()
+        removed, removed_track = self.create_album("removed")
+        loading, loading_track = self.create_album("loading")
+        for album, track in ((removed, removed_track), (loading, loading_track)):
+            parts.watch_album(album)
+            parts.work_listing[album].append(("shared",))
+            parts.works_queue.append("shared", (track, album))
+        parts.work_listing[removed].append(("own",))
+        parts.works_queue.append("own", (removed_track, removed))
+        parts.works_queue.append("failed", (removed_track, removed))
+        parts.prefetching["key"] = [("own", 0), ("shared", 0)]
+        parts.prefetched_works["removed"] = (removed, {})
+        parts.prefetched_works["loading"] = (loading, {})
+        loading._requests = 1
+
+        parts.remove_album(removed)
+
+        self.assertEqual(parts.works_queue["shared"], [(loading_track, loading)])
+        self.assertNotIn("own", parts.works_queue)
+        self.assertNotIn("failed", parts.works_queue)
+        self.assertEqual(parts.prefetching["key"], [("shared", 0)])
+        self.assertEqual(list(parts.prefetched_works), ["loading"])
+
+        # replies for the removed album arrive after it has gone
+        parts.work_process("own", 0, {}, None, None)
+        parts.work_process("failed", 0, None, None, "error")
+        self.assertNotIn(removed, parts.work_listing)
+        self.assertEqual(removed._requests, 0)
+
+        # a prefetch for the removed album is only kept in the work store
+        parts.work_store = Mock()
+        parts.prefetching["late"] = []
+        parts.work_prefetched("removed", removed, "late", {"id": "late"}, None, None)
+        parts.work_store.set.assert_called_once_with("late", {"id": "late"})
+        self.assertNotIn("late", parts.prefetched_works)
+
+    def release(self):
+        def work(work_id, parent_id=None, ordering_key=None):
+            relations = []
+            if parent_id:
+                relations.append({
+                    "target-type": "work", "type": "parts", "direction": "backward",
+                    "ordering-key": ordering_key, "work": {"id": parent_id, "title": None},
+                })
+            return {"id": work_id, "title": "Work " + work_id, "relations": relations}
+
+        recording = {
+            "id": "rec",
+            "relations": [
+                {"target-type": "work", "work": work("w1", "p1", 2)},
+                {"target-type": "work", "work": work("w2", "p2")},
+                {"target-type": "artist", "type": "composer", "artist": {"id": "a1", "name": "A"}},
+                {"target-type": "artist", "type": "conductor", "ended": True, "artist": {"id": "a2"}},
+            ],
+        }
+        album = xml_node()
+        medium = album.append_child("medium", xml_node(position="1"))
+        medium.append_child("title", xml_node("Disc 1"))
+        album.append_child("medium", xml_node(position="2"))
+        return [{"recording": recording}, {"recording": None}, "text", album]
+
+    def test_parse_data_matches_old(self) -> None:
+        release = self.release()
+        paths = [
+            ("recording", "id"),
+            ("recording", "relations", "target-type:work", "work", "id"),
+            ("recording", "relations", "target-type:work", "work.id:w2", "work",
+             "relations", "target-type:work", "type:parts", "direction:backward", "work", "id"),
+            ("recording", "relations", "target-type:work", "work", "relations", "ordering-key"),
+            ("recording", "relations", "target-type:work", "work", "relations", "work", "title"),
+            ("recording", "relations", "target-type:artist", "type:composer", "artist", "name"),
+            ("recording", "relations", "ended:True", "artist", "id"),
+            ("recording", "relations", "target-type:label"),
+            ("recording", "relations", "artist.id:a1"),
+            ("medium", "attribs", "position"),
+            ("medium", "attribs.position:1", "title", "text"),
+            ("missing",),
+        ]
+        for match in paths:
+            self.assertEqual(
+                old_parse_data(release, [], *match),
+                self.plugin.parse_data("session", release, [], *match),
+                match)
+
+    def test_selector_cache_is_bounded(self) -> None:
+        release = self.release()
+        for i in range(self.plugin.SELECTOR_CACHE_SIZE + 10):
+            self.plugin.parse_data(
+                "session", release, [], "recording", "relations", "work.id:w%d" % i, "work", "id")
+        self.assertLessEqual(
+            self.plugin.get_selector.cache_info().currsize, self.plugin.SELECTOR_CACHE_SIZE)
+
+    SYNONYMS = ("(Rezitativ, Recitativo, Recitative) / (Sinfonia, Sinfonie, Symphony) / "
+                "(Nr, No) / (opus, op) / (moll, minor)")
+
+    def test_listify_unchanged(self) -> None:
+        # as listed before the synonyms were compiled into one regex
+        expected = {
+            "Sinfonie Nr. 5 c-moll op. 67 - 1. Allegro con brio":
+                ("Symphony ", "5", "cminor", "op67", "1", "Allegro", "con", "brio"),
+            "Symphony No. 40 in G minor, K. 550: I. Molto allegro":
+                ("Symphony ", "40", "in", "Gminor", "K550", "I", "Molto", "allegro"),
+            "Rezitativ: Recitative and Aria, BWV 243a":
+                ("Recitative", " Recitative ", "and", "Aria", "BWV243a"),
+        }
+        hyphenated = {
+            True: ("Es", "Dur", " Symphony", " Symphony ", "one", "two"),
+            False: ("Es-Dur", " Symphony", " Symphony ", "one-two"),
+        }
+        parts = self.plugin.PartLevels()
+        tuples = self.plugin.parse_text_tuples("synonyms", self.SYNONYMS)[0]
+        for split in (True, False):
+            track = Mock()
+            parts.options[track] = {"cwp_split_hyphenated": split}
+            parts.synonyms[track] = tuples
+            for title, words in expected.items():
+                self.assertEqual(parts.listify("session", track, title)["s_test_tuple"], words)
+            self.assertEqual(
+                parts.listify("session", track, "Es-Dur Sinfonia; Sinfonie one-two")["s_test_tuple"],
+                hyphenated[split])
+
+    def test_canonize_matches_old(self) -> None:
+        options = [
+            self.SYNONYMS,
+            # groups, repeated group names and named backreferences in user regexes
+            self.SYNONYMS + r" / (!!(?P<n>op)\.!!, opno) / (!!(?P<n>n)(?P=n)?o\.!!, number)",
+        ]
+        words = ["Sinfonie Nr. 5 c-moll op. 67", "Symphony No. 40 in G minor", "Rezitativ: Recitative",
+                 "Recitativo (no. 3, op. 2)", "Sinfonia", "Nr", "", "op.", "nno. 4"]
+        for option in options:
+            tuples = self.plugin.parse_text_tuples("synonyms", option)[0]
+            table = self.plugin.SynonymTable(tuples)
+            for s in words + [word for s in words for word in s.split()]:
+                self.assertEqual(table.canonize(s), old_canonize_synonyms(tuples, s), s)
+
+        # numbered backreferences, and a regex which does not compile
+        tuples = self.plugin.parse_text_tuples(
+            "synonyms", self.SYNONYMS + r" / (!!(\w)\1-flat!!, double flat) / (!!(?P=x)!!, broken)")[0]
+        table = self.plugin.SynonymTable(tuples)
+        self.assertEqual(table.canonize("Sinfonia in ee-flat major"), "Symphony in double flat major")
+
+    def test_boil_string_matches_old(self) -> None:
+        strings = [
+            "Symphony No. 5 in C minor, Op. 67: I. Allegro con brio",
+            "Die schöne Müllerin, D. 795: XX. Des Baches Wiegenlied",
+            "Straße, Grosz, Œuvres, Cœur, Übung, Mädchen, Æsir",
+            "Prélude in F\u266F major \u2013 Fugue in B\u266D \u2014 part IV",
+            "Händel: Messiah, HWV 56 \u2013 Part II: No. 44 Hallelujah",
+            "Les Nuits d'été, Op. 7", "Variations", "Bachs'", "", "   ", "ii", "III. Menuetto",
+        ]
+        for s in strings:
+            self.assertEqual(
+                self.plugin.boil_string(s), old_boil_string(self.plugin.replace_roman_numerals, s), s)
+
+    def test_multi_lcs(self) -> None:
+        multi_lcs = self.plugin.suffixtree.multi_lcs
+        self.assertEqual(multi_lcs(["Symphony No. 5", "Symphony No. 7", "Sinfonia No. 5"])["response"], list(" No. "))
+        self.assertEqual(multi_lcs([["Mass", "in", "B", "minor"], ["Mass", "in", "C", "minor"]])["response"],
+                         ["Mass", "in"])
+        self.assertEqual(multi_lcs(["abc", "xyz"])["response"], [])
+        self.assertIn("error", multi_lcs(["abc", ["abc"]]))
+        self.assertIn("error", multi_lcs("abc"))
+
+        rng = random.Random(1)
+        for _ in range(300):
+            strings = ["".join(rng.choice("ab|$#%@_") for _ in range(rng.randint(0, 12)))
+                       for _ in range(rng.randint(1, 4))]
+            if rng.random() < 0.5:
+                strings = [list(s) for s in strings]
+            response = multi_lcs(strings)["response"]
+            self.assertEqual(len(response), brute_force_lcs_length(strings), strings)
+            part = response if isinstance(strings[0], list) else "".join(response)
+            self.assertTrue(all(contains(s, part) for s in strings), strings)
+
+    def test_session_profile_is_bounded(self) -> None:
+        self.plugin.log_writer = Mock()
+        releases = self.plugin.PROFILE_RECENT_RELEASES + 5
+        for i in range(releases):
+            self.plugin.write_profile("r%d" % i, {
+                "release_id": "r%d" % i, "name": "Album", "duration": 1.0, "lookups": 2,
+                "cache_hits": 1, "bytes_received": 10,
+                "stages": {"work_process": {"calls": 3, "wall": 0.5, "cpu": 0.25}},
+            })
+        self.assertEqual(self.plugin.log_writer.replace.call_count, releases)
+        filename, content = self.plugin.log_writer.replace.call_args[0]
+        self.assertEqual(filename, "session.profile.json")
+        profile = json.loads(content)
+        self.assertEqual(profile["releases"], releases)
+        self.assertEqual(profile["lookups"], 2 * releases)
+        self.assertEqual(profile["stages"]["work_process"]["calls"], 3 * releases)
+        self.assertEqual(len(profile["recent"]), self.plugin.PROFILE_RECENT_RELEASES)
+        self.assertEqual(profile["recent"][-1]["release_id"], "r%d" % (releases - 1))
+        self.assertNotIn("stages", profile["recent"][-1])
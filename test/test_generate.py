@@ -1,13 +1,17 @@
 import doctest
 import os
 import glob
+import gzip
 import json
 import shutil
 import tempfile
 import unittest
+import zipfile
 from contextlib import redirect_stdout
+from hashlib import sha256
 from io import StringIO
-from generate import build_json, zip_files
+from unittest.mock import Mock, patch
+from generate import BuildCache, BuildStats, build_json, build_plugins, zip_files
 
 
 class GenerateTestCase(unittest.TestCase):
@@ -92,3 +96,145 @@ class GenerateTestCase(unittest.TestCase):
             self.assertIsInstance(data['author'], str)
             self.assertIsInstance(data['description'], str)
             self.assertIsInstance(data['version'], str)
+
+    def test_build_cache(self):
+        """
+        Asserts that a second build reuses the cached results for
+        all unchanged plugins.
+        """
+
+        cache_path = os.path.join(self.dest_dir, "cache", "build.json")
+        cache = BuildCache(cache_path)
+        self.with_suppressed_stdout(build_json, self.dest_dir, cache, jobs=1)
+        self.with_suppressed_stdout(zip_files, self.dest_dir, cache, jobs=1)
+        cache.save()
+        with open(self.plugin_file, "r") as in_file:
+            first_json = in_file.read()
+
+        stats = BuildStats()
+        cache = BuildCache(cache_path)
+        self.with_suppressed_stdout(build_json, self.dest_dir, cache, stats)
+        self.with_suppressed_stdout(zip_files, self.dest_dir, cache, stats)
+        with open(self.plugin_file, "r") as in_file:
+            second_json = in_file.read()
+
+        plugin_folders = next(os.walk(self.PLUGIN_DIR))[1]
+        self.assertEqual(first_json, second_json)
+        self.assertEqual(stats.hits['plugin'], 2 * len(plugin_folders))
+        self.assertEqual(stats.misses['plugin'], 0)
+
+        out = StringIO()
+        with redirect_stdout(out):
+            stats.report()
+        lines = {line.split()[0]: line for line in out.getvalue().splitlines()[1:]}
+        self.assertEqual(set(lines), {'scan', 'build', 'json', 'plugin'})
+        self.assertNotIn('cached', lines['build'])
+        self.assertIn('%d cached' % (2 * len(plugin_folders)), lines['plugin'])
+        self.assertNotIn('.', lines['plugin'])
+
+    def test_reproducible_zip(self):
+        """
+        Asserts that zip files are identical across builds and that the
+        digests in the json data match the zip files.
+        """
+
+        other_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_dir)
+        self.with_suppressed_stdout(build_plugins, self.dest_dir)
+        self.with_suppressed_stdout(zip_files, other_dir)
+
+        with open(self.plugin_file, "r") as in_file:
+            plugin_json = json.load(in_file)["plugins"]
+
+        for module_name, data in plugin_json.items():
+            zip_name = module_name + ".zip"
+            with open(os.path.join(self.dest_dir, zip_name), "rb") as zip_file:
+                first_zip = zip_file.read()
+            with open(os.path.join(other_dir, zip_name), "rb") as zip_file:
+                second_zip = zip_file.read()
+            self.assertEqual(first_zip, second_zip)
+            self.assertEqual(data['zip_sha256'], sha256(first_zip).hexdigest())
+
+            with zipfile.ZipFile(os.path.join(self.dest_dir, zip_name)) as archive:
+                self.assertIsNone(archive.testzip())
+                for info in archive.infolist():
+                    self.assertEqual(info.date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_sharded_json(self):
+        """
+        Asserts that every plugin gets a shard matching its entry in
+        plugins.json and that the index references the shard contents.
+        """
+
+        self.with_suppressed_stdout(build_plugins, self.dest_dir, write_zip=False, sharded=True)
+
+        with open(self.plugin_file, "r") as in_file:
+            plugin_json = json.load(in_file)["plugins"]
+        with open(os.path.join(self.dest_dir, "plugins-index.json"), "rb") as in_file:
+            index = json.loads(in_file.read())["plugins"]
+
+        self.assertEqual(set(index), set(plugin_json))
+        for module_name, data in plugin_json.items():
+            shard_path = os.path.join(self.dest_dir, "shards", module_name + ".json")
+            with open(shard_path, "rb") as in_file:
+                content = in_file.read()
+            with gzip.open(shard_path + ".gz", "rb") as in_file:
+                self.assertEqual(in_file.read(), content)
+            self.assertEqual(json.loads(content), data)
+            self.assertEqual(index[module_name]['version'], data['version'])
+            self.assertEqual(index[module_name]['sha256'], sha256(content).hexdigest())
+
+    def test_sharded_without_json(self):
+        """
+        Asserts that shards are written without plugins.json and that a
+        missing compressed variant is recreated when the shard is unchanged.
+        """
+
+        self.with_suppressed_stdout(build_plugins, self.dest_dir, write_json=False,
+                                    write_zip=False, sharded=True)
+        self.assertFalse(os.path.exists(self.plugin_file))
+        index_path = os.path.join(self.dest_dir, "plugins-index.json")
+        self.assertTrue(os.path.exists(index_path + ".gz"))
+
+        shard_path = os.path.join(self.dest_dir, "shards", "keep.json")
+        os.remove(shard_path + ".gz")
+        self.with_suppressed_stdout(build_plugins, self.dest_dir, write_json=False,
+                                    write_zip=False, sharded=True)
+        with open(shard_path, "rb") as in_file:
+            content = in_file.read()
+        with gzip.open(shard_path + ".gz", "rb") as in_file:
+            self.assertEqual(in_file.read(), content)
+
+    def test_stale_brotli_variants(self):
+        """
+        Asserts that .br variants written by a build with brotli are removed
+        by a later build without it, and that the shard cleanup only
+        touches shard files.
+        """
+
+        fake_brotli = Mock(compress=lambda content: b"br:" + content)
+        with patch("generate.brotli", fake_brotli):
+            self.with_suppressed_stdout(build_plugins, self.dest_dir, write_json=False,
+                                        write_zip=False, sharded=True)
+        shard_path = os.path.join(self.dest_dir, "shards", "keep.json")
+        index_path = os.path.join(self.dest_dir, "plugins-index.json")
+        self.assertTrue(os.path.exists(shard_path + ".br"))
+        self.assertTrue(os.path.exists(index_path + ".br"))
+
+        other_paths = [os.path.join(self.dest_dir, "shards", name)
+                       for name in ("README", "removed.txt", "removed.json.tmp")]
+        for path in other_paths:
+            open(path, "w").close()
+        removed_path = os.path.join(self.dest_dir, "shards", "removed.json")
+        for suffix in ("", ".gz", ".br"):
+            open(removed_path + suffix, "w").close()
+
+        with patch("generate.brotli", None):
+            self.with_suppressed_stdout(build_plugins, self.dest_dir, write_json=False,
+                                        write_zip=False, sharded=True)
+        self.assertTrue(os.path.exists(shard_path + ".gz"))
+        self.assertFalse(os.path.exists(shard_path + ".br"))
+        self.assertFalse(os.path.exists(index_path + ".br"))
+        self.assertEqual(glob.glob(removed_path + "*"), [removed_path + ".tmp"])
+        for path in other_paths:
+            self.assertTrue(os.path.exists(path))
@@ -0,0 +1,73 @@
+import re
+from test.plugin_test_case import PluginTestCase
+
+
+def old_parse_ignored_tags(ignore_tags_setting):
+    ignore_tags = []
+    for tag in ignore_tags_setting.lower().split(','):
+        tag = tag.strip()
+        if tag.startswith('/') and tag.endswith('/'):
+            try:
+                tag = re.compile(tag[1:-1])
+            except re.error:
+                pass
+        ignore_tags.append(tag)
+    return ignore_tags
+
+
+def old_matches_ignored(ignore_tags, tag):
+    tag = tag.lower().strip()
+    for pattern in ignore_tags:
+        if hasattr(pattern, 'match'):
+            match = pattern.match(tag)
+        else:
+            match = pattern == tag
+        if match:
+            return True
+    return False
+
+
+SETTING = ('Seen Live, favorites, /\\d+ of \\d+ stars/, /best.*/, /(bad/, '
+           '/(a)\\1/, /(?P<x>b)(?P=x)/, /(?i)CAPS/')
+TAGS = ['seen live', ' Seen Live ', 'favorites', 'Favourites', '5 of 5 stars',
+        'Best Of', 'the best', '/(bad/', 'aa', 'ab', 'bb', 'ba', 'caps', 'rock']
+
+
+class TestIgnoredTags(PluginTestCase):
+
+    def check_plugin(self, plugin):
+        ignored = plugin.parse_ignored_tags(SETTING)
+        old = old_parse_ignored_tags(SETTING)
+        for tag in TAGS:
+            self.assertEqual(old_matches_ignored(old, tag), ignored.matches(tag), tag)
+
+        self.assertFalse(ignored.matches(None))
+        self.assertFalse(ignored.matches(''))
+        empty = plugin.parse_ignored_tags('/(bad/')
+        self.assertTrue(empty.matches('/(bad/'))
+        empty = plugin.IgnoredTags([], [])
+        self.assertFalse(empty)
+        self.assertFalse(empty.matches(None))
+        self.assertFalse(empty.matches('rock'))
+
+    def check_structure(self, plugin):
+        for count in (10, 2000):
+            setting = ', '.join('tag%d' % i for i in range(count)) + ', /x\\d+/, /y+/'
+            ignored = plugin.parse_ignored_tags(setting)
+            # names are looked up in a set and the expressions matched as a single regex
+            self.assertIsInstance(ignored.names, frozenset)
+            self.assertEqual(len(ignored.names), count)
+            self.assertIsInstance(ignored.regex, re.Pattern)
+            self.assertEqual(ignored.patterns, [])
+            self.assertTrue(ignored.matches('tag%d' % (count - 1)))
+            self.assertTrue(ignored.matches('x12'))
+
+    def test_lastfm(self):
+        plugin = self._test_plugin_install('Last.fm', 'lastfm')
+        self.check_plugin(plugin)
+        self.check_structure(plugin)
+
+    def test_wikidata(self):
+        plugin = self._test_plugin_install('Wikidata Genre', 'wikidata')
+        self.check_plugin(plugin)
+        self.check_structure(plugin)
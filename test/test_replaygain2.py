@@ -0,0 +1,44 @@
+import os
+from test.plugin_test_case import PluginTestCase
+
+from picard.metadata import Metadata
+
+
+class TestReplayGain2ResultCache(PluginTestCase):
+    OPTIONS = "-O -s i"
+    RESULT = {"gain": "-6.50", "peak": "0.98", "lufs": "-11.50"}
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.plugin = self._test_plugin_install("ReplayGain 2.0", "replaygain2")
+        self.cache = self.plugin.ResultCache(os.path.join(self.tmp_directory, "cache.db"))
+        self.path = os.path.join(self.tmp_directory, "track.flac")
+        self.write_file(b"audio")
+        self.metadata = Metadata(replaygain_track_gain="-6.50 dB")
+
+    def write_file(self, data: bytes) -> None:
+        with open(self.path, "ab") as f:
+            f.write(data)
+        mtime = os.stat(self.path).st_mtime_ns + 1_000_000_000
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def test_saved_tags_keep_result(self) -> None:
+        self.cache.set_track(self.path, self.OPTIONS, self.RESULT)
+        self.write_file(b"tags")
+        self.cache.file_saved(self.path, self.metadata)
+        self.assertEqual(self.cache.get_track(self.path, self.OPTIONS), self.RESULT)
+
+    def test_changed_before_save_drops_result(self) -> None:
+        self.cache.set_track(self.path, self.OPTIONS, self.RESULT)
+        self.write_file(b"other audio")
+        self.assertIsNone(self.cache.get_track(self.path, self.OPTIONS))
+        self.write_file(b"tags")
+        self.cache.file_saved(self.path, self.metadata)
+        self.assertIsNone(self.cache.get_track(self.path, self.OPTIONS))
+
+    def test_file_without_result_is_ignored(self) -> None:
+        self.cache.set_track(self.path, self.OPTIONS, self.RESULT)
+        self.cache.identities.clear()
+        self.write_file(b"tags")
+        self.cache.file_saved(self.path, self.metadata)
+        self.assertIsNone(self.cache.get_track(self.path, self.OPTIONS))